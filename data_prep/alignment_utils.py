@@ -1,10 +1,17 @@
 import csv
+import json
+import os
+import shutil
+from functools import lru_cache
 from pathlib import Path
+from typing import List, Tuple
+import numpy as np
 import torch
 import torchaudio.functional as F
 import torchaudio
 from denoiser import pretrained  # Import du modèle pré-entraîné
 from denoiser.dsp import convert_audio
+from result_sink import ResultSink
 
 #########################################################
 # MMS feature extractor minimum input frame size (25ms)
@@ -14,6 +21,95 @@ from denoiser.dsp import convert_audio
 
 MMS_SUBSAMPLING_RATIO = 400
 
+# hop between two consecutive MMS emission frames, in samples (20ms at 16kHz)
+MMS_FRAME_STRIDE = 320
+
+# identity of the acoustic model used by segmentation and filtering, part of the emission cache key
+MMS_MODEL_ID = "torchaudio.pipelines.MMS_FA"
+
+
+def window_emissions(model, windows: torch.Tensor, append_star: bool = False) -> torch.Tensor:
+    """Log-probabilities of a batch of windows ``(batch, samples)``, each computed as if run alone.
+
+    The wrapper returned by ``bundle.get_model()`` layer-normalizes the whole batch as
+    one waveform, and only appends the ``*`` column to a batch of one. Its network is
+    run here under a normalization of every window on its own, and ``append_star``
+    appends the column to every item.
+
+    Returns:
+        torch.Tensor: emission of shape (batch, frames, num_labels [+ 1])
+    """
+    if hasattr(model, "normalize_waveform"):
+        if model.normalize_waveform:
+            windows = torch.nn.functional.layer_norm(windows, windows.shape[-1:])
+        emission, _ = model.model(windows)
+        if model.apply_log_softmax:
+            emission = torch.nn.functional.log_softmax(emission, dim=-1)
+    else:
+        emission, _ = model(windows)
+    if append_star:
+        emission = torch.cat((emission, emission.new_zeros(emission.shape[:2] + (1,))), dim=-1)
+    return emission
+
+
+def compute_emissions(
+    model,
+    waveform,
+    sample_rate: int,
+    chunk_size_s: int,
+    device,
+    context_size_s: float = 0.0,
+    batch_size: int = 1,
+    append_star: bool = False,
+):
+    """Run the MMS model over ``chunk_size_s`` windows of ``waveform`` and rejoin the emissions.
+
+    Full windows are cut with ``unfold`` and run ``batch_size`` at a time, each one
+    normalized on its own (see ``window_emissions``) so the batch size doesn't change
+    the result. Each window is extended by ``context_size_s`` of audio on both sides
+    and the frames computed from that context are dropped, so frames near a window
+    boundary see the same amount of audio as any other. The remaining tail is run on
+    its own, with its left context. With no context, the output is the same as running
+    every chunk separately. ``append_star`` adds the ``*`` column of the star model,
+    which must then be loaded without it (``bundle.get_model(with_star=False)``).
+
+    Returns:
+        torch.Tensor: emission of shape (1, num_frames, num_labels)
+    """
+    waveform = waveform.mean(dim=0)  # (num_samples,)
+    num_samples = waveform.size(0)
+    batch_size = max(batch_size, 1)
+
+    context = int(context_size_s * sample_rate) // MMS_FRAME_STRIDE * MMS_FRAME_STRIDE
+    window = int(chunk_size_s * sample_rate)
+    if context > 0:
+        # kept frames only line up with the window boundaries on a whole number of frames
+        window = window // MMS_FRAME_STRIDE * MMS_FRAME_STRIDE
+    context_frames, window_frames = context // MMS_FRAME_STRIDE, window // MMS_FRAME_STRIDE
+    num_windows = num_samples // window
+
+    emissions = []
+    with torch.inference_mode():
+        if num_windows > 0:
+            # samples [-context, num_windows * window + context), zero-padded outside the audio
+            padded = waveform[: num_windows * window + context]
+            padded = torch.nn.functional.pad(padded, (context, num_windows * window + context - padded.size(0)))
+            windows = padded.unfold(0, window + 2 * context, window)  # (num_windows, window + 2 * context)
+            for i in range(0, num_windows, batch_size):
+                emission = window_emissions(model, windows[i : i + batch_size].to(device), append_star)
+                if context > 0:
+                    emission = emission[:, context_frames : context_frames + window_frames]
+                emissions.append(emission.reshape(1, -1, emission.size(-1)))
+
+        start = max(num_windows * window - context, 0)
+        # NOTE: we could pad here, but it'll need to be removed later
+        # skipping for simplicity, since it's at most 25ms
+        if num_samples > num_windows * window and num_samples - start >= MMS_SUBSAMPLING_RATIO:
+            emission = window_emissions(model, waveform[start:].unsqueeze(0).to(device), append_star)
+            emissions.append(emission[:, (num_windows * window - start) // MMS_FRAME_STRIDE :])
+
+    return torch.cat(emissions, dim=1)  # (1, frame_length, num_labels)
+
 
 ###############################################################################################################
 # functions modified from https://pytorch.org/audio/main/tutorials/ctc_forced_alignment_api_tutorial.html
@@ -27,7 +123,8 @@ def align(emission, tokens, device):
     # Supprimer les 0 (blanks) tout en gardant la forme [1, N]
     targets = targets[targets != 0].unsqueeze(0)
 
-    alignments, scores = F.forced_align(emission, targets, blank=0)
+    # cached emissions are float16
+    alignments, scores = F.forced_align(emission.float(), targets, blank=0)
 
     alignments, scores = alignments[0], scores[0]  # enlever la batch dimension
     scores = scores.exp()  # convertir en probabilité
@@ -45,14 +142,35 @@ def unflatten(list_, lengths):
     return ret
 
 
-def compute_alignments(emission, transcript, dictionary, device):
+def compute_alignments(emission, transcript, dictionary, device, return_scores=False):
     tokens = [dictionary[char] for word in transcript for char in word]
     alignment, scores = align(emission, tokens, device)
     token_spans = F.merge_tokens(alignment, scores)
     word_spans = unflatten(token_spans, [len(word) for word in transcript])
+    if return_scores:
+        # per-frame probabilities of the aligned path, shape (frame_length,)
+        return word_spans, scores
     return word_spans
 
 
+def compute_span_probability_difference(emission, aligned_scores, start: int, end: int, num_labels: int) -> float:
+    """Length-normalized probability difference (§3.1.5 of MMS) of frames [start, end).
+
+    Uses the emission and the forced-alignment scores of a whole chapter instead of
+    re-running the model on the segment, so segmentation can score verses for free.
+    Only the first ``num_labels`` emission columns are used, which drops the ``*``
+    column of the star model (a constant log-probability of 0).
+    """
+    num_frames = end - start
+    if num_frames <= 0:
+        return float("-inf")
+    # emissions are already log-softmaxed by the MMS_FA bundle
+    log_probs = emission[0, start:end, :num_labels].float()
+    greedy_log_probs = log_probs.max(dim=-1).values.sum()
+    aligned_log_probs = torch.log(aligned_scores[start:end]).sum()
+    return ((aligned_log_probs - greedy_log_probs) / num_frames).item()
+
+
 def compute_alignment_scores(emission, transcript, dictionary, device):
     tokens = [dictionary[char] for word in transcript for char in word]
 
@@ -68,34 +186,231 @@ def compute_alignment_scores(emission, transcript, dictionary, device):
         else:
             raise e
 
+def make_length_batches(lengths: List[float], max_batch_length: float, max_batch_size: int = None) -> List[List[int]]:
+    """Group item indices into batches of similar length.
+
+    Items are sorted by length and a batch is closed as soon as its padded size
+    (number of items x longest item) would exceed ``max_batch_length`` or it holds
+    ``max_batch_size`` items. An item longer than the budget gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        # sorted order: the item being added is always the longest of the batch
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or (len(batch) + 1) * lengths[i] > max_batch_length):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@lru_cache(maxsize=1)
+def _forced_align_batch():
+    # optional: the batched C++ aligner of forced-alignhf-model, built or installed as in the README
+    try:
+        from ctc_forced_aligner import forced_align_batch
+    except ImportError:
+        return None
+    return forced_align_batch
+
+
+def compute_aligned_log_probs_batched(emission, lengths, transcripts, dictionary, device):
+    """Forced-alignment log-probability of every item of a padded emission batch.
+
+    With the ``ctc_forced_aligner`` extension available, the whole batch is copied to
+    the host once and aligned by its ``forced_align_batch``, all items in parallel
+    threads. Otherwise ``F.forced_align``, which only accepts a batch of one, aligns
+    the items one after the other, syncing with the host for each.
+    Items whose transcript can't be aligned (empty, or too long for the number of
+    frames) get ``-inf``, i.e. a zero probability.
+
+    Returns:
+        A (B,) tensor on ``emission.device``.
+    """
+    forced_align_batch = _forced_align_batch()
+    if forced_align_batch is None:
+        return _aligned_log_probs_one_by_one(emission, lengths, transcripts, dictionary, device)
+
+    # blank (0) isn't a target
+    tokens = [[dictionary[char] for word in transcript for char in word] for transcript in transcripts]
+    tokens = [[token for token in item if token != 0] for item in tokens]
+    target_lengths = np.array([len(item) for item in tokens], dtype=np.int64)
+    targets = np.zeros((len(tokens), max(target_lengths.max(initial=0), 1)), dtype=np.int64)
+    for i, item in enumerate(tokens):
+        targets[i, : len(item)] = item
+
+    aligned_log_probs = np.full(len(tokens), float("-inf"), dtype=np.float32)
+    aligned = target_lengths > 0
+    if aligned.any():
+        log_probs = emission.float().cpu().numpy()
+        input_lengths = lengths.cpu().numpy().astype(np.int64)
+        # padded frames score 0, items whose targets don't fit score -inf
+        _, scores = forced_align_batch(
+            np.ascontiguousarray(log_probs[aligned]),
+            targets[aligned],
+            input_lengths[aligned],
+            target_lengths[aligned],
+            0,
+            0,
+        )
+        aligned_log_probs[aligned] = scores.sum(axis=1)
+    return torch.from_numpy(aligned_log_probs).to(emission.device)
+
+
+def _aligned_log_probs_one_by_one(emission, lengths, transcripts, dictionary, device):
+    aligned_log_probs = torch.full((len(transcripts),), float("-inf"), device=emission.device)
+    for i, (length, transcript) in enumerate(zip(lengths.tolist(), transcripts)):
+        tokens = [dictionary[char] for word in transcript for char in word]
+        targets = torch.tensor([tokens], dtype=torch.int32, device=device)
+        targets = targets[targets != 0].unsqueeze(0)
+        if targets.size(1) == 0:
+            continue
+        try:
+            _, scores = F.forced_align(emission[i : i + 1, :length], targets, blank=0)
+        except RuntimeError as e:
+            # sometimes emission frames are too short for the transcript
+            if e.args[0].startswith("targets length is too long for CTC"):
+                continue
+            raise e
+        aligned_log_probs[i] = scores.sum()
+    return aligned_log_probs
+
+
 ######### statistic to controle fitered and rejected verses ############
 
-def write_book_stats(book_name:str,retained_count:int, rejected_count:int,history_file_path:Path):
-        """Helper function to write stats to the CSV."""
+# per-chapter table written by `segment_audio.py --score`, read back by `run_filter.py --precomputed_scores`
+SCORES_FILE_NAME = "scores.csv"
+
+
+def load_precomputed_scores(audio_dir: Path) -> dict:
+    """Read every chapter's scores.csv under ``audio_dir`` into {wav path: probability difference}."""
+    scores = {}
+    for scores_path in sorted(Path(audio_dir).rglob(SCORES_FILE_NAME)):
+        with open(scores_path, newline="") as f:
+            for row in csv.DictReader(f):
+                scores[scores_path.parent / row["filename"]] = float(row["probability_difference"])
+    return scores
+
+
+# how filtering places the retained segments in the output directory
+MATERIALIZE_MODES = ("copy", "hardlink", "symlink", "manifest")
+MANIFEST_FILE_NAME = "manifest.jsonl"
+
+
+def materialize(src: Path, dst: Path, mode: str = "copy"):
+    """Place ``src`` at ``dst`` by copying it, or by linking it so no data is duplicated.
+
+    Hard links fall back to a copy when ``src`` and ``dst`` are on different file systems.
+    Symbolic links point to the absolute path of ``src``.
+    """
+    dst = Path(dst)
+    if dst.exists() or dst.is_symlink():
+        # links can't overwrite, and a copy onto a link of ``src`` would copy the file onto itself
+        dst.unlink()
+    if mode == "copy":
+        shutil.copy(src, dst)
+    elif mode == "hardlink":
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+    elif mode == "symlink":
+        os.symlink(Path(src).resolve(), dst)
+    else:
+        raise ValueError(f"Unknown materialize mode {mode!r}, expected one of {MATERIALIZE_MODES[:3]}")
+
+
+def manifest_line(audio_path: Path, transcript_path: Path, probability_difference: float) -> str:
+    """JSONL manifest line listing a retained segment instead of materializing it."""
+    entry = {
+        "audio_filepath": str(Path(audio_path).resolve()),
+        "text_filepath": str(Path(transcript_path).resolve()),
+        "probability_difference": round(probability_difference, 6),
+    }
+    return json.dumps(entry, ensure_ascii=False)
+
+
+def write_book_stats(book_name:str,retained_count:int, rejected_count:int,history_file):
+        """Helper function to write stats to the CSV, a ``ResultSink`` or a path."""
         if book_name:
-            with open(history_file_path, "a", newline="") as history_file:
-                csv_writer = csv.writer(history_file)
+            if isinstance(history_file, ResultSink):
+                history_file.write_row([book_name, retained_count, rejected_count])
+                return
+            with open(history_file, "a", newline="") as f:
+                csv_writer = csv.writer(f)
                 csv_writer.writerow([book_name, retained_count, rejected_count])
-            retained_count = 0
-            rejected_count = 0
 
 
 ############ process audio by denoising(in our case,remove background music) #############
 
-def denoise(audio_path: Path,output_dir:Path) -> str:
-    """Dénoise un fichier audio en utilisant le CPU ou le GPU selon la disponibilité."""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = pretrained.dns64().to(device)
+_DENOISERS = {}
+
+
+def load_denoiser(device=None):
+    """Charge le modèle dns64 une seule fois par processus et par device."""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    if device not in _DENOISERS:
+        _DENOISERS[device] = pretrained.dns64().to(device).eval()
+    return _DENOISERS[device]
 
-    # Charger et convertir l'audio
-    wav, sr = torchaudio.load(audio_path)
-    wav = convert_audio(wav, sr, model.sample_rate, model.chin).to(device)
 
-    # Dénoiser
+def denoise_waveform(wav: torch.Tensor, sr: int, device=None) -> Tuple[torch.Tensor, int]:
+    """Dénoise un signal déjà décodé (canaux x échantillons), sans passer par un fichier.
+
+    Returns:
+    - Le signal dénoisé sur CPU et sa fréquence d'échantillonnage, celle du modèle.
+    """
+    model = load_denoiser(device)
+    device = next(model.parameters()).device
+
+    wav = convert_audio(wav, sr, model.sample_rate, model.chin).to(device)
     with torch.no_grad():
         denoised = model(wav[None])[0].cpu()  # Assurez-vous de ramener en CPU pour torchaudio.save
+    return denoised, model.sample_rate
+
+
+def denoise(audio_path: Path,output_dir:Path) -> str:
+    """Dénoise un fichier audio en utilisant le CPU ou le GPU selon la disponibilité."""
+    # Charger l'audio et dénoiser
+    wav, sr = torchaudio.load(audio_path)
+    denoised, sample_rate = denoise_waveform(wav, sr)
 
     # Sauvegarde du fichier
-    torchaudio.save(output_dir, denoised, model.sample_rate) # quelle frequence pour output audios?
+    torchaudio.save(output_dir, denoised, sample_rate) # quelle frequence pour output audios?
     print(f"Processed and saved: {output_dir}")
-    return output_dir
\ No newline at end of file
+    return output_dir
+
+
+def denoise_batch(audio_paths: List[Path], output_paths: List[Path], device=None) -> List[Path]:
+    """Dénoise un lot de fichiers en un seul passage du modèle.
+
+    Les signaux sont complétés par des zéros jusqu'à la longueur du plus long du lot,
+    puis chaque sortie est recoupée à sa longueur d'origine avant la sauvegarde.
+    Le modèle normalise chaque signal par son écart-type, padding compris : regrouper
+    des fichiers de durées proches (voir ``denoising.bucket_by_duration``) garde cet
+    effet négligeable.
+    """
+    model = load_denoiser(device)
+    device = next(model.parameters()).device
+
+    wavs = []
+    for audio_path in audio_paths:
+        wav, sr = torchaudio.load(audio_path)
+        wavs.append(convert_audio(wav, sr, model.sample_rate, model.chin))
+    lengths = [wav.shape[-1] for wav in wavs]
+
+    batch = torch.zeros(len(wavs), model.chin, max(lengths))
+    for i, wav in enumerate(wavs):
+        batch[i, :, : wav.shape[-1]] = wav
+
+    with torch.no_grad():
+        denoised = model(batch.to(device)).cpu()
+
+    for output_path, wav, length in zip(output_paths, denoised, lengths):
+        torchaudio.save(output_path, wav[:, :length], model.sample_rate)
+    return output_paths
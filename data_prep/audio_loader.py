@@ -0,0 +1,164 @@
+import math
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import torch
+import torchaudio
+import torchaudio.transforms as T
+from torch.nn.utils.rnn import pad_sequence
+
+# (orig_freq, new_freq, dtype) -> Resample, shared by every caller in the process
+_RESAMPLERS = {}
+_RESAMPLERS_LOCK = threading.Lock()
+
+
+def get_resampler(orig_freq: int, new_freq: int, dtype: torch.dtype = torch.float32) -> T.Resample:
+    """``torchaudio.transforms.Resample`` for a rate pair, its sinc kernel computed only once."""
+    key = (int(orig_freq), int(new_freq), dtype)
+    with _RESAMPLERS_LOCK:
+        resampler = _RESAMPLERS.get(key)
+        if resampler is None:
+            resampler = _RESAMPLERS[key] = T.Resample(key[0], key[1], dtype=dtype)
+    return resampler
+
+
+def resampled_length(num_frames: int, orig_freq: int, new_freq: int) -> int:
+    return math.ceil(num_frames * new_freq / orig_freq)
+
+
+def resample_batch(waveforms: List[torch.Tensor], sample_rates: List[int], target_sample_rate: int) -> List[torch.Tensor]:
+    """Resample 1-D waveforms of mixed sample rates to ``target_sample_rate``.
+
+    Waveforms sharing a rate are zero-padded and resampled in one call, then trimmed
+    back to their own resampled length. The kernel only reaches past the end of a
+    waveform into zeros, as it would when resampling it alone, so the output is the
+    same as resampling each file on its own.
+    """
+    resampled = list(waveforms)
+    groups = defaultdict(list)
+    for i, sample_rate in enumerate(sample_rates):
+        if sample_rate != target_sample_rate:
+            groups[(sample_rate, waveforms[i].dtype)].append(i)
+
+    for (sample_rate, dtype), indices in groups.items():
+        resampler = get_resampler(sample_rate, target_sample_rate, dtype)
+        padded = pad_sequence([waveforms[i] for i in indices], batch_first=True, padding_value=0)
+        output = resampler(padded)
+        for row, i in enumerate(indices):
+            resampled[i] = output[row, : resampled_length(waveforms[i].shape[0], sample_rate, target_sample_rate)]
+    return resampled
+
+
+def audio_length(audio_path: Path, target_sample_rate: int) -> int:
+    """Number of samples of ``audio_path`` once resampled, read from the header only."""
+    info = torchaudio.info(str(audio_path))
+    return resampled_length(info.num_frames, info.sample_rate, target_sample_rate)
+
+
+def audio_duration(audio_path: Path) -> float:
+    """Duration of ``audio_path`` in seconds, read from the header only."""
+    info = torchaudio.info(str(audio_path))
+    return info.num_frames / info.sample_rate
+
+
+def decode_audio(audio_path: Path, sample_rate: int = None, block_seconds: float = 10.0) -> Tuple[torch.Tensor, int]:
+    """Decode any ffmpeg-readable file (mp3, ogg, flac, wav...) to a mono float waveform of shape (1, T).
+
+    Downmixing and resampling to ``sample_rate`` (the file's own rate if None) run in
+    ffmpeg's filter graph while decoding, ``block_seconds`` of audio at a time, so no
+    intermediate wav is written and the full-rate multichannel signal is never held
+    in memory.
+    """
+    # torchaudio.io (removed in torchaudio 2.9) needs the FFmpeg 4-6 shared libraries,
+    # imported here so that the modules only reading wav files don't depend on them
+    from torchaudio.io import StreamReader
+
+    reader = StreamReader(str(audio_path))
+    if sample_rate is None:
+        sample_rate = int(reader.get_src_stream_info(reader.default_audio_stream).sample_rate)
+    reader.add_basic_audio_stream(
+        frames_per_chunk=int(sample_rate * block_seconds),
+        format="fltp",
+        sample_rate=sample_rate,
+        num_channels=1,
+    )
+    blocks = [chunk for (chunk,) in reader.stream()]
+    # chunks are (frames, channels)
+    return torch.cat(blocks).t().contiguous(), sample_rate
+
+
+def load_mono(audio_path: Path) -> Tuple[torch.Tensor, int]:
+    """Decode ``audio_path`` and downmix it to mono."""
+    waveform, sample_rate = torchaudio.load(audio_path)
+    return waveform.mean(dim=0), sample_rate
+
+
+def load_resampled(audio_path: Path, target_sample_rate: int) -> torch.Tensor:
+    """Decode ``audio_path``, downmix it to mono and resample it to ``target_sample_rate``."""
+    waveform, sample_rate = load_mono(audio_path)
+    if sample_rate != target_sample_rate:
+        waveform = get_resampler(sample_rate, target_sample_rate, waveform.dtype)(waveform)
+    return waveform
+
+
+def iter_audio_batches(
+    audio_paths: List[Path],
+    batches: List[List[int]],
+    target_sample_rate: int,
+    num_workers: int = 4,
+    prefetch: int = 2,
+) -> Iterator[Tuple[List[int], torch.Tensor, torch.Tensor]]:
+    """Stream padded batches of resampled audio, decoded in background threads.
+
+    Decoding of the next ``prefetch`` batches runs on ``num_workers`` threads while the
+    caller consumes the current one, so at most ``prefetch + 1`` batches are held in
+    memory at a time, whatever the number of files. Each decoded batch is then
+    resampled on a separate thread, one call per source sample rate.
+
+    Args:
+        audio_paths: All audio files.
+        batches: Indices into ``audio_paths``, one list per batch, in the order to yield them.
+        target_sample_rate: Sample rate of the yielded waveforms.
+        num_workers: Number of decoding threads.
+        prefetch: Number of batches decoded ahead of the one being consumed.
+
+    Yields:
+        Tuple(list, Tensor, Tensor): the batch indices, the zero-padded waveforms of
+        shape (batch_size, max_length) and their lengths of shape (batch_size,).
+    """
+    batch_iter = iter(batches)
+    pending = deque()
+
+    def resample(futures) -> List[torch.Tensor]:
+        waveforms, sample_rates = zip(*(future.result() for future in futures))
+        return resample_batch(list(waveforms), list(sample_rates), target_sample_rate)
+
+    # resampling waits on the decoding futures, it gets its own thread so it can never
+    # hold a decoding worker while the files it waits on are still queued
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor, ThreadPoolExecutor(
+        max_workers=1
+    ) as resample_executor:
+
+        def submit_next() -> bool:
+            batch = next(batch_iter, None)
+            if batch is None:
+                return False
+            futures = [executor.submit(load_mono, audio_paths[i]) for i in batch]
+            pending.append((batch, resample_executor.submit(resample, futures)))
+            return True
+
+        for _ in range(max(prefetch, 1)):
+            if not submit_next():
+                break
+
+        while pending:
+            batch, future = pending.popleft()
+            waveforms = future.result()
+            # keep the queue full while the caller runs inference on this batch
+            submit_next()
+
+            lengths = torch.tensor([waveform.shape[0] for waveform in waveforms], dtype=torch.int64)
+            yield batch, pad_sequence(waveforms, batch_first=True, padding_value=0), lengths
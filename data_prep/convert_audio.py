@@ -1,38 +1,77 @@
+import os
 import sys
 import argparse
-from pydub import AudioSegment
+from itertools import repeat
 from pathlib import Path
 from glob import glob
-from tqdm.contrib.concurrent import process_map
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from tqdm import tqdm
 
-def convert_audio(input_path, output_dir, sample_rate, extension):
+from fingerprints import code_version, fingerprint, hash_inputs, plan_reason, print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+
+# secondes de signal décodées, rééchantillonnées et écrites à la fois
+BLOCK_SECONDS = 10
+
+# format de sortie -> encodeur ffmpeg (PCM 16 bits dans les deux cas)
+OUTPUT_ENCODERS = {"wav": "pcm_s16le", "flac": "flac"}
+
+
+def _init_worker():
+    # chaque processus convertit un fichier à la fois sur un seul thread,
+    # le parallélisme vient du nombre de processus
+    torch.set_num_threads(1)
+
+
+def convert_audio(input_path, output_dir, sample_rate, output_format="wav"):
     """
-    Convertit un fichier audio en WAV avec le taux d'échantillonnage spécifié.
+    Convertit un fichier audio en WAV (ou FLAC) mono avec le taux d'échantillonnage spécifié.
+
+    Le fichier est décodé, converti en mono et rééchantillonné par blocs de
+    ``BLOCK_SECONDS`` secondes par ffmpeg dans le processus, puis chaque bloc est
+    encodé directement dans le fichier de sortie : le fichier entier n'est jamais
+    chargé en mémoire. La sortie est écrite dans un fichier temporaire renommé à la
+    fin, un fichier interrompu n'est donc jamais pris pour une sortie valide.
     """
     file_name = Path(input_path).stem  # Nom du fichier sans extension
-    output_path = Path(output_dir) / f"{file_name}.wav"  # Suppression de la langue dans le chemin
+    output_path = Path(output_dir) / f"{file_name}.{output_format}"  # Suppression de la langue dans le chemin
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Charger le fichier audio en fonction de l'extension
-    if extension == "mp3":
-        audio = AudioSegment.from_mp3(input_path)
-    elif extension == "ogg":
-        audio = AudioSegment.from_ogg(input_path)
-    elif extension == "flac":
-        audio = AudioSegment.from_file(input_path, format="flac")
-    else:
-        raise ValueError(f"Extension {extension} non prise en charge")
-
-    audio.export(output_path, format="wav", parameters=["-ar", str(sample_rate), "-ac", "1"])
+    # torchaudio.io (retiré de torchaudio 2.9) charge les bibliothèques FFmpeg 4 à 6 :
+    # importé ici pour que --dry_run fonctionne sans elles
+    from torchaudio.io import StreamReader, StreamWriter
+
+    # le format d'entrée (mp3, ogg, flac...) est détecté par ffmpeg
+    reader = StreamReader(str(input_path))
+    reader.add_basic_audio_stream(
+        frames_per_chunk=sample_rate * BLOCK_SECONDS,
+        decoder_option={"threads": "1"},
+        format="s16p",
+        sample_rate=sample_rate,
+        num_channels=1,
+    )
+
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    writer = StreamWriter(str(tmp_path), format=output_format)
+    writer.add_audio_stream(sample_rate, 1, format="s16", encoder=OUTPUT_ENCODERS[output_format])
+    with writer.open():
+        for (chunk,) in reader.stream():
+            writer.write_audio_chunk(0, chunk)
+    os.replace(tmp_path, output_path)
+
     print(f"Converti : {input_path} -> {output_path} ({sample_rate} Hz)")
+    return input_path
 
 def main():
-    parser = argparse.ArgumentParser(description="Convertir des fichiers audio en WAV avec un taux d'échantillonnage spécifique.")
+    parser = argparse.ArgumentParser(description="Convertir des fichiers audio en WAV ou FLAC mono avec un taux d'échantillonnage spécifique.")
     parser.add_argument("--audio_dir", type=str, required=True, help="Répertoire contenant les fichiers audio")
     parser.add_argument("--sample", type=int, choices=[16000, 22050, 44100, 48000], required=True, help="Taux d'échantillonnage en Hz (ex: 16000, 22050, 44100, 48000)")
     parser.add_argument("--output_dir", type=str, required=True, help="Répertoire de sortie pour les fichiers WAV")
     parser.add_argument("--extension", type=str, default="mp3", choices=["mp3", "ogg", "flac"], help="Extension des fichiers audio (par défaut : mp3)")
+    parser.add_argument("--format", type=str, default="wav", choices=list(OUTPUT_ENCODERS), help="Format des fichiers de sortie, PCM 16 bits (par défaut : wav)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Nombre de processus de conversion (par défaut : nombre de CPU)")
+    parser.add_argument("--dry_run", action="store_true", help="Lister les fichiers à convertir (nouveaux ou modifiés) sans les convertir")
 
     args = parser.parse_args()
     
@@ -43,9 +82,42 @@ def main():
         print(f"Aucun fichier {args.extension} trouvé dans le répertoire spécifié.")
         sys.exit(1)
 
-    convert_audio_partial = partial(convert_audio, output_dir=args.output_dir, sample_rate=args.sample, extension=args.extension)
+    # un fichier n'est reconverti que si son contenu, le code, le taux d'échantillonnage
+    # ou le format a changé, ou si sa sortie a été supprimée
+    ledger = JobLedger(Path(args.output_dir) / LEDGER_FILE_NAME)
+    code = code_version("convert_audio")
+    plans = {}
+    for input_path in audio_files:
+        key = f"{Path(input_path).stem}.{args.format}"
+        inputs = hash_inputs([input_path], ledger.get(key))
+        file_fp = fingerprint(inputs, code, sample_rate=args.sample, format=args.format)
+        reason = plan_reason(ledger.get(key), file_fp)
+        if reason is None and not (Path(args.output_dir) / key).exists():
+            reason = "missing"
+        plans[input_path] = (key, inputs, file_fp, reason)
+
+    if args.dry_run:
+        print_plan(args.audio_dir, {key: reason for key, _, _, reason in plans.values()})
+        return
 
-    process_map(convert_audio_partial, audio_files)
+    pending = [input_path for input_path in audio_files if plans[input_path][3] is not None]
+    workers = max(1, min(args.workers, len(pending)))
+    # assez de fichiers par envoi pour amortir la communication entre processus,
+    # assez peu pour que les processus finissent ensemble
+    chunksize = max(1, min(16, len(pending) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        converted = executor.map(
+            convert_audio,
+            pending,
+            repeat(args.output_dir),
+            repeat(args.sample),
+            repeat(args.format),
+            chunksize=chunksize,
+        )
+        for input_path in tqdm(converted, total=len(pending)):
+            key, inputs, file_fp, _ = plans[input_path]
+            ledger.mark_done(key, inputs=inputs, fingerprint=file_fp)
+    ledger.close()
 if __name__ == "__main__":
     main()
 
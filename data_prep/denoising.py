@@ -1,57 +1,180 @@
 import os
 import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import torch
+import torchaudio
 from tqdm import tqdm
-from alignment_utils import denoise  
-def denoiser(src_path: Path, output_dir: str, extension: str = 'wav'):
+from alignment_utils import denoise_batch, load_denoiser, make_length_batches
+from fingerprints import code_version, fingerprint, hash_inputs, plan_reason, print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+
+
+def bucket_by_duration(audio_paths, max_batch_seconds: float = 600.0, max_batch_size: int = 16):
+    """
+    Regroupe les fichiers audio par durées proches pour le dénoisage par lots.
+
+    Les fichiers sont triés par durée puis découpés de façon à ce que la taille du lot
+    une fois complété par des zéros (nombre de fichiers x durée du plus long) ne dépasse
+    pas ``max_batch_seconds``. Un fichier plus long que ce budget forme un lot à lui seul.
+
+    Args:
+    - audio_paths: Les fichiers audio à regrouper.
+    - max_batch_seconds (float): Durée totale maximale (padding compris) d'un lot.
+    - max_batch_size (int): Nombre maximal de fichiers par lot.
+
+    Returns:
+    - list[list[Path]]: Les lots, du plus court au plus long.
+    """
+    audio_paths = list(audio_paths)
+    durations = []
+    for audio_path in audio_paths:
+        info = torchaudio.info(str(audio_path))
+        durations.append(info.num_frames / info.sample_rate)
+    batches = make_length_batches(durations, max_batch_seconds, max_batch_size)
+    return [[audio_paths[i] for i in batch] for batch in batches]
+
+
+def _init_worker(device: str, num_threads: int):
+    # un seul chargement du modèle par processus, réutilisé pour tous ses lots
+    torch.set_num_threads(num_threads)
+    load_denoiser(device)
+
+
+def _denoise_batch(audio_paths, output_paths, device):
+    return denoise_batch(audio_paths, output_paths, device)
+
+
+def denoiser(
+    src_path: Path,
+    output_dir: str,
+    extension: str = 'wav',
+    max_batch_seconds: float = 600.0,
+    max_batch_size: int = 16,
+    workers: int = 1,
+    device: str = None,
+    dry_run: bool = False,
+):
     """
     Appliquer la réduction du bruit sur les fichiers audio dans le répertoire source.
-    
+
     Args:
     - src_path (Path): Le répertoire contenant les fichiers audio à traiter.
     - output_dir (str): Répertoire où les fichiers audio débruités seront enregistrés.
     - extension (str): L'extension des fichiers audio à traiter (par défaut 'wav').
+    - max_batch_seconds (float): Durée totale maximale (padding compris) d'un lot.
+    - max_batch_size (int): Nombre maximal de fichiers par lot.
+    - workers (int): Nombre de processus, chacun chargeant le modèle une seule fois.
+    - device (str): "cuda" ou "cpu" (par défaut : cuda si disponible, sinon cpu).
+    - dry_run (bool): Lister les fichiers à débruiter sans les traiter.
+
+    Seuls les fichiers nouveaux, modifiés, ou débruités avec une autre version du code
+    sont traités : chaque fichier terminé est enregistré dans le journal
+    ``output_dir/.ledger.jsonl`` avec l'empreinte de son contenu.
     """
     # Récupérer tous les fichiers audio du répertoire source avec l'extension spécifiée
     raw_src_audios = sorted(src_path.rglob(f'*.{extension}'))
 
-    
+
     if not raw_src_audios:
         print(f"Aucun fichier audio avec l'extension .{extension} trouvé dans {src_path}.")
         return
 
-    for src_audio in tqdm(raw_src_audios, desc='Traitement des fichiers audio'):
-        # Extraire le nom du répertoire parent et le nom du fichier
-        parent_dir = src_audio.parent.name
-        file_name = src_audio.name
+    # clé = chemin de sortie relatif, empreinte = contenu du fichier + code du débruiteur
+    ledger = JobLedger(Path(output_dir) / LEDGER_FILE_NAME)
+    code = code_version("alignment_utils")
+    plans = {}
+    for src_audio in raw_src_audios:
+        key = f"{src_audio.parent.name}/{src_audio.name}"
+        inputs = hash_inputs([src_audio], ledger.get(key))
+        file_fp = fingerprint(inputs, code)
+        plans[src_audio] = (key, inputs, file_fp, plan_reason(ledger.get(key), file_fp))
+
+    if dry_run:
+        print_plan(str(src_path), {key: reason for key, _, _, reason in plans.values()})
+        return
+
+    raw_src_audios = [src_audio for src_audio in raw_src_audios if plans[src_audio][3] is not None]
+    if not raw_src_audios:
+        print(f"Tous les fichiers de {src_path} sont déjà débruités.")
+        return
+
+    def mark_done(batch):
+        for src_audio in batch:
+            key, inputs, file_fp, _ = plans[src_audio]
+            ledger.mark_done(key, inputs=inputs, fingerprint=file_fp)
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        # Construire le chemin de sortie
-        out_audio_path = os.path.join(output_dir, parent_dir, file_name)
-        
-        # Créer les répertoires nécessaires pour la sortie
-        os.makedirs(os.path.dirname(out_audio_path), exist_ok=True)
+    jobs = []
+    for batch in bucket_by_duration(raw_src_audios, max_batch_seconds, max_batch_size):
+        out_audio_paths = []
+        for src_audio in batch:
+            # Construire le chemin de sortie à partir du répertoire parent et du nom du fichier
+            out_audio_path = os.path.join(output_dir, src_audio.parent.name, src_audio.name)
+            os.makedirs(os.path.dirname(out_audio_path), exist_ok=True)
+            out_audio_paths.append(out_audio_path)
+        jobs.append((batch, out_audio_paths))
 
-        # Appliquer la réduction du bruit
-        denoise(src_audio, out_audio_path)
+    progress = tqdm(total=len(raw_src_audios), desc='Traitement des fichiers audio')
+    if workers <= 1:
+        load_denoiser(device)
+        for batch, out_audio_paths in jobs:
+            denoise_batch(batch, out_audio_paths, device)
+            mark_done(batch)
+            progress.update(len(batch))
+    else:
+        # répartir les threads CPU entre les processus pour éviter la sur-souscription
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(device, num_threads),
+        ) as executor:
+            futures = {
+                executor.submit(_denoise_batch, batch, out_audio_paths, device): batch for batch, out_audio_paths in jobs
+            }
+            for future in as_completed(futures):
+                progress.update(len(future.result()))
+                mark_done(futures[future])
+    progress.close()
+    ledger.close()
 
     print(f"Traitement terminé. Les fichiers ont été enregistrés dans {output_dir}")
 
 def main():
     # Initialisation du parser d'arguments
     parser = argparse.ArgumentParser(description="Applique la réduction du bruit aux fichiers audio dans un répertoire.")
-    
+
     parser.add_argument('--src_path', type=Path, required=True, help="Chemin du répertoire source contenant les fichiers audio.")
     parser.add_argument('--output_dir', type=str, required=True, help="Répertoire où les fichiers audio débruités seront enregistrés.")
     parser.add_argument('--extension', type=str, default='wav', help="L'extension des fichiers audio à traiter (par défaut 'wav').")
+    parser.add_argument('--max_batch_seconds', type=float, default=600.0, help="Durée totale maximale d'un lot, padding compris (par défaut 600).")
+    parser.add_argument('--max_batch_size', type=int, default=16, help="Nombre maximal de fichiers par lot (par défaut 16).")
+    parser.add_argument('--workers', type=int, default=1, help="Nombre de processus de dénoisage (par défaut 1).")
+    parser.add_argument('--device', type=str, default=None, help="'cuda' ou 'cpu' (par défaut : cuda si disponible).")
+    parser.add_argument('--dry_run', action='store_true', help="Lister les fichiers à débruiter (nouveaux ou modifiés) sans les traiter.")
 
     # Récupérer les arguments
     args = parser.parse_args()
 
     # Lancer la réduction du bruit
-    denoiser(args.src_path, args.output_dir, args.extension)
+    denoiser(
+        args.src_path,
+        args.output_dir,
+        args.extension,
+        args.max_batch_seconds,
+        args.max_batch_size,
+        args.workers,
+        args.device,
+        args.dry_run,
+    )
 
 if __name__ == "__main__":
     main()
 
 # usage
-# python3 denoising.py --src_path "$src_path" --output_dir "$output_dir" --extension wav
\ No newline at end of file
+# python3 denoising.py --src_path "$src_path" --output_dir "$output_dir" --extension wav --workers 4
@@ -0,0 +1,85 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+from fingerprints import file_sha1
+
+
+class EmissionCache:
+    """On-disk cache of MMS emissions, addressed by audio content and model settings.
+
+    Emissions are stored as ``.npy`` arrays (float16 by default) under
+    ``cache_dir/<key[:2]>/<key>.npy``, so a re-run of segmentation or filtering, e.g.
+    with another threshold, skips the acoustic model for every file it has already
+    seen. They are returned memory-mapped in the stored dtype, callers convert the
+    frames they use. A miss returns the stored values as well, so a first run and a
+    re-run give the same alignments and scores. Writes go through a temporary file
+    and ``os.replace`` so parallel workers can share one cache directory.
+    """
+
+    def __init__(self, cache_dir, dtype=np.float16):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+
+    def key(self, audio_path, model_id: str, chunk_size_s: int, with_star: bool, context_size_s: float = 0.0) -> str:
+        fields = [
+            file_sha1(audio_path),
+            model_id,
+            f"chunk={chunk_size_s}",
+            f"star={with_star}",
+            f"context={float(context_size_s)}",
+            self.dtype.str,
+        ]
+        return hashlib.sha1("|".join(fields).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
+
+    def load(self, key: str, device=None) -> Optional[torch.Tensor]:
+        path = self.path(key)
+        if not path.exists():
+            return None
+        # copy-on-write mapping: a writable array torch can wrap without copying it
+        emission = np.load(path, mmap_mode="c")
+        return torch.from_numpy(emission).to(device)
+
+    def save(self, key: str, emission: torch.Tensor):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, emission.detach().cpu().numpy().astype(self.dtype))
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, key: str, compute: Callable[[], torch.Tensor], device=None) -> torch.Tensor:
+        emission = self.load(key, device)
+        if emission is None:
+            self.save(key, compute())
+            emission = self.load(key, device)
+        return emission
+
+
+def cached_emission(
+    cache_dir,
+    audio_path,
+    model_id: str,
+    chunk_size_s: int,
+    with_star: bool,
+    compute: Callable[[], torch.Tensor],
+    device=None,
+    context_size_s: float = 0.0,
+) -> torch.Tensor:
+    """Return the cached emission of ``audio_path``, computing and storing it on a miss.
+
+    ``compute`` is called directly when ``cache_dir`` is None, i.e. caching is disabled.
+    """
+    if cache_dir is None:
+        return compute()
+    cache = EmissionCache(cache_dir)
+    key = cache.key(audio_path, model_id, chunk_size_s, with_star, context_size_s)
+    return cache.get_or_compute(key, compute, device)
@@ -1,16 +1,28 @@
-from typing import List
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 from pathlib import Path
 import argparse
+import os
 
 import numpy as np
 import torch
 import torchaudio
-import torchaudio.transforms as T
-from torch.nn.utils.rnn import pad_sequence
 from tqdm.auto import tqdm
 
-from alignment_utils import MMS_SUBSAMPLING_RATIO,compute_alignment_scores
-from text_utils import preprocess_verse
+from alignment_utils import (
+    MMS_MODEL_ID,
+    compute_aligned_log_probs_batched,
+    compute_alignment_scores,
+    compute_emissions,
+    make_length_batches,
+    manifest_line,
+)
+from audio_loader import audio_duration, audio_length, get_resampler, iter_audio_batches
+from emission_cache import cached_emission
+from fingerprints import code_version, fingerprint, hash_inputs, plan_reason
+from job_ledger import JobLedger, segment_key
+from score_table import write_score_table
+from text_utils import preprocess_verse, preprocess_verses
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -21,6 +33,9 @@ parser.add_argument(
 parser.add_argument("--ground_truth", required=True, help="Ground truth text to forced-align with.")
 parser.add_argument("--language", type=str, default=None, help="Language in ISO 639-3 code.")
 parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+parser.add_argument(
+    "--cache_dir", default=None, help="Directory of the emission cache, reused when the same segments are filtered again. Disabled if not set."
+)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -30,7 +45,9 @@ model = bundle.get_model(with_star=False).to(device)
 DICTIONARY = bundle.get_dict(star=None)
 
 
-def compute_probability_difference(audio_path: str, ground_truth: str,language: str, chunk_size_s: int = 15) -> float:
+def compute_probability_difference(
+    audio_path: str, ground_truth: str, language: str, chunk_size_s: int = 15, cache_dir: str = None
+) -> float:
     audio_path = Path(audio_path)
 
     # apply preprocessing
@@ -39,28 +56,16 @@ def compute_probability_difference(audio_path: str, ground_truth: str,language:
     verse = preprocess_verse(ground_truth,language)
     words = verse.split()
 
-    # load audio
-    input_waveform, input_sample_rate = torchaudio.load(audio_path)
-    resampler = T.Resample(input_sample_rate, bundle.sample_rate, dtype=input_waveform.dtype)
-    resampled_waveform = resampler(input_waveform)
-    # split audio into chunks to avoid OOM and faster inference
-    chunk_size_frames = chunk_size_s * bundle.sample_rate
-    chunks = [
-        resampled_waveform[:, i : i + chunk_size_frames]
-        for i in range(0, resampled_waveform.shape[1], chunk_size_frames)
-    ]
-
-    # collect per-chunk emissions, rejoin
-    emissions = []
-    with torch.inference_mode():
-        for chunk in chunks:
-            # NOTE: we could pad here, but it'll need to be removed later
-            # skipping for simplicity, since it's at most 25ms
-            if chunk.size(1) >= MMS_SUBSAMPLING_RATIO:
-                emission, _ = model(chunk.to(device))  # (1, chunk_frame_length, num_labels)
-                emissions.append(emission)
-
-    emission = torch.cat(emissions, dim=1)  # (1, frame_length, num_labels)
+    def compute_emission():
+        # load audio, only needed when the emission isn't cached yet
+        input_waveform, input_sample_rate = torchaudio.load(audio_path)
+        resampler = get_resampler(input_sample_rate, bundle.sample_rate, input_waveform.dtype)
+        resampled_waveform = resampler(input_waveform)
+        return compute_emissions(model, resampled_waveform, bundle.sample_rate, chunk_size_s, device)
+
+    emission = cached_emission(
+        cache_dir, audio_path, MMS_MODEL_ID, chunk_size_s, False, compute_emission, device
+    ).float()  # (1, frame_length, num_labels), float16 when cached
     num_frames = emission.size(1)
     assert len(DICTIONARY) == emission.shape[2]
 
@@ -85,44 +90,39 @@ def compute_probability_difference(audio_path: str, ground_truth: str,language:
 
 
 def compute_probability_difference_batched(
-    audio_paths: List[Path], ground_truths: List[str], language:str, batch_size: int = 16
+    audio_paths: List[Path],
+    ground_truths: List[str],
+    language: str,
+    batch_size: int = 16,
+    max_batch_seconds: float = 240.0,
+    num_workers: int = 4,
+    prefetch: int = 2,
 ) -> List[float]:
+    """Batched ``compute_probability_difference``, results are in the order of ``audio_paths``.
+
+    Segments are bucketed by duration so each padded batch holds at most
+    ``max_batch_seconds`` of audio (padding included) and ``batch_size`` segments.
+    Audio is decoded and resampled by ``num_workers`` background threads, at most
+    ``prefetch`` batches ahead of inference.
+    """
     # apply preprocessing
-   
+
     # verses = [preprocess_verse(v) for v in ground_truths]
 
-    verses = [preprocess_verse(v,language) for v in ground_truths]
+    verses = preprocess_verses(ground_truths, language)
     words = [verse.split() for verse in verses]
-    # batch transcripts
-    words_batches = [words[i : i + batch_size] for i in range(0, len(words), batch_size)]
-
-    # load audio
-    waveforms = [torchaudio.load(audio_path) for audio_path in audio_paths]
-
-    input_waveform, input_sample_rate = waveforms[0]
-    resampler = T.Resample(input_sample_rate, bundle.sample_rate, dtype=input_waveform.dtype)
-    resampled_waveforms = [resampler(waveform).squeeze() for (waveform, _) in waveforms]
-
-    # store waveform lengths for padding
-    waveform_lengths = [waveform.shape[0] for waveform in resampled_waveforms]
-    # batch waveforms and lengths
-    waveform_lengths_batches = [
-        torch.tensor(waveform_lengths[i : i + batch_size], dtype=torch.int64)
-        for i in range(0, len(waveform_lengths), batch_size)
-    ]
-    waveforms_batches = [
-        pad_sequence(
-            resampled_waveforms[i : i + batch_size], batch_first=True, padding_value=0
-        )  # (batch_size, max_batch_frame_length)
-        for i in range(0, len(resampled_waveforms), batch_size)
-    ]
-    assert len(waveforms_batches) == len(waveform_lengths_batches) == len(words_batches)
-
-    # collect per-batch probability differences
-    probability_diffs = []
-    for waveform_batch, waveform_lengths_batch, words_batch in tqdm(
-        zip(waveforms_batches, waveform_lengths_batches, words_batches), total=len(waveforms_batches)
-    ):
+
+    # bucket by resampled length, read from the file headers only
+    waveform_lengths = [audio_length(audio_path, bundle.sample_rate) for audio_path in audio_paths]
+    batches = make_length_batches(waveform_lengths, int(max_batch_seconds * bundle.sample_rate), batch_size)
+
+    # collect per-batch probability differences, scattered back to the input order
+    probability_diffs = [None] * len(audio_paths)
+    audio_batches = iter_audio_batches(audio_paths, batches, bundle.sample_rate, num_workers, prefetch)
+    for batch, waveform_batch, waveform_lengths_batch in tqdm(audio_batches, total=len(batches)):
+        # waveform_batch: (batch_size, max_batch_frame_length)
+        words_batch = [words[i] for i in batch]
+
         with torch.inference_mode():
             emission, lengths = model(
                 waveform_batch.to(device), waveform_lengths_batch.to(device)
@@ -130,35 +130,120 @@ def compute_probability_difference_batched(
 
         assert len(DICTIONARY) == emission.shape[2]
 
-        greedy_log_probs, aligned_log_probs = [], []
-
         # method proposed in §3.1.5 of MMS paper: https://arxiv.org/abs/2305.13516
         # \frac{1}{T} \log P(Y_{aligned} | X) - \log P(Y_{greedy} | X)
 
-        # compute greedy search score
-        for i, length in zip(range(len(waveform_batch)), lengths):
-            prob = torch.softmax(emission[i, :length, :].unsqueeze(dim=0), dim=-1)  # (1, frame_length, num_labels)
-            greedy_prob = torch.max(prob, dim=-1).values  # (1, frame_length)
-            greedy_log_prob = torch.sum(torch.log(greedy_prob), dim=-1).cpu().numpy().item()  # (1,)
-            greedy_log_probs.append(greedy_log_prob)
+        # compute greedy search score for the whole batch, masking the padded frames
+        frame_mask = torch.arange(emission.size(1), device=emission.device)[None, :] < lengths[:, None]
+        greedy_log_probs = torch.log_softmax(emission, dim=-1).max(dim=-1).values  # (batch_size, frame_length)
+        greedy_log_probs = (greedy_log_probs * frame_mask).sum(dim=-1)  # (batch_size,)
 
         # compute forced-alignment score
-        for i, length, words in zip(range(len(waveform_batch)), lengths, words_batch):
-            aligned_prob = compute_alignment_scores(
-                emission[i, :length, :].unsqueeze(dim=0), words, DICTIONARY, device
-            ).squeeze()  # (1, max_batch_frame_length)
-            aligned_log_prob = torch.sum(torch.log(aligned_prob), dim=-1).cpu().numpy().item()  # (1,)
-            aligned_log_probs.append(aligned_log_prob)
-
-        # compute length-normalized probability difference
-        probability_diff = (np.array(aligned_log_probs) - np.array(greedy_log_probs)) / lengths.cpu().numpy()
-        probability_diffs.append(probability_diff)
-
-    probability_diffs = np.concatenate(probability_diffs).tolist()
+        aligned_log_probs = compute_aligned_log_probs_batched(
+            emission, lengths, words_batch, DICTIONARY, device
+        )  # (batch_size,)
+
+        # compute length-normalized probability difference, one host sync per batch
+        probability_diff = ((aligned_log_probs - greedy_log_probs) / lengths).cpu().numpy()
+        for i, diff in zip(batch, probability_diff.tolist()):
+            probability_diffs[i] = diff
+
     return probability_diffs
 
 
+# modules whose changes invalidate probability differences
+FILTER_MODULES = ("filter_audio", "alignment_utils", "audio_loader", "text_utils", "norm_confg")
+
+
+@dataclass
+class FilterJob:
+    """A segment to filter and what its ledger entry says about it."""
+
+    key: str
+    audio_path: Path
+    transcript_path: Path
+    inputs: dict
+    score_fingerprint: str
+    fingerprint: str
+    # None if up to date, "threshold changed" if only the decision has to be redone
+    reason: Optional[str]
+    probability_difference: Optional[float] = None
+    duration: Optional[float] = None
+    retained: Optional[bool] = None
+
+
+def plan_filtering(
+    ledger: JobLedger,
+    audio_dir: Path,
+    pairs: List[Tuple[Path, Path]],
+    language: str,
+    chunk_size_s: int,
+    threshold: float,
+    mode: str,
+    precomputed: Optional[dict] = None,
+) -> List[FilterJob]:
+    """Compare every (audio, transcript) pair with its ledger entry.
+
+    The score of a segment depends on its audio, its transcript, the scoring code,
+    the language, the chunk size and whether it is taken from ``precomputed``
+    ({wav path: probability difference}) or computed by the model; the decision
+    additionally on the threshold and the materialize mode. A segment whose score is
+    still valid keeps it and is only decided again, the others are scored again.
+    """
+    precomputed = precomputed or {}
+    code = code_version(*FILTER_MODULES)
+    jobs = []
+    for audio_path, transcript_path in pairs:
+        key = segment_key(audio_dir, audio_path)
+        entry = ledger.get(key)
+        inputs = hash_inputs([audio_path, transcript_path], entry)
+        score_source = "precomputed" if audio_path in precomputed else "model"
+        score_fp = fingerprint(inputs, code, language=language, chunk_size_s=chunk_size_s, score_source=score_source)
+        decision_fp = fingerprint({}, score_fp, threshold=threshold, materialize=mode)
+        job = FilterJob(key, audio_path, transcript_path, inputs, score_fp, decision_fp, plan_reason(entry, decision_fp))
+        if job.reason is None:
+            job.retained = entry["retained"]
+        elif entry is not None and entry.get("score_fingerprint") == score_fp:
+            job.reason = "threshold changed"
+        if job.reason in (None, "threshold changed"):
+            job.probability_difference = entry["probability_difference"]
+            job.duration = entry.get("duration")
+        jobs.append(job)
+    return jobs
+
+
+def write_filter_scores(path, book: str, jobs: List[FilterJob]):
+    """Score table of every filtered segment of ``book``, read by ``refilter.py``."""
+    for job in jobs:
+        if job.duration is None:
+            # ledger entries written before durations were recorded
+            job.duration = audio_duration(job.audio_path)
+    write_score_table(
+        path,
+        book,
+        [job.key for job in jobs],
+        [job.audio_path.parent.name for job in jobs],
+        [job.probability_difference for job in jobs],
+        [job.duration for job in jobs],
+    )
+
+
+def write_filter_manifest(path, jobs: List[FilterJob]):
+    """Manifest of the retained segments, rewritten whole so that segments rejected
+    by a later threshold leave it and none is listed twice."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for job in jobs:
+            if job.retained:
+                f.write(manifest_line(job.audio_path, job.transcript_path, job.probability_difference) + "\n")
+    os.replace(tmp_path, path)
+
+
 if __name__ == "__main__":
     args = parser.parse_args()
-    probability_difference = compute_probability_difference(args.audio_path, args.ground_truth,args.language, args.chunk_size_s)
+    probability_difference = compute_probability_difference(
+        args.audio_path, args.ground_truth, args.language, args.chunk_size_s, args.cache_dir
+    )
     print(probability_difference)
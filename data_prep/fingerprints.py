@@ -0,0 +1,74 @@
+import hashlib
+import importlib.util
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+def file_sha1(path, block_size: int = 1 << 20) -> str:
+    """SHA-1 of a file's content, read in blocks so large chapters don't need to fit in memory."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def hash_inputs(paths: Iterable, previous: Optional[dict] = None) -> Dict[str, List]:
+    """``[size, mtime_ns, sha1]`` of every input file, by file name.
+
+    The SHA-1 stored in ``previous["inputs"]`` (a ledger entry) is reused when the
+    file's size and mtime didn't change, so checking an unchanged corpus only costs
+    one ``stat`` per file.
+    """
+    known = previous.get("inputs", {}) if previous else {}
+    inputs = {}
+    for path in paths:
+        path = Path(path)
+        stat = path.stat()
+        size_mtime = [stat.st_size, stat.st_mtime_ns]
+        entry = known.get(path.name)
+        if entry is not None and entry[:2] == size_mtime:
+            inputs[path.name] = entry
+        else:
+            inputs[path.name] = size_mtime + [file_sha1(path)]
+    return inputs
+
+
+@lru_cache(maxsize=None)
+def code_version(*modules: str) -> str:
+    """SHA-1 of the source files of ``modules``, the code a stage's outputs depend on."""
+    sha1 = hashlib.sha1()
+    for module in modules:
+        sha1.update(Path(importlib.util.find_spec(module).origin).read_bytes())
+    return sha1.hexdigest()
+
+
+def fingerprint(inputs: Dict[str, List], *parts, **params) -> str:
+    """Fingerprint of a work item: the content of its inputs, plus ``parts`` and ``params``.
+
+    Only the content hashes of ``inputs`` count, a file copied or touched without
+    being modified keeps its fingerprint. ``parts`` and ``params`` must be JSON
+    serializable (code versions, transcripts, parameters...).
+    """
+    digests = sorted((name, entry[2]) for name, entry in inputs.items())
+    payload = json.dumps([digests, parts, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def plan_reason(entry: Optional[dict], item_fingerprint: str) -> Optional[str]:
+    """Why an item has to run given its ledger entry, None if it is up to date."""
+    if entry is None:
+        return "new"
+    if entry.get("fingerprint") != item_fingerprint:
+        return "changed"
+    return None
+
+
+def print_plan(name: str, reasons: Dict[str, Optional[str]]):
+    """``--dry_run`` report: every item that would run and why, then a summary."""
+    pending = {key: reason for key, reason in reasons.items() if reason is not None}
+    for key, reason in pending.items():
+        print(f"  would run {key} ({reason})")
+    print(f"{name}: {len(pending)} to run, {len(reasons) - len(pending)} up to date")
@@ -1,12 +1,26 @@
 from pathlib import Path
 import argparse
-import shutil
 import csv
 from tqdm.auto import tqdm
-from datetime import datetime
 
-from filter_audio import compute_probability_difference, compute_probability_difference_batched
-from alignment_utils import write_book_stats
+from audio_loader import audio_duration
+from filter_audio import (
+    compute_probability_difference,
+    compute_probability_difference_batched,
+    plan_filtering,
+    write_filter_manifest,
+    write_filter_scores,
+)
+from alignment_utils import (
+    MANIFEST_FILE_NAME,
+    MATERIALIZE_MODES,
+    materialize,
+    write_book_stats,
+)
+from fingerprints import print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+from result_sink import ResultSink, timestamp
+from score_table import SCORE_TABLE_FILE_NAME
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -27,13 +41,44 @@ def parse_args():
     parser.add_argument(
         "--batched",
         action="store_true",
-        help="Whether to batch-filter. Currently still just on-par with non-batched filtering.",
+        help="Whether to batch-filter, with segments of similar duration batched together.",
     )
     parser.add_argument(
         "--batch_size",
         type=int,
         default=16,
-        help="Batch size for batch-filtering. Default to 16 (usable for P100 16GB).",
+        help="Maximum number of segments per batch for batch-filtering. Default to 16 (usable for P100 16GB).",
+    )
+    parser.add_argument(
+        "--max_batch_seconds",
+        type=float,
+        default=240.0,
+        help="Maximum padded audio duration per batch for batch-filtering, segments are bucketed by duration. Default: 240.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of audio decoding threads for batch-filtering. Default: 4.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of batches decoded ahead of inference for batch-filtering. Default: 2.",
+    )
+    parser.add_argument(
+        "--materialize",
+        choices=MATERIALIZE_MODES,
+        default="copy",
+        help="How retained segments are written: copied, hard-linked, symlinked, or only listed with their "
+        f"score in {MANIFEST_FILE_NAME}. Default: copy.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the segments that would be filtered: new ones, those whose audio, transcript, code or "
+        "parameters changed, and those only decided again because the threshold or materialize mode changed.",
     )
     return parser.parse_args()
 
@@ -51,110 +96,147 @@ def setup_logging(output_dir: Path):
             writer = csv.writer(f)
             writer.writerow(["filename", "folder", "probability_difference", "status"])
 
-    return log_f, csv_f
+    # kept open for the whole run, rows are appended in batches
+    return ResultSink(log_f), ResultSink(csv_f)
 
-def process_file(audio_path, transcript_path, probability_difference, threshold, output_dir, base_dir_name, log_f, csv_f):
+def process_file(
+    audio_path, transcript_path, probability_difference, threshold, output_dir, base_dir_name, log_f, csv_f,
+    mode="copy",
+):
     folder = audio_path.parent.name
     chapter = audio_path.parent.stem
 
-    output_path = output_dir / base_dir_name / chapter
-    output_path.mkdir(parents=True, exist_ok=True)
-
     status = "Retained" if probability_difference > threshold else "Rejected"
 
     if status == "Retained":
-        shutil.copy(audio_path, output_path / audio_path.name)
-        shutil.copy(transcript_path, output_path / transcript_path.name)
+        # in manifest mode only listed, by the manifest written at the end of the run
+        if mode != "manifest":
+            output_path = output_dir / base_dir_name / chapter
+            output_path.mkdir(parents=True, exist_ok=True)
+            materialize(audio_path, output_path / audio_path.name, mode)
+            materialize(transcript_path, output_path / transcript_path.name, mode)
     else:
-        with open(log_f, "a") as log_file:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            log_file.write(f"[{timestamp}] Rejected: {audio_path} (Difference: {probability_difference})\n")
+        # retained by a previous run with another threshold
+        output_path = output_dir / base_dir_name / chapter
+        for path in (audio_path, transcript_path):
+            (output_path / path.name).unlink(missing_ok=True)
+        log_f.write_line(f"[{timestamp()}] Rejected: {audio_path} (Difference: {probability_difference})")
 
-    with open(csv_f, "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([audio_path.name, folder, f"{probability_difference:.4f}", status])
+    csv_f.write_row([audio_path.name, folder, f"{probability_difference:.4f}", status])
 
     return status == "Retained"
 
 def main(args):
     audio_dir = Path(args.audio_dir)
     output_dir = Path(args.output_dir)
-    log_f, csv_f = setup_logging(output_dir)
-    
-    audios = sorted(audio_dir.rglob("**/*.wav"))
     base_dir_name = audio_dir.stem
 
-    # skipping if already filtered
-    if output_dir.exists() and any(output_dir.iterdir()):
+    pairs = []
+    for audio_path in sorted(audio_dir.rglob("**/*.wav")):
+        transcript_path = audio_path.with_suffix(".txt")
+        if not transcript_path.exists():
+            print(f"Transcript not found for: {audio_path}")
+            continue
+        pairs.append((audio_path, transcript_path))
+
+    # per-segment progress, an interrupted run resumes at the first unfiltered segment
+    # and only segments whose inputs, code or parameters changed are filtered again
+    ledger = JobLedger(output_dir / LEDGER_FILE_NAME)
+    jobs = plan_filtering(
+        ledger, audio_dir, pairs, args.language, args.chunk_size_s, args.probability_difference_threshold, args.materialize
+    )
+    if args.dry_run:
+        print_plan(base_dir_name, {job.key: job.reason for job in jobs})
+        return
+    # every segment's score and duration, to try other thresholds with refilter.py
+    score_table_path = output_dir / SCORE_TABLE_FILE_NAME
+    # retained segments are only listed, rewritten from every segment's decision like the score table
+    manifest_path = output_dir / MANIFEST_FILE_NAME if args.materialize == "manifest" else None
+    if all(job.reason is None for job in jobs):
         print(f"Skipping {base_dir_name}")
+        if not score_table_path.exists():
+            write_filter_scores(score_table_path, base_dir_name, jobs)
+        if manifest_path is not None:
+            write_filter_manifest(manifest_path, jobs)
         return
 
+    log_f, csv_f = setup_logging(output_dir)
+
+    if args.batched:
+        # segments without a valid score are scored up front, in batches
+        to_score = [job for job in jobs if job.reason is not None and job.probability_difference is None]
+        if to_score:
+            ground_truths = []
+            for job in to_score:
+                with open(job.transcript_path) as f:
+                    ground_truths.append(f.read())
+            prob_diffs = compute_probability_difference_batched(
+                [job.audio_path for job in to_score],
+                ground_truths,
+                args.language,
+                args.batch_size,
+                args.max_batch_seconds,
+                args.num_workers,
+                args.prefetch,
+            )
+            for job, prob_diff in zip(to_score, prob_diffs):
+                job.probability_difference = prob_diff
+
     current_folder = None
     retained_count = 0
     rejected_count = 0
 
-    if not args.batched:
-        for audio_path in tqdm(audios, desc=f"Filtering {base_dir_name}"):
-            transcript_path = audio_path.with_suffix(".txt")
-            if not transcript_path.exists():
-                print(f"Transcript not found for: {audio_path}")
-                continue
-
-            folder = audio_path.parent.name
-            if current_folder != folder:
-                if current_folder is not None:
-                    write_book_stats(current_folder, retained_count, rejected_count, csv_f)
-                current_folder = folder
-                retained_count = 0
-                rejected_count = 0
-
-            with open(transcript_path) as f:
-                ground_truth = f.read()
-
-            prob_diff = compute_probability_difference(audio_path, ground_truth, args.language, args.chunk_size_s)
-
-            if process_file(audio_path, transcript_path, prob_diff, args.probability_difference_threshold, output_dir, base_dir_name, log_f, csv_f):
-                retained_count += 1
-            else:
-                rejected_count += 1
-
-        if current_folder is not None:
-            write_book_stats(current_folder, retained_count, rejected_count, csv_f)
-
-    else:
-        transcript_paths = [a.with_suffix(".txt") for a in audios]
-        ground_truths = []
-        valid_pairs = []
-
-        for audio, transcript in zip(audios, transcript_paths):
-            if transcript.exists():
-                with open(transcript) as f:
-                    ground_truths.append(f.read())
-                valid_pairs.append((audio, transcript))
-            else:
-                print(f"Transcript not found for: {audio}")
-
-        valid_audios = [pair[0] for pair in valid_pairs]
-        valid_transcripts = [pair[1] for pair in valid_pairs]
-
-        prob_diffs = compute_probability_difference_batched(valid_audios, ground_truths, args.language, args.batch_size)
-
-        for audio_path, transcript_path, prob_diff in zip(valid_audios, valid_transcripts, prob_diffs):
-            folder = audio_path.parent.name
-            if current_folder != folder:
-                if current_folder is not None:
-                    write_book_stats(current_folder, retained_count, rejected_count, csv_f)
-                current_folder = folder
-                retained_count = 0
-                rejected_count = 0
-
-            if process_file(audio_path, transcript_path, prob_diff, args.probability_difference_threshold, output_dir, base_dir_name, log_f, csv_f):
-                retained_count += 1
-            else:
-                rejected_count += 1
-
-        if current_folder is not None:
-            write_book_stats(current_folder, retained_count, rejected_count, csv_f)
+    for job in tqdm(jobs, desc=f"Filtering {base_dir_name}"):
+        folder = job.audio_path.parent.name
+        if current_folder != folder:
+            if current_folder is not None:
+                write_book_stats(current_folder, retained_count, rejected_count, csv_f)
+            current_folder = folder
+            retained_count = 0
+            rejected_count = 0
+
+        if job.reason is None:
+            # filtered with the same inputs and parameters before, only counted
+            retained = job.retained
+        else:
+            prob_diff = job.probability_difference
+            if prob_diff is None:
+                with open(job.transcript_path) as f:
+                    ground_truth = f.read()
+                prob_diff = compute_probability_difference(job.audio_path, ground_truth, args.language, args.chunk_size_s)
+
+            retained = process_file(
+                job.audio_path, job.transcript_path, prob_diff, args.probability_difference_threshold, output_dir,
+                base_dir_name, log_f, csv_f, args.materialize,
+            )
+            job.retained = retained
+            job.probability_difference = prob_diff
+            if job.duration is None:
+                job.duration = audio_duration(job.audio_path)
+            ledger.mark_done(
+                job.key,
+                inputs=job.inputs,
+                fingerprint=job.fingerprint,
+                score_fingerprint=job.score_fingerprint,
+                retained=retained,
+                probability_difference=prob_diff,
+                duration=job.duration,
+            )
+
+        if retained:
+            retained_count += 1
+        else:
+            rejected_count += 1
+
+    if current_folder is not None:
+        write_book_stats(current_folder, retained_count, rejected_count, csv_f)
+
+    write_filter_scores(score_table_path, base_dir_name, jobs)
+    if manifest_path is not None:
+        write_filter_manifest(manifest_path, jobs)
+    ledger.close()
+    log_f.close()
+    csv_f.close()
 
 if __name__ == "__main__":
     args = parse_args()
@@ -0,0 +1,262 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Sequence
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+
+import torch
+import torchaudio
+from tqdm.auto import tqdm
+
+from alignment_utils import denoise_waveform, load_denoiser
+from audio_loader import decode_audio, get_resampler
+from fingerprints import code_version, fingerprint, plan_reason, print_plan
+from job_ledger import JobLedger
+from segment_audio import chapter_fingerprint, segment_waveform
+
+# intermediate full-length audio that can be kept, nothing is written otherwise
+ARTIFACTS = ("converted", "denoised")
+
+# next to the ledger of segment_audio.py in the book directory: the same chapters are
+# keyed on another fingerprint, sharing one file would redo them on every switch
+INGEST_LEDGER_FILE_NAME = ".ingest.ledger.jsonl"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Decode, downmix, optionally denoise, resample and segment every chapter of a book in one pass, "
+        "without writing the intermediate wav files of convert_audio.py and denoising.py."
+    )
+    parser.add_argument("--json_path", required=True, help="Path to the JSON file. Example: data/openbible_swahili/PSA.json")
+    parser.add_argument(
+        "--audio_dir", required=True, help="Directory of the original chapter audio (mp3, ogg, flac, wav...). Example: downloads/PSA/"
+    )
+    parser.add_argument("--output_dir", default="outputs/openbible_swahili/", help="Path to the output directory")
+    parser.add_argument("--language", required=True, type=str, help="Language in ISO 639-3 code.")
+    parser.add_argument("--extension", default="mp3", help="Extension of the chapter audio files. Default: mp3.")
+    parser.add_argument("--sample_rate", type=int, default=16000, help="Sample rate of the written segments. Default: 16000.")
+    parser.add_argument("--denoise", action="store_true", help="Denoise every chapter before segmenting it.")
+    parser.add_argument(
+        "--keep",
+        nargs="*",
+        choices=ARTIFACTS,
+        default=[],
+        help="Intermediate chapter audio to also write under --artifacts_dir/<artifact>/<book>/, as 16-bit wav.",
+    )
+    parser.add_argument("--artifacts_dir", default=None, help="Directory of the kept intermediate audio.")
+    parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+    parser.add_argument(
+        "--context_size_s",
+        type=float,
+        default=1.0,
+        help="Audio added on both sides of every chunk and dropped from its emissions, in seconds.",
+    )
+    parser.add_argument("--emission_batch_size", type=int, default=4, help="Number of chunks run through the model at once.")
+    parser.add_argument("--cache_dir", default=None, help="Directory of the parsed book transcripts. Disabled if not set.")
+    parser.add_argument(
+        "--score",
+        action="store_true",
+        help="Also compute each verse's MMS probability difference from the chapter alignment and write it to scores.csv.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of chapters ingested in parallel, each worker process loads its own models.",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="torch threads of each worker. Default: CPU count divided by --workers.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the chapters that would be ingested: new ones, and those whose audio, verses, "
+        "code or parameters changed since they were ingested.",
+    )
+    args = parser.parse_args()
+    if args.keep and args.artifacts_dir is None:
+        parser.error("--keep requires --artifacts_dir")
+    if "denoised" in args.keep and not args.denoise:
+        parser.error("--keep denoised requires --denoise")
+    return args
+
+
+def ingest_fingerprint(
+    audio_path,
+    json_path,
+    language: str,
+    sample_rate: int,
+    denoise: bool,
+    keep: Sequence[str],
+    chunk_size_s: int,
+    context_size_s: float,
+    score: bool,
+    index_dir,
+    previous: dict = None,
+):
+    """``segment_audio.chapter_fingerprint`` of the original audio, plus the ingest parameters."""
+    inputs, segment_fp = chapter_fingerprint(
+        audio_path, json_path, language, chunk_size_s, context_size_s, score, "wav", index_dir, previous
+    )
+    return inputs, fingerprint(
+        {},
+        segment_fp,
+        code_version("ingest", "audio_loader"),
+        sample_rate=sample_rate,
+        denoise=denoise,
+        keep=sorted(keep),
+    )
+
+
+def save_artifact(artifacts_dir, artifact: str, book: str, chapter: str, waveform: torch.Tensor, sample_rate: int):
+    path = Path(artifacts_dir) / artifact / book / f"{chapter}.wav"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torchaudio.save(str(path), waveform, sample_rate, encoding="PCM_S", bits_per_sample=16)
+
+
+def ingest_chapter(
+    audio_path,
+    json_path,
+    output_dir,
+    language: str,
+    sample_rate: int = 16000,
+    denoise: bool = False,
+    keep: Sequence[str] = (),
+    artifacts_dir=None,
+    chunk_size_s: int = 15,
+    cache_dir=None,
+    score: bool = False,
+    context_size_s: float = 1.0,
+    emission_batch_size: int = 4,
+) -> List[str]:
+    """Segment one original chapter file, every transform applied in memory.
+
+    The chapter is decoded once, downmixed and resampled while decoding (to the
+    denoiser's rate if ``denoise``), denoised, resampled to ``sample_rate`` and
+    segmented, and only the verse segments (and the ``keep`` artifacts) are
+    written. Chapters are recorded in the book's ``INGEST_LEDGER_FILE_NAME``.
+
+    Returns:
+        The warnings raised while ingesting the chapter.
+    """
+    audio_path = Path(audio_path)
+    json_path = Path(json_path)
+    book, chapter = json_path.stem, audio_path.stem
+    index_dir = Path(cache_dir) / "transcripts" if cache_dir is not None else None
+
+    ledger = JobLedger(Path(output_dir) / book / INGEST_LEDGER_FILE_NAME)
+    inputs, chapter_fp = ingest_fingerprint(
+        audio_path, json_path, language, sample_rate, denoise, keep, chunk_size_s, context_size_s, score, index_dir,
+        ledger.get(chapter),
+    )
+    if ledger.is_done(chapter, chapter_fp):
+        return [f"Skipping {chapter}"]
+
+    chapter_dir = Path(output_dir) / book / chapter
+    if chapter_dir.exists():
+        shutil.rmtree(chapter_dir)
+    chapter_dir.mkdir(parents=True, exist_ok=True)
+
+    # decode -> downmix -> resample, inside ffmpeg
+    decode_rate = load_denoiser().sample_rate if denoise else sample_rate
+    waveform, waveform_rate = decode_audio(audio_path, decode_rate)
+    if "converted" in keep:
+        save_artifact(artifacts_dir, "converted", book, chapter, waveform, waveform_rate)
+
+    if denoise:
+        waveform, waveform_rate = denoise_waveform(waveform, waveform_rate)
+        if waveform_rate != sample_rate:
+            waveform = get_resampler(waveform_rate, sample_rate, waveform.dtype)(waveform)
+            waveform_rate = sample_rate
+        if "denoised" in keep:
+            save_artifact(artifacts_dir, "denoised", book, chapter, waveform, waveform_rate)
+
+    messages, _, num_segments = segment_waveform(
+        waveform,
+        waveform_rate,
+        json_path,
+        chapter,
+        chapter_dir,
+        language,
+        chunk_size_s,
+        cache_dir,
+        score,
+        context_size_s,
+        emission_batch_size,
+    )
+
+    ledger.mark_done(chapter, inputs=inputs, fingerprint=chapter_fp, segments=num_segments)
+    ledger.close()
+    return messages
+
+
+def _init_worker(num_threads: int):
+    # the MMS_FA model is loaded once per worker, when segment_audio is imported
+    torch.set_num_threads(num_threads)
+
+
+def main(args):
+    audio_dir = Path(args.audio_dir)
+    audios = sorted(audio_dir.rglob(f"*.{args.extension}"))
+    chapter_args = (
+        args.json_path,
+        args.output_dir,
+        args.language,
+        args.sample_rate,
+        args.denoise,
+        tuple(args.keep),
+        args.artifacts_dir,
+        args.chunk_size_s,
+        args.cache_dir,
+        args.score,
+        args.context_size_s,
+        args.emission_batch_size,
+    )
+
+    if args.dry_run:
+        ledger = JobLedger(Path(args.output_dir) / Path(args.json_path).stem / INGEST_LEDGER_FILE_NAME)
+        index_dir = Path(args.cache_dir) / "transcripts" if args.cache_dir is not None else None
+        reasons = {}
+        for audio_path in audios:
+            entry = ledger.get(audio_path.stem)
+            _, chapter_fp = ingest_fingerprint(
+                audio_path, args.json_path, args.language, args.sample_rate, args.denoise, args.keep,
+                args.chunk_size_s, args.context_size_s, args.score, index_dir, entry,
+            )
+            reasons[audio_path.stem] = plan_reason(entry, chapter_fp)
+        print_plan(audio_dir.stem, reasons)
+        return
+
+    if args.workers <= 1:
+        for audio_path in tqdm(audios, desc=f"Ingesting {audio_dir.stem}"):
+            for message in ingest_chapter(audio_path, *chapter_args):
+                tqdm.write(message)
+        return
+
+    num_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        futures = {executor.submit(ingest_chapter, audio_path, *chapter_args): audio_path for audio_path in audios}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Ingesting {audio_dir.stem}"):
+            try:
+                messages = future.result()
+            except Exception as e:
+                # one failing chapter shouldn't stop the other workers
+                tqdm.write(f"[Error] {futures[future].stem}: {e}")
+                continue
+            for message in messages:
+                tqdm.write(message)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from result_sink import ResultSink, timestamp
+
+# written inside the output directory it describes
+LEDGER_FILE_NAME = ".ledger.jsonl"
+
+
+class JobLedger:
+    """Append-only JSONL record of finished work items (chapters, segments, books).
+
+    An item is only recorded once its outputs are fully written, so after a crash the
+    ledger, not the presence of files, tells which items are complete: a rerun skips
+    exactly those and redoes the rest. The file is replayed on start, later lines win,
+    and a line cut short by a crash is ignored. Entries are written every
+    ``flush_every`` items, at worst the last unflushed items are computed again.
+    The ``flush_first`` sinks (e.g. a manifest listing the items) are flushed before
+    the ledger, so it never records an item whose output is still in a buffer.
+    An entry recorded with a ``fingerprint`` (see ``fingerprints.py``) only counts
+    as done while the item's inputs, code and parameters still give that fingerprint.
+    """
+
+    def __init__(self, path, flush_every: int = 64, flush_first: Iterable[ResultSink] = ()):
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self.flush_first = [sink for sink in flush_first if sink is not None]
+        self.entries: Dict[str, dict] = {}
+        self._sink = None
+        self._unflushed = 0
+        # a line cut short by a crash must not swallow the next entry
+        self._terminate_line = False
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self._terminate_line = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["key"]] = entry
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def is_done(self, key: str, fingerprint: Optional[str] = None) -> bool:
+        """Whether ``key`` is recorded, and if ``fingerprint`` is given, recorded with it."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        return fingerprint is None or entry.get("fingerprint") == fingerprint
+
+    def mark_done(self, key: str, **info):
+        entry = {"key": key, "time": timestamp(), **info}
+        self.entries[key] = entry
+        if self._sink is None:
+            # created on the first write, reading a ledger never creates it
+            self._sink = ResultSink(self.path, flush_every=0)
+        line = json.dumps(entry, ensure_ascii=False)
+        if self._terminate_line:
+            line = "\n" + line
+            self._terminate_line = False
+        self._sink.write_line(line)
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for sink in self.flush_first:
+            sink.flush()
+        if self._sink is not None:
+            self._sink.flush()
+        self._unflushed = 0
+
+    def close(self):
+        self.flush()
+        if self._sink is not None:
+            self._sink.close()
+
+
+def segment_key(audio_dir: Path, audio_path: Path) -> str:
+    """Ledger key of a segment, stable wherever the corpus is mounted."""
+    return Path(audio_path).relative_to(audio_dir).as_posix()
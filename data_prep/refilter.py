@@ -0,0 +1,115 @@
+from pathlib import Path
+import argparse
+import csv
+
+import numpy as np
+
+from score_table import SCORE_TABLE_FILE_NAME, load_score_tables, retention_curves
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Try filtering thresholds on the scores stored by run_filter.py/generic_filter.py, without the model."
+    )
+    parser.add_argument(
+        "--scores_dir",
+        required=True,
+        help=f"Filtering output directory, searched recursively for {SCORE_TABLE_FILE_NAME} tables. Example: outputs/filtered/",
+    )
+    parser.add_argument("--output_dir", required=True, help="Directory to write retention.csv and the retained/rejected lists.")
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[-0.1, -0.2, -0.3],
+        help="Probability difference thresholds to evaluate. Default: -0.1 -0.2 -0.3.",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=float,
+        nargs=3,
+        metavar=("START", "STOP", "STEP"),
+        default=None,
+        help="Evaluate every threshold from START to STOP (included) by STEP instead of --thresholds, e.g. -1 0 0.01.",
+    )
+    parser.add_argument(
+        "--group_by",
+        choices=("book", "chapter"),
+        default="book",
+        help="Retention is reported per book or per chapter. Default: book.",
+    )
+    parser.add_argument(
+        "--write_sets",
+        action="store_true",
+        help="Also write retained_<threshold>.txt and rejected_<threshold>.txt, one <book>/<segment> per line.",
+    )
+    return parser.parse_args()
+
+
+def sweep_thresholds(start: float, stop: float, step: float) -> np.ndarray:
+    num_steps = int(round((stop - start) / step))
+    return np.round(start + step * np.arange(num_steps + 1), 6)
+
+
+def write_retention(path: Path, thresholds, curves):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["group", "threshold", "retained", "total", "retention", "retained_duration", "total_duration", "duration_retention"]
+        )
+        for group, curve in curves.items():
+            retention = curve["retained"] / max(curve["total"], 1)
+            duration_retention = curve["retained_duration"] / max(curve["total_duration"], 1e-9)
+            for i, threshold in enumerate(thresholds):
+                writer.writerow(
+                    [
+                        group,
+                        f"{threshold:g}",
+                        int(curve["retained"][i]),
+                        curve["total"],
+                        f"{retention[i]:.4f}",
+                        f"{curve['retained_duration'][i]:.1f}",
+                        f"{curve['total_duration']:.1f}",
+                        f"{duration_retention[i]:.4f}",
+                    ]
+                )
+
+
+def write_sets(output_dir: Path, thresholds, table):
+    names = np.char.add(np.char.add(table["book"].astype(str), "/"), table["key"])
+    for threshold in thresholds:
+        retained = table["probability_difference"] > threshold
+        for status, mask in (("retained", retained), ("rejected", ~retained)):
+            with open(output_dir / f"{status}_{threshold:g}.txt", "w") as f:
+                f.writelines(name + "\n" for name in names[mask].tolist())
+
+
+def main(args):
+    scores_dir = Path(args.scores_dir)
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    table = load_score_tables(sorted(scores_dir.rglob(SCORE_TABLE_FILE_NAME)))
+    thresholds = sweep_thresholds(*args.sweep) if args.sweep else np.asarray(args.thresholds)
+
+    groups = table["book"] if args.group_by == "book" else np.char.add(
+        np.char.add(table["book"].astype(str), "/"), table["chapter"]
+    )
+    curves = retention_curves(groups, table["probability_difference"], table["duration"], thresholds)
+    write_retention(output_dir / "retention.csv", thresholds, curves)
+    if args.write_sets:
+        write_sets(output_dir, thresholds, table)
+
+    overall = curves["ALL"]
+    print(f"{overall['total']} segments, {overall['total_duration'] / 3600:.1f} h")
+    for i, threshold in enumerate(thresholds):
+        print(
+            f"  threshold {threshold:g}: {overall['retained'][i]} retained "
+            f"({overall['retained_duration'][i] / 3600:.1f} h, "
+            f"{overall['retained_duration'][i] / max(overall['total_duration'], 1e-9):.1%} of the audio)"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,80 @@
+import atexit
+import csv
+import io
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable
+
+
+class ResultSink:
+    """Append-only text/CSV output kept open for the whole run and written in batches.
+
+    Lines are buffered in memory and appended with a single ``os.write`` on an
+    ``O_APPEND`` descriptor every ``flush_every`` lines (never if 0), on :meth:`flush`
+    and when the interpreter exits, including after an uncaught exception. A lock makes it safe to
+    share between threads, and since each batch is one append of whole lines, several
+    processes can append to the same local file without interleaving partial rows.
+    """
+
+    def __init__(self, path, flush_every: int = 256):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_every = flush_every
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._lines = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write_line(self, line: str):
+        with self._lock:
+            self._lines.append(line if line.endswith("\n") else line + "\n")
+            if self.flush_every and len(self._lines) >= self.flush_every:
+                self._flush()
+
+    def write_row(self, row: Iterable):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        # same "\r\n"-terminated rows as csv.writer on a file opened with newline=""
+        self.write_line(buffer.getvalue())
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._lines and self._fd is not None:
+            data = "".join(self._lines).encode("utf-8")
+            while data:
+                data = data[os.write(self._fd, data) :]
+            self._lines = []
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            self._flush()
+            os.close(self._fd)
+            self._fd = None
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_timestamp_second = None
+_timestamp = ""
+
+
+def timestamp() -> str:
+    """``datetime.now()`` formatted as in the logs, formatted at most once per second."""
+    global _timestamp_second, _timestamp
+    second = int(time.time())
+    if second != _timestamp_second:
+        _timestamp_second, _timestamp = second, datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+    return _timestamp
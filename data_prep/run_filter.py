@@ -1,12 +1,27 @@
 from pathlib import Path
 import argparse
-import shutil
 import csv
 from tqdm.auto import tqdm
-from datetime import datetime
 
-from filter_audio import compute_probability_difference, compute_probability_difference_batched
-from alignment_utils import write_book_stats
+from audio_loader import audio_duration
+from filter_audio import (
+    compute_probability_difference,
+    compute_probability_difference_batched,
+    plan_filtering,
+    write_filter_manifest,
+    write_filter_scores,
+)
+from alignment_utils import (
+    MANIFEST_FILE_NAME,
+    MATERIALIZE_MODES,
+    load_precomputed_scores,
+    materialize,
+    write_book_stats,
+)
+from fingerprints import print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+from result_sink import ResultSink, timestamp
+from score_table import SCORE_TABLE_FILE_NAME
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,22 +34,65 @@ def parse_args():
     parser.add_argument("--log_dir", help="Directory for storing log_file.txt and history.csv. Defaults to output_dir.")
     parser.add_argument("--language", required=True, type=str, help="Language in ISO 639-3 code.")
     parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Directory of the emission cache, reused when the same segments are filtered again (e.g. with another "
+        "threshold), used by non-batched filtering. Disabled if not set.",
+    )
     parser.add_argument(
         "--probability_difference_threshold",
         type=float,
         default=-0.2,
         help="Probability difference threshold for filtering. Default: -0.2 from MMS.",
     )
+    parser.add_argument(
+        "--precomputed_scores",
+        action="store_true",
+        help="Use the scores.csv written by `run_segmentation.py --score` instead of running the model. "
+        "Segments without a precomputed score are still scored by the model.",
+    )
     parser.add_argument(
         "--batched",
         action="store_true",
-        help="Whether to batch-filter. Currently still just on-par with non-batched filtering.",
+        help="Whether to batch-filter, with segments of similar duration batched together.",
     )
     parser.add_argument(
         "--batch_size",
         type=int,
         default=16,
-        help="Batch size for batch-filtering. Default to 16 (usable for P100 16GB).",
+        help="Maximum number of segments per batch for batch-filtering. Default to 16 (usable for P100 16GB).",
+    )
+    parser.add_argument(
+        "--max_batch_seconds",
+        type=float,
+        default=240.0,
+        help="Maximum padded audio duration per batch for batch-filtering, segments are bucketed by duration. Default: 240.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of audio decoding threads for batch-filtering. Default: 4.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of batches decoded ahead of inference for batch-filtering. Default: 2.",
+    )
+    parser.add_argument(
+        "--materialize",
+        choices=MATERIALIZE_MODES,
+        default="copy",
+        help="How retained segments are written: copied, hard-linked, symlinked, or only listed with their "
+        f"score in {MANIFEST_FILE_NAME}. Default: copy.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the segments that would be filtered: new ones, those whose audio, transcript, code or "
+        "parameters changed, and those only decided again because the threshold or materialize mode changed.",
     )
     return parser.parse_args()
 
@@ -52,22 +110,29 @@ def setup_logging(log_dir: Path):
             writer = csv.writer(f)
             writer.writerow(["Book", "Retained", "Rejected"])
 
-    return log_f, history_f
+    # kept open for the whole run, rows are appended in batches
+    return ResultSink(log_f), ResultSink(history_f)
 
-def process_file(audio_path, transcript_path, probability_difference, threshold, output_dir, base_dir_name, log_f):
+def process_file(
+    audio_path, transcript_path, probability_difference, threshold, output_dir, base_dir_name, log_f,
+    mode="copy",
+):
     chapter = audio_path.parent.stem
 
-    output_path = output_dir / chapter
-    output_path.mkdir(parents=True, exist_ok=True)
-
     if probability_difference > threshold:
-        shutil.copy(audio_path, output_path / audio_path.name)
-        shutil.copy(transcript_path, output_path / transcript_path.name)
+        if mode == "manifest":
+            # listed in the manifest written at the end of the run
+            return True
+        output_path = output_dir / chapter
+        output_path.mkdir(parents=True, exist_ok=True)
+        materialize(audio_path, output_path / audio_path.name, mode)
+        materialize(transcript_path, output_path / transcript_path.name, mode)
         return True
     else:
-        with open(log_f, "a") as log_file:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            log_file.write(f"[{timestamp}] Rejected: {audio_path} (Difference: {probability_difference})\n")
+        # retained by a previous run with another threshold
+        for path in (audio_path, transcript_path):
+            (output_dir / chapter / path.name).unlink(missing_ok=True)
+        log_f.write_line(f"[{timestamp()}] Rejected: {audio_path} (Difference: {probability_difference})")
         return False
 
 def main(args):
@@ -75,88 +140,127 @@ def main(args):
     output_dir = Path(args.output_dir)
     log_dir = Path(args.log_dir) if args.log_dir else output_dir
 
-    log_f, history_f = setup_logging(log_dir)
-
     base_dir_name = audio_dir.stem
     output_subdir = output_dir / base_dir_name
 
-    # skipping if already filtered for this book
-    if output_subdir.exists() and any(output_subdir.iterdir()):
+    pairs = []
+    for audio_path in sorted(audio_dir.rglob("**/*.wav")):
+        transcript_path = audio_path.with_suffix(".txt")
+        if not transcript_path.exists():
+            print(f"Transcript not found for: {audio_path}")
+            continue
+        pairs.append((audio_path, transcript_path))
+
+    # per-segment progress, an interrupted book resumes at the first unfiltered segment
+    # and only segments whose inputs, code or parameters changed are filtered again
+    ledger = JobLedger(output_subdir / LEDGER_FILE_NAME)
+    precomputed = load_precomputed_scores(audio_dir) if args.precomputed_scores else {}
+    jobs = plan_filtering(
+        ledger,
+        audio_dir,
+        pairs,
+        args.language,
+        args.chunk_size_s,
+        args.probability_difference_threshold,
+        args.materialize,
+        precomputed,
+    )
+    if args.dry_run:
+        print_plan(base_dir_name, {job.key: job.reason for job in jobs})
+        return
+    # every segment's score and duration, to try other thresholds with refilter.py
+    score_table_path = output_subdir / SCORE_TABLE_FILE_NAME
+    # retained segments are only listed, rewritten from every segment's decision like the score table
+    manifest_path = output_subdir / MANIFEST_FILE_NAME if args.materialize == "manifest" else None
+    if all(job.reason is None for job in jobs):
         print(f"Skipping {base_dir_name}")
+        if not score_table_path.exists():
+            write_filter_scores(score_table_path, base_dir_name, jobs)
+        if manifest_path is not None:
+            write_filter_manifest(manifest_path, jobs)
         return
 
-    audios = sorted(audio_dir.rglob("**/*.wav"))
+    log_f, history_f = setup_logging(log_dir)
+
+    if args.batched and not args.precomputed_scores:
+        # segments without a valid score are scored up front, in batches
+        to_score = [job for job in jobs if job.reason is not None and job.probability_difference is None]
+        if to_score:
+            ground_truths = []
+            for job in to_score:
+                with open(job.transcript_path) as f:
+                    ground_truths.append(f.read())
+            prob_diffs = compute_probability_difference_batched(
+                [job.audio_path for job in to_score],
+                ground_truths,
+                args.language,
+                args.batch_size,
+                args.max_batch_seconds,
+                args.num_workers,
+                args.prefetch,
+            )
+            for job, prob_diff in zip(to_score, prob_diffs):
+                job.probability_difference = prob_diff
 
     current_book = None
     retained_count = 0
     rejected_count = 0
 
-    if not args.batched:
-        for audio_path in tqdm(audios, desc=f"Filtering {base_dir_name}"):
-            transcript_path = audio_path.with_suffix(".txt")
-            if not transcript_path.exists():
-                print(f"Transcript not found for: {audio_path}")
-                continue
+    for job in tqdm(jobs, desc=f"Filtering {base_dir_name}"):
+        book_name = job.audio_path.parent.parent.stem
+        if current_book != book_name:
+            if current_book is not None:
+                write_book_stats(current_book, retained_count, rejected_count, history_f)
+            current_book = book_name
+            retained_count = 0
+            rejected_count = 0
 
-            book_name = audio_path.parent.parent.stem
-            if current_book != book_name:
-                if current_book is not None:
-                    write_book_stats(current_book, retained_count, rejected_count, history_f)
-                current_book = book_name
-                retained_count = 0
-                rejected_count = 0
+        if job.reason is None:
+            # filtered with the same inputs and parameters before, only counted
+            retained = job.retained
+        else:
+            prob_diff = job.probability_difference
+            if prob_diff is None and job.audio_path in precomputed:
+                prob_diff = precomputed[job.audio_path]
+            elif prob_diff is None:
+                with open(job.transcript_path) as f:
+                    ground_truth = f.read()
+                prob_diff = compute_probability_difference(
+                    job.audio_path, ground_truth, args.language, args.chunk_size_s, args.cache_dir
+                )
 
-            with open(transcript_path) as f:
-                ground_truth = f.read()
+            retained = process_file(
+                job.audio_path, job.transcript_path, prob_diff, args.probability_difference_threshold, output_subdir,
+                base_dir_name, log_f, args.materialize,
+            )
+            job.retained = retained
+            job.probability_difference = prob_diff
+            if job.duration is None:
+                job.duration = audio_duration(job.audio_path)
+            ledger.mark_done(
+                job.key,
+                inputs=job.inputs,
+                fingerprint=job.fingerprint,
+                score_fingerprint=job.score_fingerprint,
+                retained=retained,
+                probability_difference=prob_diff,
+                duration=job.duration,
+            )
 
-            prob_diff = compute_probability_difference(audio_path, ground_truth, args.language, args.chunk_size_s)
+        if retained:
+            retained_count += 1
+        else:
+            rejected_count += 1
 
-            if process_file(audio_path, transcript_path, prob_diff, args.probability_difference_threshold, output_subdir, base_dir_name, log_f):
-                retained_count += 1
-            else:
-                rejected_count += 1
+    if current_book is not None:
+        write_book_stats(current_book, retained_count, rejected_count, history_f)
 
-        if current_book is not None:
-            write_book_stats(current_book, retained_count, rejected_count, history_f)
-
-    else:
-        transcript_paths = [a.with_suffix(".txt") for a in audios]
-        ground_truths = []
-        valid_pairs = []
-
-        for audio, transcript in zip(audios, transcript_paths):
-            if transcript.exists():
-                with open(transcript) as f:
-                    ground_truths.append(f.read())
-                valid_pairs.append((audio, transcript))
-            else:
-                print(f"Transcript not found for: {audio}")
-
-        valid_audios = [pair[0] for pair in valid_pairs]
-        valid_transcripts = [pair[1] for pair in valid_pairs]
-
-        prob_diffs = compute_probability_difference_batched(valid_audios, ground_truths, args.language, args.batch_size)
-
-        for audio_path, transcript_path, prob_diff in tqdm(
-            zip(valid_audios, valid_transcripts, prob_diffs),
-            total=len(valid_audios),
-            desc=f"Filtering {base_dir_name} (batched)"
-        ):
-            book_name = audio_path.parent.parent.stem
-            if current_book != book_name:
-                if current_book is not None:
-                    write_book_stats(current_book, retained_count, rejected_count, history_f)
-                current_book = book_name
-                retained_count = 0
-                rejected_count = 0
-
-            if process_file(audio_path, transcript_path, prob_diff, args.probability_difference_threshold, output_subdir, base_dir_name, log_f):
-                retained_count += 1
-            else:
-                rejected_count += 1
-
-        if current_book is not None:
-            write_book_stats(current_book, retained_count, rejected_count, history_f)
+    write_filter_scores(score_table_path, base_dir_name, jobs)
+    if manifest_path is not None:
+        write_filter_manifest(manifest_path, jobs)
+    ledger.close()
+    log_f.close()
+    history_f.close()
 
 if __name__ == "__main__":
     args = parse_args()
@@ -0,0 +1,248 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+import argparse
+import shutil
+import threading
+
+import torch
+import torchaudio
+from tqdm.auto import tqdm
+
+from audio_loader import get_resampler
+from fingerprints import plan_reason, print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+from segment_audio import align_verses, bundle, chapter_emission, chapter_fingerprint, export_verses
+from stage_pipeline import Pipeline, Stage
+from text_utils import load_transcripts, pre_processing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Segment many books at once, decoding, text processing, inference, alignment "
+        "and export running concurrently on different chapters."
+    )
+    parser.add_argument("--json_dir", required=True, help="Directory of the book JSON files, <BOOK>.json. Example: data/openbible_swahili/")
+    parser.add_argument("--audio_dir", required=True, help="Directory of the chapter wavs, one folder per book. Example: downloads/wavs_16/")
+    parser.add_argument("--output_dir", default="outputs/openbible_swahili/", help="Path to the output directory")
+    parser.add_argument("--books", nargs="*", default=None, help="Books to segment. Default: every folder of --audio_dir with a JSON file.")
+    parser.add_argument("--language", required=True, type=str, help="Language in ISO 639-3 code.")
+    parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+    parser.add_argument(
+        "--context_size_s",
+        type=float,
+        default=1.0,
+        help="Audio added on both sides of every chunk and dropped from its emissions, in seconds.",
+    )
+    parser.add_argument("--emission_batch_size", type=int, default=4, help="Number of chunks run through the model at once.")
+    parser.add_argument(
+        "--cache_dir", default=None, help="Directory of the emission cache, reused when the same chapters are segmented again, also holds parsed book "
+        "transcripts. Filtering caches verse emissions under other keys, use --score to reuse the chapter alignment. Disabled if not set."
+    )
+    parser.add_argument(
+        "--score",
+        action="store_true",
+        help="Also compute each verse's MMS probability difference from the chapter alignment and write it to scores.csv.",
+    )
+    parser.add_argument("--decode_workers", type=int, default=2, help="Threads reading and resampling chapter audio.")
+    parser.add_argument("--text_workers", type=int, default=1, help="Threads romanizing and normalizing chapter verses (uroman).")
+    parser.add_argument("--infer_workers", type=int, default=1, help="Threads computing emissions, all sharing the one MMS_FA model.")
+    parser.add_argument("--align_workers", type=int, default=1, help="Threads force-aligning verses on the emissions.")
+    parser.add_argument("--export_workers", type=int, default=2, help="Threads writing the verse wav and txt files.")
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=4,
+        help="Chapters waiting between two stages, bounds the decoded audio held in memory.",
+    )
+    parser.add_argument(
+        "--report_every",
+        type=float,
+        default=30.0,
+        help="Seconds between two reports of stage utilization and queue depths, 0 reports at the end only.",
+    )
+    parser.add_argument("--torch_threads", type=int, default=None, help="torch intra-op threads. Default: torch's own.")
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the chapters that would be segmented: new ones, and those whose audio, verses, "
+        "code or parameters changed since they were segmented.",
+    )
+    args = parser.parse_args()
+    # a stage without workers would never pass its chapters on, and the run would hang
+    for name in ("decode_workers", "text_workers", "infer_workers", "align_workers", "export_workers"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name} must be at least 1")
+    return args
+
+
+@dataclass
+class ChapterJob:
+    """A chapter going through the pipeline, each stage filling in its part."""
+
+    book: str
+    chapter: str
+    audio_path: Path
+    json_path: Path
+    inputs: Dict
+    fingerprint: str
+    messages: List[str] = field(default_factory=list)
+    waveform: torch.Tensor = None
+    sample_rate: int = None
+    resampled_waveform: torch.Tensor = None
+    augmented_words: List[str] = None
+    words: List[List[str]] = None
+    verse_ids: List[str] = None
+    emission: torch.Tensor = None
+    bounds: List[Tuple[int, int]] = None
+    labels: List[str] = None
+    scores: List[float] = None
+    num_segments: int = None
+
+
+def list_books(json_dir: Path, audio_dir: Path, books=None) -> List[str]:
+    if books:
+        return books
+    return sorted(
+        book_dir.name for book_dir in audio_dir.iterdir() if book_dir.is_dir() and (json_dir / f"{book_dir.name}.json").exists()
+    )
+
+
+def plan_chapters(args, books: List[str], ledgers: Dict[str, JobLedger]) -> Tuple[List[ChapterJob], Dict[str, Dict]]:
+    """Chapters to segment, in book order, and the plan reason of every chapter per book."""
+    index_dir = Path(args.cache_dir) / "transcripts" if args.cache_dir is not None else None
+    jobs, reasons = [], {}
+    for book in books:
+        json_path = Path(args.json_dir) / f"{book}.json"
+        reasons[book] = {}
+        for audio_path in sorted((Path(args.audio_dir) / book).rglob("*.wav")):
+            chapter = audio_path.stem
+            entry = ledgers[book].get(chapter)
+            inputs, chapter_fp = chapter_fingerprint(
+                audio_path,
+                json_path,
+                args.language,
+                args.chunk_size_s,
+                args.context_size_s,
+                args.score,
+                "wav",
+                index_dir,
+                entry,
+            )
+            reason = plan_reason(entry, chapter_fp)
+            reasons[book][chapter] = reason
+            if reason is not None:
+                jobs.append(ChapterJob(book, chapter, audio_path, json_path, inputs, chapter_fp))
+    return jobs, reasons
+
+
+def build_stages(args, ledgers: Dict[str, JobLedger]) -> List[Stage]:
+    index_dir = Path(args.cache_dir) / "transcripts" if args.cache_dir is not None else None
+    ledger_lock = threading.Lock()
+
+    def decode(job: ChapterJob) -> ChapterJob:
+        job.waveform, job.sample_rate = torchaudio.load(job.audio_path)
+        resampler = get_resampler(job.sample_rate, bundle.sample_rate, job.waveform.dtype)
+        job.resampled_waveform = resampler(job.waveform)
+        return job
+
+    def text(job: ChapterJob) -> ChapterJob:
+        job.augmented_words, job.words = pre_processing(job.json_path, job.chapter, args.language, index_dir)
+        job.verse_ids, _ = load_transcripts(job.json_path, job.chapter, index_dir)
+        return job
+
+    def infer(job: ChapterJob) -> ChapterJob:
+        job.emission = chapter_emission(
+            job.resampled_waveform,
+            args.chunk_size_s,
+            args.cache_dir,
+            args.context_size_s,
+            args.emission_batch_size,
+            job.audio_path,
+        )
+        job.resampled_waveform = None
+        return job
+
+    def align(job: ChapterJob) -> ChapterJob:
+        messages, job.bounds, job.labels, job.scores = align_verses(
+            job.emission, job.augmented_words, job.words, job.waveform.size(1), job.chapter, args.score
+        )
+        job.messages.extend(messages)
+        job.emission = None
+        return job
+
+    def export(job: ChapterJob) -> ChapterJob:
+        # verses of a previous version of the chapter would be left behind
+        output_dir = Path(args.output_dir) / job.book / job.chapter
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        _, job.num_segments = export_verses(
+            job.waveform,
+            job.sample_rate,
+            job.bounds,
+            job.labels,
+            job.scores,
+            job.verse_ids,
+            job.book,
+            job.chapter,
+            output_dir,
+            args.score,
+        )
+        job.waveform = None
+        # every file of the chapter is written, only now it counts as segmented
+        with ledger_lock:
+            ledgers[job.book].mark_done(
+                job.chapter, inputs=job.inputs, fingerprint=job.fingerprint, segments=job.num_segments
+            )
+        return job
+
+    return [
+        Stage("decode", decode, args.decode_workers),
+        Stage("text", text, args.text_workers),
+        Stage("infer", infer, args.infer_workers),
+        Stage("align", align, args.align_workers),
+        Stage("export", export, args.export_workers),
+    ]
+
+
+def main(args):
+    if args.torch_threads:
+        torch.set_num_threads(args.torch_threads)
+
+    books = list_books(Path(args.json_dir), Path(args.audio_dir), args.books)
+    ledgers = {book: JobLedger(Path(args.output_dir) / book / LEDGER_FILE_NAME) for book in books}
+    jobs, reasons = plan_chapters(args, books, ledgers)
+
+    if args.dry_run:
+        for book in books:
+            print_plan(book, reasons[book])
+        return
+
+    skipped = sum(reason is None for book_reasons in reasons.values() for reason in book_reasons.values())
+    if skipped:
+        tqdm.write(f"Skipping {skipped} chapters already segmented")
+
+    def on_error(stage, job, e):
+        # the chapter isn't marked done and is redone by the next run
+        tqdm.write(f"[Error] {stage.name} {job.chapter}: {e}")
+
+    pipeline = Pipeline(
+        build_stages(args, ledgers),
+        queue_size=args.queue_size,
+        on_error=on_error,
+        report_every=args.report_every,
+        report=tqdm.write,
+    )
+    try:
+        for job in tqdm(pipeline.run(jobs), total=len(jobs), desc="Segmenting"):
+            for message in job.messages:
+                tqdm.write(message)
+    finally:
+        for ledger in ledgers.values():
+            ledger.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
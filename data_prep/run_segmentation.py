@@ -1,9 +1,16 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import argparse
+import multiprocessing as mp
+import os
 
+import torch
 from tqdm.auto import tqdm
 
-from segment_audio import segment
+from fingerprints import plan_reason, print_plan
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+from segment_plan import chapter_fingerprint
+from shard_writer import DEFAULT_SHARD_BYTES, SHARD_FORMATS, ShardWriter, compact_shards
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -16,6 +23,53 @@ parser.add_argument(
 )
 parser.add_argument("--output_dir", default="outputs/openbible_swahili/", help="Path to the output directory")
 parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+parser.add_argument(
+    "--context_size_s",
+    type=float,
+    default=1.0,
+    help="Audio added on both sides of every chunk and dropped from its emissions, in seconds.",
+)
+parser.add_argument("--emission_batch_size", type=int, default=4, help="Number of chunks run through the model at once.")
+parser.add_argument(
+    "--cache_dir", default=None, help="Directory of the emission cache, reused when the same chapters are segmented again, also holds parsed book "
+    "transcripts. Filtering caches verse emissions under other keys, use --score to reuse the chapter alignment. Disabled if not set."
+)
+parser.add_argument(
+    "--score",
+    action="store_true",
+    help="Also compute each verse's MMS probability difference from the chapter alignment and write it to scores.csv.",
+)
+parser.add_argument(
+    "--export",
+    choices=("wav",) + SHARD_FORMATS,
+    default="wav",
+    help="Write one wav and txt file per verse, or append the verses of each book to Arrow/Parquet shards "
+    "(requires pyarrow) under output_dir/<book>/.",
+)
+parser.add_argument(
+    "--shard_size_mb",
+    type=float,
+    default=DEFAULT_SHARD_BYTES / (1024 * 1024),
+    help="Size after which a new shard is started, in MB.",
+)
+parser.add_argument(
+    "--dry_run",
+    action="store_true",
+    help="Only list the chapters that would be segmented: new ones, and those whose audio, verses, "
+    "code or parameters changed since they were segmented.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of chapters segmented in parallel, each worker process loads its own MMS_FA model.",
+)
+parser.add_argument(
+    "--threads_per_worker",
+    type=int,
+    default=None,
+    help="torch threads of each worker. Default: CPU count divided by --workers.",
+)
 parser.add_argument(
         "--language",
         type=str,
@@ -29,11 +83,133 @@ parser.add_argument(
     )
 
 
+def _init_worker(num_threads: int):
+    torch.set_num_threads(num_threads)
+    # the MMS_FA model is loaded once per worker, when segment_audio is imported
+    import segment_audio  # noqa: F401
+
+
+def _segment(audio_path, *segment_args):
+    # segment_audio is only imported where chapters are segmented, the main process
+    # of a parallel run would otherwise load a model it never uses
+    from segment_audio import segment
+
+    return segment(audio_path, *segment_args)
+
+
 def main(args):
     audio_dir = Path(args.audio_dir)
     audios = sorted(audio_dir.rglob("*.wav"))
-    for audio_path in tqdm(audios, desc=f"Segmenting {audio_dir.stem}"):
-        segment(audio_path, args.json_path, args.output_dir,args.language,args.chunk_size_s)
+    as_records = args.export != "wav"
+    segment_args = (
+        args.json_path,
+        args.output_dir,
+        args.language,
+        args.chunk_size_s,
+        args.cache_dir,
+        args.score,
+        args.context_size_s,
+        args.emission_batch_size,
+        as_records,
+    )
+
+    book_dir = Path(args.output_dir) / Path(args.json_path).stem
+
+    # in wav mode segment() checks the ledger itself, chapters exported to shards are
+    # checked here, as they are written by this process only
+    plans = {}
+    if as_records or args.dry_run:
+        # a chapter only counts as exported once the shard holding it is closed
+        ledger = JobLedger(book_dir / LEDGER_FILE_NAME, flush_every=1)
+        index_dir = Path(args.cache_dir) / "transcripts" if args.cache_dir is not None else None
+        for audio_path in audios:
+            inputs, chapter_fp = chapter_fingerprint(
+                audio_path,
+                args.json_path,
+                args.language,
+                args.chunk_size_s,
+                args.context_size_s,
+                args.score,
+                args.export,
+                index_dir,
+                ledger.get(audio_path.stem),
+            )
+            plans[audio_path.stem] = (inputs, chapter_fp, plan_reason(ledger.get(audio_path.stem), chapter_fp))
+
+    if args.dry_run:
+        print_plan(audio_dir.stem, {chapter: reason for chapter, (_, _, reason) in plans.items()})
+        return
+
+    # chapters are appended to the book's shards by this process only, as they finish
+    writer = None
+    pending_chapters = []
+    if as_records:
+        writer = ShardWriter(book_dir, args.export, int(args.shard_size_mb * 1024 * 1024))
+        done = [audio_path for audio_path in audios if plans[audio_path.stem][2] is None]
+        if done:
+            tqdm.write(f"Skipping {len(done)} chapters already exported")
+        audios = [audio_path for audio_path in audios if plans[audio_path.stem][2] is not None]
+
+    def commit_chapters():
+        for chapter, num_records, shard in pending_chapters:
+            inputs, chapter_fp, _ = plans[chapter]
+            # rows of a changed chapter in older shards are dropped by compact_shards()
+            ledger.mark_done(chapter, inputs=inputs, fingerprint=chapter_fp, segments=num_records, shard=shard)
+        pending_chapters.clear()
+
+    def report(chapter, result):
+        messages, records = result
+        if writer is not None:
+            writer.write(records)
+            shard = writer.paths[-1].name if records else None
+            pending_chapters.append((chapter, len(records), shard))
+            if writer.writer is None:
+                commit_chapters()
+        for message in messages:
+            tqdm.write(message)
+
+    try:
+        run(args, audio_dir, audios, segment_args, report)
+    finally:
+        if writer is not None:
+            writer.close()
+            commit_chapters()
+            ledger.close()
+            # every chapter keeps its rows in the shard its ledger entry names only, this also
+            # finishes the compaction of a run interrupted after its shards were closed
+            chapter_shards = {chapter: entry["shard"] for chapter, entry in ledger.entries.items() if "shard" in entry}
+            for path in compact_shards(book_dir, args.export, chapter_shards):
+                tqdm.write(f"Dropped the previous rows of redone chapters from {path.name}")
+
+
+def run(args, audio_dir, audios, segment_args, report):
+    if args.workers <= 1:
+        for audio_path in tqdm(audios, desc=f"Segmenting {audio_dir.stem}"):
+            try:
+                result = _segment(audio_path, *segment_args)
+            except Exception as e:
+                # one failing chapter shouldn't stop the rest of the book
+                tqdm.write(f"[Error] {audio_path.stem}: {e}")
+                continue
+            report(audio_path.stem, result)
+        return
+
+    num_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        futures = {executor.submit(_segment, audio_path, *segment_args): audio_path for audio_path in audios}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Segmenting {audio_dir.stem}"):
+            try:
+                result = future.result()
+            except Exception as e:
+                # one failing chapter shouldn't stop the other workers
+                tqdm.write(f"[Error] {futures[future].stem}: {e}")
+                continue
+            report(futures[future].stem, result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+# written by filtering next to its ledger, one table per book
+SCORE_TABLE_FILE_NAME = "scores.npz"
+
+
+def write_score_table(path, book: str, keys: List[str], chapters: List[str], scores, durations):
+    """Store the probability difference and duration of every segment of a book.
+
+    The table holds columns only (segment keys, chapters, float32 scores and
+    durations), a few bytes per segment, so thresholds can be tried again from it
+    without running the model or reading any audio.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            book=np.array(book),
+            key=np.array(keys, dtype=str),
+            chapter=np.array(chapters, dtype=str),
+            probability_difference=np.asarray(scores, dtype=np.float32),
+            duration=np.asarray(durations, dtype=np.float32),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_score_tables(paths) -> Dict[str, np.ndarray]:
+    """Concatenate score tables, with a ``book`` column repeating each table's book."""
+    columns = {"book": [], "key": [], "chapter": [], "probability_difference": [], "duration": []}
+    for path in paths:
+        with np.load(path) as table:
+            num_segments = len(table["key"])
+            columns["book"].append(np.full(num_segments, str(table["book"]), dtype=object))
+            for name in ("key", "chapter", "probability_difference", "duration"):
+                columns[name].append(table[name])
+    if not columns["key"]:
+        raise FileNotFoundError("No score table found")
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def retention_curves(groups: np.ndarray, scores: np.ndarray, durations: np.ndarray, thresholds) -> Dict[str, Dict[str, np.ndarray]]:
+    """Retained segments and duration of every group for every threshold.
+
+    A segment is retained when its score is above the threshold, as in filtering.
+    Scores are sorted once per group, and a ``searchsorted`` of all thresholds in a
+    cumulative sum of durations gives every count and retained duration at once.
+
+    Returns:
+        group -> {"retained", "total", "retained_duration", "total_duration"}, each
+        an array over ``thresholds`` (totals are scalars), plus an ``"ALL"`` group.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    scores = np.asarray(scores, dtype=np.float32)
+    durations = np.asarray(durations, dtype=np.float64)
+
+    def curves(group_scores, group_durations):
+        order = np.argsort(group_scores, kind="stable")
+        sorted_scores = group_scores[order]
+        cumulative_durations = np.concatenate(([0.0], np.cumsum(group_durations[order])))
+        # segments at or below the threshold are rejected
+        rejected = np.searchsorted(sorted_scores, thresholds, side="right")
+        return {
+            "retained": len(sorted_scores) - rejected,
+            "total": len(sorted_scores),
+            "retained_duration": cumulative_durations[-1] - cumulative_durations[rejected],
+            "total_duration": cumulative_durations[-1],
+        }
+
+    results = {}
+    group_names, group_index = np.unique(groups, return_inverse=True)
+    order = np.argsort(group_index, kind="stable")
+    bounds = np.searchsorted(group_index[order], np.arange(len(group_names) + 1))
+    for i, name in enumerate(group_names):
+        members = order[bounds[i] : bounds[i + 1]]
+        results[str(name)] = curves(scores[members], durations[members])
+    results["ALL"] = curves(scores, durations)
+    return results
@@ -1,12 +1,25 @@
 from pathlib import Path
+from typing import Dict, List, Tuple
 import argparse
+import csv
+import shutil
 import torch
 import torchaudio
-import torchaudio.transforms as T
 
 from scipy.io.wavfile import write
 
-from alignment_utils import MMS_SUBSAMPLING_RATIO, compute_alignments
+from alignment_utils import (
+    MMS_MODEL_ID,
+    SCORES_FILE_NAME,
+    compute_alignments,
+    compute_emissions,
+    compute_span_probability_difference,
+)
+from audio_loader import get_resampler
+from emission_cache import cached_emission
+from job_ledger import LEDGER_FILE_NAME, JobLedger
+from segment_plan import SEGMENT_MODULES, chapter_fingerprint  # noqa: F401
+from shard_writer import wav_bytes
 from text_utils import (pre_processing,load_transcripts)
 # after modification of this add lang parameter to handle language transcripts variety
 
@@ -22,6 +35,22 @@ parser.add_argument(
 )
 parser.add_argument("--output_dir", default="outputs/openbible_swahili/", help="Path to the output directory")
 parser.add_argument("--chunk_size_s", type=int, default=15, help="Chunk size in seconds")
+parser.add_argument(
+    "--context_size_s",
+    type=float,
+    default=1.0,
+    help="Audio added on both sides of every chunk and dropped from its emissions, in seconds.",
+)
+parser.add_argument("--emission_batch_size", type=int, default=4, help="Number of chunks run through the model at once.")
+parser.add_argument(
+    "--cache_dir", default=None, help="Directory of the emission cache, reused when the same chapters are segmented again, also holds parsed book "
+    "transcripts. Filtering caches verse emissions under other keys, use --score to reuse the chapter alignment. Disabled if not set."
+)
+parser.add_argument(
+    "--score",
+    action="store_true",
+    help="Also compute each verse's MMS probability difference from the chapter alignment and write it to scores.csv.",
+)
 parser.add_argument(
         "--language",
         type=str,
@@ -38,81 +67,68 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # load MMS aligner model
 bundle = torchaudio.pipelines.MMS_FA
-model = bundle.get_model(with_star=True).to(device)
+# the star column is appended to every window by compute_emissions
+model = bundle.get_model(with_star=False).to(device)
 DICTIONARY = bundle.get_dict()
 
 
-"""def load_transcripts(json_path: Path, chapter: str) -> Tuple[List[str], List[str]]:
-    with open(json_path, "r") as f:
-        data = json.load(f)
-
-    # convert MAT.19.1 -> MAT_019
-    get_chapter = lambda x: x.split('.')[0] + '_' + x.split('.')[1].zfill(3)  # noqa: E731
-    # filter by book and chapter
-    transcripts = [d["verset"] for d in data if get_chapter(d["numVerset"]) == chapter]
-    verse_ids = [d["numVerset"] for d in data if get_chapter(d["numVerset"]) == chapter]
-    return verse_ids, transcripts
-"""
-
-def segment(audio_path: str, json_path: str, output_dir: str,language: str, chunk_size_s: int = 15):
-    audio_path = Path(audio_path)
-    json_path = Path(json_path)
-
-    # book = "MAT"; chapter = "MAT_019"
-    book, chapter = json_path.stem, audio_path.stem
-
-    # prepare output directories
-    output_dir = Path(output_dir) / book / chapter
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # skip if already segmented
-    if any(output_dir.iterdir()):
-        print(f"Skipping {chapter}")
-        return
-    
-    augmented_words, words= pre_processing(json_path,chapter, language)
-
-    # load transcripts
-    # verse_ids, transcripts = load_transcripts(json_path, chapter)
-    # apply preprocessing
-    # verses = [preprocess_verse(v) for v in transcripts]
-
-    # insert "*" before every verse for chapter intro or verse number
-    # see MMS robust noisy audio alignment
-    # https://pytorch.org/audio/main/tutorials/ctc_forced_alignment_api_tutorial.html
-    # augmented_verses = ["*"] * len(verses) * 2
-    # augmented_verses[1::2] = verses
+def chapter_emission(
+    resampled_waveform: torch.Tensor,
+    chunk_size_s: int = 15,
+    cache_dir: str = None,
+    context_size_s: float = 1.0,
+    emission_batch_size: int = 4,
+    audio_path: Path = None,
+) -> torch.Tensor:
+    """MMS_FA emission of a chapter already resampled to ``bundle.sample_rate``, float16 when cached.
+
+    Emissions are only cached when ``audio_path``, the file the waveform was read
+    from, is given: there is no file content to key a waveform built in memory on.
+    """
+    return cached_emission(
+        cache_dir if audio_path is not None else None,
+        audio_path,
+        MMS_MODEL_ID,
+        chunk_size_s,
+        True,
+        lambda: compute_emissions(
+            model,
+            resampled_waveform,
+            bundle.sample_rate,
+            chunk_size_s,
+            device,
+            context_size_s,
+            emission_batch_size,
+            append_star=True,
+        ),
+        device,
+        context_size_s,
+    )
 
-    # words = [verse.split() for verse in verses]
-    # augmented_words = [word for verse in augmented_verses for word in verse.split()]
 
-    # load audio
-    input_waveform, input_sample_rate = torchaudio.load(audio_path)
-    resampler = T.Resample(input_sample_rate, bundle.sample_rate, dtype=input_waveform.dtype)
-    resampled_waveform = resampler(input_waveform)
-    # split audio into chunks to avoid OOM and faster inference
-    chunk_size_frames = chunk_size_s * bundle.sample_rate
-    chunks = [
-        resampled_waveform[:, i : i + chunk_size_frames]
-        for i in range(0, resampled_waveform.shape[1], chunk_size_frames)
-    ]
-
-    # collect per-chunk emissions, rejoin
-    emissions = []
-    with torch.inference_mode():
-        for chunk in chunks:
-            # NOTE: we could pad here, but it'll need to be removed later
-            # skipping for simplicity, since it's at most 25ms
-            if chunk.size(1) >= MMS_SUBSAMPLING_RATIO:
-                emission, _ = model(chunk.to(device))
-                emissions.append(emission)
-
-    emission = torch.cat(emissions, dim=1)
+def align_verses(
+    emission: torch.Tensor,
+    augmented_words: List[str],
+    words: List[List[str]],
+    num_samples: int,
+    chapter: str,
+    score: bool = False,
+) -> Tuple[List[str], List[Tuple[int, int]], List[str], List[float]]:
+    """Force-align a chapter's verses on its emission.
+
+    Returns:
+        ``(messages, bounds, labels, scores)``: the ``(x0, x1)`` sample bounds of every
+        aligned verse in a waveform of ``num_samples`` samples, its transcript, and
+        its probability difference if ``score``.
+    """
+    messages = []
     num_frames = emission.size(1)
     assert len(DICTIONARY) == emission.shape[2]
 
     # perform forced-alignment
-    word_spans = compute_alignments(emission, augmented_words, DICTIONARY, device)
+    word_spans, aligned_scores = compute_alignments(
+        emission, augmented_words, DICTIONARY, device, return_scores=True
+    )
 
     # remove "*" from alignment
     word_only_spans = [spans for spans, word in zip(word_spans, augmented_words) if word != "*"]
@@ -122,15 +138,17 @@ def segment(audio_path: str, json_path: str, output_dir: str,language: str, chun
     
     # words: comes from  pre_processing function above
 
-    segments, labels, start = [], [], 0
+    bounds, labels, scores, start = [], [], [], 0
     for verse_words in words:
         end = start + len(verse_words)
         verse_spans = word_only_spans[start:end]
-        ratio = input_waveform.size(1) / num_frames
+        ratio = num_samples / num_frames
         
         
         if not verse_spans or not all(verse_spans):
-            print(f"[Warning] Skipping verse {start}-{end}: verse_spans is empty or contains empty elements.")
+            messages.append(
+                f"[Warning] {chapter}: skipping verse {start}-{end}: verse_spans is empty or contains empty elements."
+            )
             start = end
             continue
 
@@ -138,37 +156,261 @@ def segment(audio_path: str, json_path: str, output_dir: str,language: str, chun
             x0 = int(ratio * verse_spans[0][0].start)
             x1 = int(ratio * verse_spans[-1][-1].end)
         except Exception as e:
-            print(f"[Error] Failed to compute x0/x1 for verse {start}-{end}: {e}")
+            messages.append(f"[Error] {chapter}: failed to compute x0/x1 for verse {start}-{end}: {e}")
             start = end
             continue
 
         transcript = " ".join(verse_words)
-        segment = input_waveform[:, x0:x1]
         start = end
-        segments.append(segment)
+        bounds.append((x0, x1))
         labels.append(transcript)
-
-
-    # assert len(segments) == len(verse_ids) == len(labels)
+        if score:
+            # the "*" column isn't part of the filter's label set
+            scores.append(
+                compute_span_probability_difference(
+                    emission,
+                    aligned_scores,
+                    verse_spans[0][0].start,
+                    verse_spans[-1][-1].end,
+                    len(DICTIONARY) - 1,
+                )
+            )
+
+    return messages, bounds, labels, scores
+
+
+def export_verses(
+    input_waveform: torch.Tensor,
+    input_sample_rate: int,
+    bounds: List[Tuple[int, int]],
+    labels: List[str],
+    scores: List[float],
+    verse_ids: List[str],
+    book: str,
+    chapter: str,
+    output_dir: Path,
+    score: bool = False,
+    as_records: bool = False,
+) -> Tuple[List[Dict], int]:
+    """Write the aligned verses of a chapter to its ``output_dir``, or return them as records.
+
+    Returns:
+        ``(records, num_segments)``, ``records`` being empty unless ``as_records``.
+    """
+    records = []
+    # assert len(bounds) == len(verse_ids) == len(labels)
 
     # export segments and forced-aligned transcripts
-    verse_ids,_ = load_transcripts(json_path, chapter)
-
-    for verse_id, segment, label in zip(verse_ids, segments, labels):
+    score_rows = []
+    for i, (verse_id, (x0, x1), label) in enumerate(zip(verse_ids, bounds, labels)):
+        segment = input_waveform[:, x0:x1]
         # # MAT.1.2 -> MAT_001_002
         verse_number = verse_id.split(".")[-1].zfill(3)
         verse_file_name = chapter + "_" + verse_number
 
+        if as_records:
+            records.append(
+                {
+                    "id": verse_file_name,
+                    "book": book,
+                    "chapter": chapter,
+                    "verse_id": verse_id,
+                    "audio": wav_bytes(segment.squeeze().numpy(), input_sample_rate),
+                    "sample_rate": input_sample_rate,
+                    "duration": segment.size(1) / input_sample_rate,
+                    "transcript": label,
+                    "probability_difference": scores[i] if score else None,
+                }
+            )
+            continue
+
         # write audio
-        audio_path = (output_dir / verse_file_name).with_suffix(".wav")
-        write(audio_path, input_sample_rate, segment.squeeze().numpy())
+        verse_audio_path = (output_dir / verse_file_name).with_suffix(".wav")
+        write(verse_audio_path, input_sample_rate, segment.squeeze().numpy())
 
         # write transcript
         transcript_path = (output_dir / verse_file_name).with_suffix(".txt")
         with open(transcript_path, "w") as f:
             f.write(label)
 
+        if score:
+            duration = segment.size(1) / input_sample_rate
+            score_rows.append([verse_audio_path.name, f"{scores[i]:.6f}", f"{duration:.3f}"])
+
+    if as_records:
+        return records, len(records)
+
+    if score:
+        with open(output_dir / SCORES_FILE_NAME, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["filename", "probability_difference", "duration"])
+            writer.writerows(score_rows)
+
+    return records, len(bounds)
+
+
+def segment_waveform(
+    input_waveform: torch.Tensor,
+    input_sample_rate: int,
+    json_path: Path,
+    chapter: str,
+    output_dir: Path,
+    language: str,
+    chunk_size_s: int = 15,
+    cache_dir: str = None,
+    score: bool = False,
+    context_size_s: float = 1.0,
+    emission_batch_size: int = 4,
+    as_records: bool = False,
+    audio_path: Path = None,
+) -> Tuple[List[str], List[Dict], int]:
+    """Segment a decoded chapter into verses, written to the chapter's ``output_dir``.
+
+    This is :func:`segment` without the file handling, for callers that already hold
+    the chapter audio in memory (e.g. ``ingest.py``). Emissions are only cached when
+    ``audio_path``, the file ``input_waveform`` was read from, is given.
+
+    Returns:
+        ``(messages, records, num_segments)``, ``records`` being empty unless ``as_records``.
+    """
+    json_path = Path(json_path)
+    book = json_path.stem
+    index_dir = Path(cache_dir) / "transcripts" if cache_dir is not None else None
+
+    augmented_words, words= pre_processing(json_path,chapter, language, index_dir)
+
+    # load transcripts
+    # verse_ids, transcripts = load_transcripts(json_path, chapter)
+    # apply preprocessing
+    # verses = [preprocess_verse(v) for v in transcripts]
+
+    # insert "*" before every verse for chapter intro or verse number
+    # see MMS robust noisy audio alignment
+    # https://pytorch.org/audio/main/tutorials/ctc_forced_alignment_api_tutorial.html
+    # augmented_verses = ["*"] * len(verses) * 2
+    # augmented_verses[1::2] = verses
+
+    # words = [verse.split() for verse in verses]
+    # augmented_words = [word for verse in augmented_verses for word in verse.split()]
+
+    resampler = get_resampler(input_sample_rate, bundle.sample_rate, input_waveform.dtype)
+    resampled_waveform = resampler(input_waveform)
+    emission = chapter_emission(
+        resampled_waveform, chunk_size_s, cache_dir, context_size_s, emission_batch_size, audio_path
+    )
+
+    messages, bounds, labels, scores = align_verses(
+        emission, augmented_words, words, input_waveform.size(1), chapter, score
+    )
+
+    verse_ids,_ = load_transcripts(json_path, chapter, index_dir)
+    records, num_segments = export_verses(
+        input_waveform,
+        input_sample_rate,
+        bounds,
+        labels,
+        scores,
+        verse_ids,
+        book,
+        chapter,
+        output_dir,
+        score,
+        as_records,
+    )
+    return messages, records, num_segments
+
+
+def segment(
+    audio_path: str,
+    json_path: str,
+    output_dir: str,
+    language: str,
+    chunk_size_s: int = 15,
+    cache_dir: str = None,
+    score: bool = False,
+    context_size_s: float = 1.0,
+    emission_batch_size: int = 4,
+    as_records: bool = False,
+) -> Tuple[List[str], List[Dict]]:
+    """Segment one chapter into verses.
+
+    With ``as_records``, nothing is written to ``output_dir``: every verse is returned
+    as a record of ``shard_writer.segment_schema`` for the caller to export.
+
+    Returns:
+        ``(messages, records)``: the warnings raised while segmenting the chapter, so
+        callers running chapters in parallel can report them in one place, and the
+        verse records, empty unless ``as_records``.
+    """
+    messages = []
+    audio_path = Path(audio_path)
+    json_path = Path(json_path)
+
+    # book = "MAT"; chapter = "MAT_019"
+    book, chapter = json_path.stem, audio_path.stem
+
+    # parsed book transcripts are kept next to the emissions when caching is enabled
+    index_dir = Path(cache_dir) / "transcripts" if cache_dir is not None else None
+
+    # prepare output directories
+    output_dir = Path(output_dir) / book / chapter
+    if not as_records:
+        # skip if segmented from the same audio, verses, code and parameters,
+        # a chapter interrupted halfway isn't in the ledger and is redone,
+        # records are checked against the ledger by the caller writing them
+        ledger = JobLedger(output_dir.parent / LEDGER_FILE_NAME)
+        inputs, chapter_fp = chapter_fingerprint(
+            audio_path, json_path, language, chunk_size_s, context_size_s, score, "wav", index_dir, ledger.get(chapter)
+        )
+        if ledger.is_done(chapter, chapter_fp):
+            messages.append(f"Skipping {chapter}")
+            return messages, []
+
+        # verses of a previous version of the chapter would be left behind
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    # load audio
+    input_waveform, input_sample_rate = torchaudio.load(audio_path)
+    chapter_messages, records, num_segments = segment_waveform(
+        input_waveform,
+        input_sample_rate,
+        json_path,
+        chapter,
+        output_dir,
+        language,
+        chunk_size_s,
+        cache_dir,
+        score,
+        context_size_s,
+        emission_batch_size,
+        as_records,
+        audio_path,
+    )
+    messages.extend(chapter_messages)
+    if as_records:
+        return messages, records
+
+    # every file of the chapter is written, only now it counts as segmented
+    ledger.mark_done(chapter, inputs=inputs, fingerprint=chapter_fp, segments=num_segments)
+    ledger.close()
+
+    return messages, []
+
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    segment(args.audio_path, args.json_path, args.output_dir,args.language, args.chunk_size_s)
+    messages, _ = segment(
+        args.audio_path,
+        args.json_path,
+        args.output_dir,
+        args.language,
+        args.chunk_size_s,
+        args.cache_dir,
+        args.score,
+        args.context_size_s,
+        args.emission_batch_size,
+    )
+    for message in messages:
+        print(message)
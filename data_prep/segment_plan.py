@@ -0,0 +1,42 @@
+from pathlib import Path
+from typing import Dict, Tuple
+
+from fingerprints import code_version, fingerprint, hash_inputs
+from text_utils import load_transcripts
+
+
+# modules whose changes invalidate segmented chapters
+SEGMENT_MODULES = ("segment_audio", "alignment_utils", "audio_loader", "text_utils", "norm_confg")
+
+
+def chapter_fingerprint(
+    audio_path,
+    json_path,
+    language: str,
+    chunk_size_s: int = 15,
+    context_size_s: float = 1.0,
+    score: bool = False,
+    export: str = "wav",
+    index_dir=None,
+    previous: dict = None,
+) -> Tuple[Dict, str]:
+    """Input hashes and fingerprint of a chapter, for its ledger entry.
+
+    The fingerprint covers the chapter audio, the chapter's verses in the book JSON
+    (a corrected verse elsewhere in the book leaves it unchanged), the segmentation
+    code and every parameter that changes the output. ``previous`` is the chapter's
+    current ledger entry, whose hashes are reused for an unmodified audio file.
+    """
+    verse_ids, transcripts = load_transcripts(json_path, Path(audio_path).stem, index_dir)
+    inputs = hash_inputs([audio_path], previous)
+    return inputs, fingerprint(
+        inputs,
+        code_version(*SEGMENT_MODULES),
+        verse_ids,
+        transcripts,
+        language=language,
+        chunk_size_s=chunk_size_s,
+        context_size_s=context_size_s,
+        score=score,
+        export=export,
+    )
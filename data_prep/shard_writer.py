@@ -0,0 +1,161 @@
+import io
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# bytes of audio, transcript and metadata per shard before a new one is started
+DEFAULT_SHARD_BYTES = 512 * 1024 * 1024
+
+SHARD_FORMATS = ("arrow", "parquet")
+
+
+def _pyarrow():
+    # optional dependency, only needed when exporting shards
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Exporting shards requires pyarrow: pip install pyarrow") from e
+    return pa
+
+
+def segment_schema():
+    pa = _pyarrow()
+    return pa.schema(
+        [
+            ("id", pa.string()),
+            ("book", pa.string()),
+            ("chapter", pa.string()),
+            ("verse_id", pa.string()),
+            ("audio", pa.binary()),
+            ("sample_rate", pa.int32()),
+            ("duration", pa.float32()),
+            ("transcript", pa.string()),
+            ("probability_difference", pa.float32()),
+        ]
+    )
+
+
+def wav_bytes(waveform, sample_rate: int) -> bytes:
+    """The exact bytes ``scipy.io.wavfile.write`` would put in a ``.wav`` file."""
+    from scipy.io.wavfile import write
+
+    buffer = io.BytesIO()
+    write(buffer, sample_rate, waveform)
+    return buffer.getvalue()
+
+
+def read_shard(path, columns: Optional[List[str]] = None):
+    """The table of an Arrow or Parquet shard, Arrow shards memory-mapped."""
+    pa = _pyarrow()
+    path = Path(path)
+    if path.suffix == ".arrow":
+        table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+        return table.select(columns) if columns is not None else table
+    return pa.parquet.read_table(str(path), columns=columns)
+
+
+def compact_shards(output_dir, shard_format: str, chapter_shards: Dict[str, Optional[str]], prefix: str = "shard") -> List[Path]:
+    """Drop the rows of redone chapters from the shards that held their previous version.
+
+    ``chapter_shards`` maps every exported chapter to the name of the shard holding its
+    current rows (None when it has no rows), as recorded in the book ledger. Rows of a
+    chapter found in any other shard are stale and removed, shards are rewritten under
+    a temporary name and ``os.replace``d, and a shard left without rows is deleted.
+    Chapters missing from ``chapter_shards`` are left alone.
+
+    Returns:
+        The shards rewritten or deleted.
+    """
+    pa = _pyarrow()
+    changed = []
+    for path in sorted(Path(output_dir).glob(f"{prefix}-*.{shard_format}")):
+        chapters = read_shard(path, ["chapter"]).column("chapter").to_pylist()
+        keep = [chapter not in chapter_shards or chapter_shards[chapter] == path.name for chapter in chapters]
+        if all(keep):
+            continue
+        changed.append(path)
+        if not any(keep):
+            path.unlink()
+            continue
+
+        table = read_shard(path).filter(pa.array(keep))
+        tmp_path = path.with_name(path.name + ".tmp")
+        if shard_format == "arrow":
+            with pa.ipc.new_file(str(tmp_path), table.schema) as writer:
+                writer.write_table(table)
+        else:
+            pa.parquet.write_table(table, str(tmp_path))
+        del table
+        os.replace(tmp_path, path)
+    return changed
+
+
+class ShardWriter:
+    """Append segment records to size-bounded Arrow IPC or Parquet shards.
+
+    Records are written as one record batch (or row group) per ``write`` call, i.e.
+    per chapter. A shard is written under a ``.tmp`` name and only renamed to
+    ``<prefix>-NNNNN.<format>`` once closed with its footer, so an interrupted run
+    leaves every shard matching that name readable. A new shard is started once the
+    current one holds ``max_shard_bytes``. Arrow shards can be opened without copying
+    with ``pyarrow.ipc.open_file(pyarrow.memory_map(path))``.
+    """
+
+    def __init__(self, output_dir, shard_format: str = "arrow", max_shard_bytes: int = DEFAULT_SHARD_BYTES, prefix: str = "shard"):
+        if shard_format not in SHARD_FORMATS:
+            raise ValueError(f"Unknown shard format {shard_format!r}, expected one of {SHARD_FORMATS}")
+        self.pa = _pyarrow()
+        self.schema = segment_schema()
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_format = shard_format
+        self.max_shard_bytes = max_shard_bytes
+        self.prefix = prefix
+
+        # never overwrite the shards of a previous run
+        self.shard_index = len(list(self.output_dir.glob(f"{prefix}-*.{shard_format}")))
+        self.writer = None
+        self.tmp_path = None
+        self.shard_bytes = 0
+        self.paths: List[Path] = []
+
+    def _open(self):
+        path = self.output_dir / f"{self.prefix}-{self.shard_index:05d}.{self.shard_format}"
+        while path.exists():
+            self.shard_index += 1
+            path = self.output_dir / f"{self.prefix}-{self.shard_index:05d}.{self.shard_format}"
+        # renamed by close(), a shard without its footer never has the final name
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        if self.shard_format == "arrow":
+            self.writer = self.pa.ipc.new_file(str(self.tmp_path), self.schema)
+        else:
+            self.writer = self.pa.parquet.ParquetWriter(str(self.tmp_path), self.schema)
+        self.shard_bytes = 0
+        self.paths.append(path)
+
+    def write(self, records: List[Dict]):
+        if not records:
+            return
+        table = self.pa.Table.from_pylist(records, schema=self.schema)
+        if self.writer is None:
+            self._open()
+        self.writer.write_table(table)
+        self.shard_bytes += table.nbytes
+        if self.shard_bytes >= self.max_shard_bytes:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.paths[-1])
+            self.writer = None
+            self.tmp_path = None
+            self.shard_index += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
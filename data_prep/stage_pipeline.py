@@ -0,0 +1,183 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List
+
+# put in a queue once everything upstream is processed
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """One step of a :class:`Pipeline`: ``fn`` run on every item by ``workers`` threads.
+
+    ``fn`` returns the item handed to the next stage, or None to drop it (e.g. a
+    chapter found up to date). The counters are filled in while the pipeline runs.
+    """
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    processed: int = 0
+    failed: int = 0
+    # worker time spent in fn, waiting for an input, and waiting for room downstream
+    busy_s: float = 0.0
+    starved_s: float = 0.0
+    blocked_s: float = 0.0
+    # input queue depth, sampled by the monitor
+    depth_total: int = 0
+    depth_max: int = 0
+    depth_samples: int = 0
+
+
+class Pipeline:
+    """Stages connected by bounded queues, all running at the same time.
+
+    Every stage has its own worker threads, so reading audio, text processing,
+    inference and writing files overlap on different items. Threads are enough here:
+    ffmpeg decoding, torch and file I/O release the GIL, and the model is loaded once
+    and shared. The bounded queues hold at most ``queue_size`` items between two
+    stages, so a slow stage holds back the ones before it instead of letting decoded
+    audio pile up in memory.
+
+    Every ``report_every`` seconds, and once at the end, ``report`` is called with a
+    table of each stage's throughput, utilization (time in ``fn`` over the time of
+    all its workers), time starved of input and blocked on the next stage, and the
+    depth of its input queue. The busiest stage, whose input queue stays full while
+    the following ones starve, is the bottleneck.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 4,
+        on_error: Callable[[Stage, Any, Exception], None] = None,
+        report_every: float = 30.0,
+        report: Callable[[str], None] = print,
+        sample_every: float = 0.5,
+    ):
+        for stage in stages:
+            if stage.workers < 1:
+                # a stage without workers would never hand on _DONE, run() would wait forever
+                raise ValueError(f"Stage {stage.name!r} needs at least one worker, got {stage.workers}")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.report_every = report_every
+        self.report = report
+        self.sample_every = sample_every
+        self._lock = threading.Lock()
+        self._started = None
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Push ``items`` through every stage, yielding the outputs of the last one as they finish."""
+        # queues[i] feeds stages[i], the last one is read by the caller
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        self._queues = queues
+        self._started = time.perf_counter()
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work, args=(stage, queues[i], queues[i + 1], remaining), daemon=True
+                    )
+                )
+        stop = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(stop,), daemon=True)
+        for thread in threads:
+            thread.start()
+        monitor.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            stop.set()
+            monitor.join()
+            self.report(self.summary())
+
+    def _feed(self, items, outbox):
+        try:
+            for item in items:
+                outbox.put(item)
+        finally:
+            # also when items raises, for the same reason as in _work
+            outbox.put(_DONE)
+
+    def _work(self, stage: Stage, inbox, outbox, remaining):
+        try:
+            while True:
+                waiting = time.perf_counter()
+                item = inbox.get()
+                started = time.perf_counter()
+                if item is _DONE:
+                    # for the other workers of the stage
+                    inbox.put(_DONE)
+                    break
+                failed = False
+                try:
+                    result = stage.fn(item)
+                except Exception as e:
+                    failed, result = True, None
+                    if self.on_error is not None:
+                        self.on_error(stage, item, e)
+                finished = time.perf_counter()
+                if result is not None:
+                    outbox.put(result)
+                with self._lock:
+                    stage.starved_s += started - waiting
+                    stage.busy_s += finished - started
+                    stage.blocked_s += time.perf_counter() - finished
+                    stage.processed += not failed
+                    stage.failed += failed
+        finally:
+            # also when on_error raises: without _DONE the next stages and the caller would wait forever
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                outbox.put(_DONE)
+
+    def _monitor(self, stop: threading.Event):
+        last_report = time.perf_counter()
+        while not stop.wait(self.sample_every):
+            with self._lock:
+                for stage, inbox in zip(self.stages, self._queues):
+                    depth = inbox.qsize()
+                    stage.depth_total += depth
+                    stage.depth_max = max(stage.depth_max, depth)
+                    stage.depth_samples += 1
+            if self.report_every and time.perf_counter() - last_report >= self.report_every:
+                self.report(self.summary())
+                last_report = time.perf_counter()
+
+    def summary(self) -> str:
+        """Stage table so far, and the stage most likely holding the pipeline back."""
+        elapsed = max(time.perf_counter() - self._started, 1e-9)
+        lines = [
+            f"{'stage':<10} {'workers':>7} {'done':>6} {'failed':>6} {'items/s':>8} "
+            f"{'busy':>6} {'starved':>8} {'blocked':>8} {'queue avg/max':>14}"
+        ]
+        with self._lock:
+            for stage in self.stages:
+                capacity = elapsed * stage.workers
+                depth_avg = stage.depth_total / max(stage.depth_samples, 1)
+                lines.append(
+                    f"{stage.name:<10} {stage.workers:>7} {stage.processed:>6} {stage.failed:>6} "
+                    f"{stage.processed / elapsed:>8.2f} {stage.busy_s / capacity:>6.0%} "
+                    f"{stage.starved_s / capacity:>8.0%} {stage.blocked_s / capacity:>8.0%} "
+                    f"{f'{depth_avg:.1f}/{stage.depth_max}':>14}"
+                )
+            bottleneck = max(self.stages, key=lambda stage: stage.busy_s / stage.workers)
+            lines.append(
+                f"after {elapsed:.0f}s, busiest stage: {bottleneck.name} "
+                f"({bottleneck.busy_s / (elapsed * bottleneck.workers):.0%} busy)"
+            )
+        return "\n".join(lines)
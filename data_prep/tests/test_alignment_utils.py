@@ -0,0 +1,59 @@
+import pytest
+import torch
+from torchaudio.models import wav2vec2_model
+from torchaudio.pipelines._wav2vec2.utils import _extend_model
+
+from alignment_utils import MMS_FRAME_STRIDE, compute_emissions, window_emissions
+
+
+@pytest.fixture(scope="module")
+def model():
+    # a small network with the MMS_FA frame stride, wrapped as by MMS_FA.get_model(with_star=False)
+    torch.manual_seed(0)
+    network = wav2vec2_model(
+        extractor_mode="layer_norm",
+        extractor_conv_layer_config=[(16, 10, 5)] + [(16, 3, 2)] * 4 + [(16, 2, 2)] * 2,
+        extractor_conv_bias=True,
+        encoder_embed_dim=32,
+        encoder_projection_dropout=0.0,
+        encoder_pos_conv_kernel=16,
+        encoder_pos_conv_groups=4,
+        encoder_num_layers=2,
+        encoder_num_heads=2,
+        encoder_attention_dropout=0.0,
+        encoder_ff_interm_features=64,
+        encoder_ff_interm_dropout=0.0,
+        encoder_dropout=0.0,
+        encoder_layer_norm_first=True,
+        encoder_layer_drop=0.0,
+        aux_num_out=28,
+    )
+    return _extend_model(network, normalize_waveform=True, apply_log_softmax=True).eval()
+
+
+def test_window_emissions_match_single_windows(model):
+    # windows of very different loudness, normalized together they would change each other
+    windows = torch.randn(4, 20 * MMS_FRAME_STRIDE) * torch.tensor([[0.01], [0.1], [1.0], [10.0]])
+    with torch.inference_mode():
+        batched = window_emissions(model, windows, append_star=True)
+        for i in range(windows.size(0)):
+            alone, _ = model(windows[i : i + 1])
+            torch.testing.assert_close(batched[i : i + 1, :, :-1], alone)
+    assert batched.size(-1) == 29
+    assert torch.all(batched[..., -1] == 0)
+
+
+@pytest.mark.parametrize("context_size_s", [0.0, 0.1])
+def test_compute_emissions_batch_size_invariant(model, context_size_s):
+    sample_rate = 16000
+    torch.manual_seed(1)
+    # 5 full windows of 0.4 s and a tail, louder towards the end
+    waveform = torch.randn(1, int(2.1 * sample_rate)) * torch.linspace(0.01, 1.0, int(2.1 * sample_rate))
+
+    one_by_one = compute_emissions(model, waveform, sample_rate, 0.4, "cpu", context_size_s, 1, append_star=True)
+    for batch_size in (2, 4, 8):
+        batched = compute_emissions(
+            model, waveform, sample_rate, 0.4, "cpu", context_size_s, batch_size, append_star=True
+        )
+        torch.testing.assert_close(batched, one_by_one)
+    assert one_by_one.size(-1) == 29
@@ -0,0 +1,47 @@
+import torch
+
+from emission_cache import EmissionCache, cached_emission
+
+
+def test_hit_returns_the_values_of_the_miss(tmp_path):
+    audio_path = tmp_path / "a.wav"
+    audio_path.write_bytes(b"audio")
+    emission = torch.log_softmax(torch.randn(1, 50, 29), dim=-1)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return emission
+
+    miss = cached_emission(tmp_path / "cache", audio_path, "model", 15, True, compute)
+    hit = cached_emission(tmp_path / "cache", audio_path, "model", 15, True, compute)
+
+    assert len(calls) == 1
+    assert miss.dtype == hit.dtype == torch.float16
+    torch.testing.assert_close(miss, hit, rtol=0, atol=0)
+    torch.testing.assert_close(hit.float(), emission, rtol=1e-3, atol=1e-2)
+
+
+def test_key_covers_content_and_settings(tmp_path):
+    cache = EmissionCache(tmp_path / "cache")
+    audio_path = tmp_path / "a.wav"
+    audio_path.write_bytes(b"audio")
+    key = cache.key(audio_path, "model", 15, True, 1.0)
+
+    assert cache.key(audio_path, "model", 15, True, 1.0) == key
+    assert cache.key(audio_path, "model", 15, True, 0.0) != key
+    assert cache.key(audio_path, "model", 15, False, 1.0) != key
+    assert cache.key(audio_path, "model", 10, True, 1.0) != key
+    assert cache.key(audio_path, "other", 15, True, 1.0) != key
+    audio_path.write_bytes(b"other audio")
+    assert cache.key(audio_path, "model", 15, True, 1.0) != key
+
+
+def test_load_returns_the_stored_dtype(tmp_path):
+    cache = EmissionCache(tmp_path / "cache")
+    cache.save("ab12", torch.zeros(1, 4, 3))
+
+    assert cache.load("cd34") is None
+    emission = cache.load("ab12")
+    assert emission.dtype == torch.float16
+    assert not list(cache.cache_dir.rglob("*.tmp"))
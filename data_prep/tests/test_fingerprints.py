@@ -0,0 +1,49 @@
+import os
+
+from fingerprints import fingerprint, hash_inputs, plan_reason
+
+
+def test_fingerprint_follows_content_and_parameters(tmp_path):
+    audio_path = tmp_path / "PSA_001.wav"
+    audio_path.write_bytes(b"audio")
+    inputs = hash_inputs([audio_path])
+    item_fp = fingerprint(inputs, "code", language="bum", chunk_size_s=15)
+
+    assert fingerprint(inputs, "code", chunk_size_s=15, language="bum") == item_fp
+    assert fingerprint(inputs, "other code", language="bum", chunk_size_s=15) != item_fp
+    assert fingerprint(inputs, "code", language="fra", chunk_size_s=15) != item_fp
+
+    audio_path.write_bytes(b"other audio")
+    assert (
+        fingerprint(hash_inputs([audio_path]), "code", language="bum", chunk_size_s=15) != item_fp
+    )
+
+
+def test_touched_file_keeps_its_fingerprint(tmp_path):
+    audio_path = tmp_path / "PSA_001.wav"
+    audio_path.write_bytes(b"audio")
+    inputs = hash_inputs([audio_path])
+    stat = audio_path.stat()
+    os.utime(audio_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    touched = hash_inputs([audio_path], {"inputs": inputs})
+
+    assert touched[audio_path.name][:2] != inputs[audio_path.name][:2]
+    assert fingerprint(touched, "code") == fingerprint(inputs, "code")
+
+
+def test_unchanged_file_reuses_the_recorded_hash(tmp_path):
+    audio_path = tmp_path / "PSA_001.wav"
+    audio_path.write_bytes(b"audio")
+    size_mtime = hash_inputs([audio_path])[audio_path.name][:2]
+
+    # only the recorded hash can give this value: the file isn't read again
+    inputs = hash_inputs([audio_path], {"inputs": {audio_path.name: size_mtime + ["recorded"]}})
+
+    assert inputs[audio_path.name][2] == "recorded"
+
+
+def test_plan_reason():
+    assert plan_reason(None, "1") == "new"
+    assert plan_reason({"fingerprint": "0"}, "1") == "changed"
+    assert plan_reason({"fingerprint": "1"}, "1") is None
@@ -0,0 +1,52 @@
+import json
+
+from job_ledger import JobLedger
+
+
+def test_replay_skips_a_torn_last_line(tmp_path):
+    path = tmp_path / ".ledger.jsonl"
+    ledger = JobLedger(path, flush_every=1)
+    ledger.mark_done("a", fingerprint="1")
+    ledger.mark_done("b", fingerprint="2")
+    ledger.close()
+    # a crash cut the last entry short
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"key": "c", "fingerp')
+
+    ledger = JobLedger(path)
+    assert set(ledger.entries) == {"a", "b"}
+    assert ledger.is_done("a", "1")
+    assert not ledger.is_done("a", "other")
+    assert not ledger.is_done("c")
+
+    # the next entry starts on a line of its own instead of being swallowed
+    ledger.mark_done("c", fingerprint="3")
+    ledger.close()
+    assert JobLedger(path).is_done("c", "3")
+
+
+def test_later_lines_win(tmp_path):
+    path = tmp_path / ".ledger.jsonl"
+    ledger = JobLedger(path)
+    ledger.mark_done("a", fingerprint="1")
+    ledger.mark_done("a", fingerprint="2")
+    ledger.close()
+
+    assert JobLedger(path).get("a")["fingerprint"] == "2"
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 2
+
+
+def test_entries_are_written_every_flush_every_items(tmp_path):
+    path = tmp_path / ".ledger.jsonl"
+    ledger = JobLedger(path, flush_every=2)
+    ledger.mark_done("a")
+    assert not path.exists() or path.read_text() == ""
+    ledger.mark_done("b")
+    assert [json.loads(line)["key"] for line in path.read_text().splitlines()] == ["a", "b"]
+    ledger.close()
+
+
+def test_reading_never_creates_the_file(tmp_path):
+    path = tmp_path / ".ledger.jsonl"
+    JobLedger(path).close()
+    assert not path.exists()
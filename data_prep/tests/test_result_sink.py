@@ -0,0 +1,38 @@
+from result_sink import ResultSink
+
+
+def test_lines_are_appended_in_batches(tmp_path):
+    path = tmp_path / "log.txt"
+    sink = ResultSink(path, flush_every=3)
+    sink.write_line("a")
+    sink.write_line("b\n")
+    assert path.read_text() == ""
+    sink.write_line("c")
+    assert path.read_text() == "a\nb\nc\n"
+
+    sink.write_line("d")
+    sink.close()
+    assert path.read_text() == "a\nb\nc\nd\n"
+    # closing twice is harmless, e.g. explicitly and at exit
+    sink.close()
+
+
+def test_rows_match_csv_writer_and_append_to_existing_file(tmp_path):
+    path = tmp_path / "history.csv"
+    path.write_text("Book,Retained,Rejected\r\n")
+    with ResultSink(path, flush_every=0) as sink:
+        sink.write_row(["PSA", 3, 1])
+        sink.write_row(["a, b", 0, 2])
+        # flush_every=0 only writes on flush or close
+        assert path.read_bytes() == b"Book,Retained,Rejected\r\n"
+
+    assert path.read_bytes() == b'Book,Retained,Rejected\r\nPSA,3,1\r\n"a, b",0,2\r\n'
+
+
+def test_flush_writes_pending_lines(tmp_path):
+    path = tmp_path / "log.txt"
+    sink = ResultSink(path, flush_every=0)
+    sink.write_line("a")
+    sink.flush()
+    assert path.read_text() == "a\n"
+    sink.close()
@@ -0,0 +1,45 @@
+import numpy as np
+
+from score_table import load_score_tables, retention_curves, write_score_table
+
+
+def test_retention_curves_match_a_brute_force_count():
+    rng = np.random.default_rng(0)
+    groups = rng.choice(["PSA_001", "PSA_002", "MAT_005"], size=200)
+    # rounded so that some scores are equal to a threshold
+    scores = np.round(rng.uniform(-1.0, 0.0, size=200), 1).astype(np.float32)
+    durations = rng.uniform(1.0, 20.0, size=200)
+    thresholds = np.linspace(-1.0, 0.0, 11)
+
+    curves = retention_curves(groups, scores, durations, thresholds)
+
+    assert set(curves) == {"PSA_001", "PSA_002", "MAT_005", "ALL"}
+    for name, curve in curves.items():
+        members = np.ones(len(groups), dtype=bool) if name == "ALL" else groups == name
+        assert curve["total"] == members.sum()
+        np.testing.assert_allclose(curve["total_duration"], durations[members].sum())
+        for i, threshold in enumerate(thresholds.astype(np.float32)):
+            retained = members & (scores > threshold)
+            assert curve["retained"][i] == retained.sum()
+            np.testing.assert_allclose(
+                curve["retained_duration"][i], durations[retained].sum(), atol=1e-9
+            )
+
+
+def test_tables_round_trip(tmp_path):
+    write_score_table(
+        tmp_path / "PSA" / "scores.npz",
+        "PSA",
+        ["a.wav", "b.wav"],
+        ["PSA_001", "PSA_002"],
+        [-0.1, -0.5],
+        [3.0, 4.5],
+    )
+    write_score_table(tmp_path / "MAT" / "scores.npz", "MAT", ["c.wav"], ["MAT_001"], [-0.3], [2.0])
+
+    table = load_score_tables([tmp_path / "PSA" / "scores.npz", tmp_path / "MAT" / "scores.npz"])
+
+    assert list(table["book"]) == ["PSA", "PSA", "MAT"]
+    assert list(table["key"]) == ["a.wav", "b.wav", "c.wav"]
+    np.testing.assert_allclose(table["probability_difference"], [-0.1, -0.5, -0.3], rtol=1e-6)
+    assert not list(tmp_path.rglob("*.tmp"))
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from stage_pipeline import Pipeline, Stage
+
+
+def run(pipeline, items):
+    result = []
+    # on a thread, so that a pipeline that never finishes fails the test instead of hanging it
+    thread = threading.Thread(target=lambda: result.extend(pipeline.run(items)), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "the pipeline never finished"
+    return result
+
+
+def test_every_item_goes_through_every_stage():
+    stages = [Stage("double", lambda x: 2 * x, workers=3), Stage("odd", lambda x: x + 1 if x % 4 else None)]
+    pipeline = Pipeline(stages, queue_size=2, report=lambda _: None)
+
+    assert sorted(run(pipeline, range(20))) == [2 * x + 1 for x in range(20) if (2 * x) % 4]
+    assert stages[0].processed == 20 and stages[1].processed == 20
+
+
+def test_failed_items_are_reported_and_dropped():
+    errors = []
+
+    def fn(x):
+        if x == 3:
+            raise RuntimeError("broken")
+        return x
+
+    stages = [Stage("fn", fn, workers=2)]
+    pipeline = Pipeline(stages, on_error=lambda stage, item, e: errors.append(item), report=lambda _: None)
+
+    assert sorted(run(pipeline, range(5))) == [0, 1, 2, 4]
+    assert errors == [3] and stages[0].failed == 1
+
+
+# the exception of the feed thread is reported by threading.excepthook
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_pipeline_finishes_when_the_items_raise():
+    def items():
+        yield 1
+        raise RuntimeError("broken input")
+
+    pipeline = Pipeline([Stage("same", lambda x: x)], report=lambda _: None)
+
+    assert run(pipeline, items()) == [1]
+
+
+@pytest.mark.parametrize("workers", [0, -1])
+def test_stage_without_workers_is_rejected(workers):
+    with pytest.raises(ValueError, match="at least one worker"):
+        Pipeline([Stage("read", lambda x: x), Stage("write", lambda x: x, workers=workers)])
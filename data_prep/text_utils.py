@@ -1,94 +1,123 @@
 import re
+import os
+import sys
 import unicodedata
 import json
+import hashlib
+import pickle
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Tuple
 import uroman as ur
 from norm_confg import norm_config 
 
-def text_normalize(text, iso_code, lower_case=True, remove_numbers=True, remove_brackets=False):
-
-    """Given a text, normalize it by changing to lower case, removing punctuations, removing words that only contain digits and removing extra spaces
-
-    Args:
-        text : The string to be normalized
-        iso_code :
-        remove_numbers : Boolean flag to specify if words containing only digits should be removed
+# brackets with numbers in them, usually corresponds to "(Sam 23:17)"
+BRACKETS_WITH_DIGITS_PATTERN = re.compile(r"\([^\)]*\d[^\)]*\)")
+BRACKETS_PATTERN = re.compile(r"\([^\)]*\)")
+SPACES_PATTERN = re.compile(r"\s+")
 
-    Returns:
-        normalized_text : the string after all normalization  
 
-    """
+@lru_cache(maxsize=1)
+def _all_characters() -> str:
+    return "".join(map(chr, range(sys.maxunicode + 1)))
 
-    config = norm_config.get(iso_code, norm_config["*"])
 
-    for field in ["lower_case", "punc_set","del_set", "mapping", "digit_set", "unicode_norm"]:
-        if field not in config:
-            config[field] = norm_config["*"][field]
+def _char_class_members(char_class: str) -> List[str]:
+    """Every character matched by the regex character class ``[char_class]``."""
+    return re.findall("[" + char_class + "]", _all_characters())
 
 
-    text = unicodedata.normalize(config["unicode_norm"], text)
+class TextNormalizer:
+    """``text_normalize`` compiled once for one ISO code.
 
-    # Convert to lower case
+    The mapping and digit patterns are compiled and the punctuation and delete sets
+    are turned into a single ``str.translate`` table, so normalizing a whole book
+    doesn't rebuild and recompile them for every verse. The shared ``norm_config``
+    is left untouched.
+    """
 
-    if config["lower_case"] and lower_case:
-        text = text.lower()
+    def __init__(self, iso_code: str):
+        config = dict(norm_config["*"])
+        config.update(norm_config.get(iso_code, {}))
+
+        self.unicode_norm = config["unicode_norm"]
+        self.lower_case = config["lower_case"]
+        self.mapping = [(re.compile(old), new) for old, new in config["mapping"].items()]
+
+        # characters in the delete list are removed, punctuations are replaced with a space
+        # (punctuations win, as they were replaced before the deletion)
+        self.translation = {ord(c): None for c in _char_class_members(config["del_set"])}
+        self.translation.update({ord(c): " " for c in _char_class_members(config["punc_set"])})
+
+        # Remove words containing only digits
+        # We check for 3 cases  a)text starts with a number b) a number is present somewhere in the middle of the text c) the text ends with a number
+        # For each case we use lookaround regex pattern to see if the digit pattern in preceded and followed by whitespaces, only then we replace the numbers with space
+        # The lookaround enables overlapping pattern matches to be replaced
+        digits_pattern = "[" + config["digit_set"] + "]+"
+        self.digits_pattern = re.compile(
+            r"^"
+            + digits_pattern
+            + r"(?=\s)|(?<=\s)"
+            + digits_pattern
+            + r"(?=\s)|(?<=\s)"
+            + digits_pattern
+            + r"$"
+        )
 
-    # brackets
-    
-    # always text inside brackets with numbers in them. Usually corresponds to "(Sam 23:17)"
-    text = re.sub(r"\([^\)]*\d[^\)]*\)", " ", text)
-    if remove_brackets:
-        text = re.sub(r"\([^\)]*\)", " ", text)
+        self.unidecode = None
+        if config["rm_diacritics"]:
+            from unidecode import unidecode
+            self.unidecode = unidecode
 
-    # Apply mappings
+    def normalize(self, text, lower_case=True, remove_numbers=True, remove_brackets=False):
+        text = unicodedata.normalize(self.unicode_norm, text)
 
-    for old, new in config["mapping"].items():
-        text = re.sub(old, new, text)
+        # Convert to lower case
+        if self.lower_case and lower_case:
+            text = text.lower()
 
-    # Replace punctutations with space
+        # brackets
+        text = BRACKETS_WITH_DIGITS_PATTERN.sub(" ", text)
+        if remove_brackets:
+            text = BRACKETS_PATTERN.sub(" ", text)
 
-    punct_pattern = r"[" + config["punc_set"]
+        # Apply mappings
+        for old, new in self.mapping:
+            text = old.sub(new, text)
 
-    punct_pattern += "]"
+        # Replace punctutations with space and remove characters in delete list
+        normalized_text = text.translate(self.translation)
 
-    normalized_text = re.sub(punct_pattern, " ", text)
+        if remove_numbers:
+            normalized_text = self.digits_pattern.sub(" ", normalized_text)
 
-    # remove characters in delete list
+        if self.unidecode is not None:
+            normalized_text = self.unidecode(normalized_text)
 
-    delete_patten = r"[" + config["del_set"] + "]"
+        # Remove extra spaces
+        return SPACES_PATTERN.sub(" ", normalized_text).strip()
 
-    normalized_text = re.sub(delete_patten, "", normalized_text)
 
-    # Remove words containing only digits
-    # We check for 3 cases  a)text starts with a number b) a number is present somewhere in the middle of the text c) the text ends with a number
-    # For each case we use lookaround regex pattern to see if the digit pattern in preceded and followed by whitespaces, only then we replace the numbers with space
-    # The lookaround enables overlapping pattern matches to be replaced
+@lru_cache(maxsize=None)
+def get_normalizer(iso_code: str) -> TextNormalizer:
+    return TextNormalizer(iso_code)
 
-    if remove_numbers:
 
-        digits_pattern = "[" + config["digit_set"]
+def text_normalize(text, iso_code, lower_case=True, remove_numbers=True, remove_brackets=False):
 
-        digits_pattern += "]+"
-# add a list of general devise handling as Euro, Fcfa,etc
-        complete_digit_pattern = (
-            r"^"
-            + digits_pattern
-            + "(?=\s)|(?<=\s)"
-            + digits_pattern
-            + "(?=\s)|(?<=\s)"
-            + digits_pattern
-            + "$"
-        )
+    """Given a text, normalize it by changing to lower case, removing punctuations, removing words that only contain digits and removing extra spaces
 
-        normalized_text = re.sub(complete_digit_pattern, " ", normalized_text)
+    Args:
+        text : The string to be normalized
+        iso_code :
+        remove_numbers : Boolean flag to specify if words containing only digits should be removed
 
-    if config["rm_diacritics"]:
-        from unidecode import unidecode
-        normalized_text = unidecode(normalized_text)
+    Returns:
+        normalized_text : the string after all normalization  
 
-    # Remove extra spaces
-    normalized_text = re.sub(r"\s+", " ", normalized_text).strip()
+    """
 
-    return normalized_text
+    return get_normalizer(iso_code).normalize(text, lower_case, remove_numbers, remove_brackets)
 
 
 def normalize_uroman(text)-> list[str]:
@@ -107,39 +136,115 @@ def normalize_uroman(text)-> list[str]:
     text = re.sub(' +', ' ', text)
     return text.strip()
 
-def load_transcripts(json_path, chapter):
-    with open(json_path, "r") as f:
-        data = json.load(f)
-       
-    # convert MAT.19.1 -> MAT_019
-    get_chapter = lambda x: x.split('.')[0] + '_' + x.split('.')[1].zfill(3)  # noqa: E731
-    # filter by book and chapter
-    transcripts = [d["verset"] for d in data if get_chapter(d["numVerset"]) == chapter]
-    verse_ids = [d["numVerset"] for d in data if get_chapter(d["numVerset"]) == chapter]
-    return verse_ids, transcripts
+# chapter -> (verse ids, verse texts)
+BookIndex = Dict[str, Tuple[List[str], List[str]]]
+
+# bump when the pickled index layout changes
+BOOK_INDEX_VERSION = 1
+
+# json path -> (mtime_ns, size, index), so each process parses a book once
+_BOOK_INDEXES: Dict[str, Tuple[int, int, BookIndex]] = {}
 
-def preprocess_verse(text:str,lang:str):
-    special_isos_uroman = "ara, bel, bul, deu, ell, eng, fas, grc, ell, eng, heb, kaz, kir, lav, lit, mkd, mkd2, oss, pnt, pus, rus, srp, srp2, tur, uig, ukr, yid".split(",")
-    special_isos_uroman = [i.strip() for i in special_isos_uroman]
 
-    uroman = ur.Uroman()
+def build_book_index(data: List[dict]) -> BookIndex:
+    """Group the verses of a book JSON by chapter in a single pass."""
+    index = {}
+    for d in data:
+        # convert MAT.19.1 -> MAT_019
+        book, chapter_number = d["numVerset"].split(".")[:2]
+        chapter = book + "_" + chapter_number.zfill(3)
+        verse_ids, transcripts = index.setdefault(chapter, ([], []))
+        verse_ids.append(d["numVerset"])
+        transcripts.append(d["verset"])
+    return index
 
-    if lang in special_isos_uroman:
-        romanized_text = uroman.romanize_string(text,lcode=lang)
-        norm_text = normalize_uroman(romanized_text)
+
+def load_book_index(json_path, index_dir=None) -> BookIndex:
+    """Chapter index of a book JSON, parsed at most once per process.
+
+    The index is kept in memory for as long as the file's mtime and size don't change.
+    If ``index_dir`` is set, it is also pickled there under the SHA-1 of the JSON
+    content, so other processes and later runs skip parsing the book altogether.
+    """
+    json_path = Path(json_path)
+    stat = json_path.stat()
+    cache_key = str(json_path.resolve())
+    cached = _BOOK_INDEXES.get(cache_key)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    raw = json_path.read_bytes()
+    index = None
+    if index_dir is not None:
+        index_path = Path(index_dir) / f"{hashlib.sha1(raw).hexdigest()}.v{BOOK_INDEX_VERSION}.pkl"
+        if index_path.exists():
+            with open(index_path, "rb") as f:
+                index = pickle.load(f)
+    if index is None:
+        index = build_book_index(json.loads(raw))
+        if index_dir is not None:
+            index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+
+    _BOOK_INDEXES[cache_key] = (stat.st_mtime_ns, stat.st_size, index)
+    return index
+
+
+def load_transcripts(json_path, chapter, index_dir=None):
+    verse_ids, transcripts = load_book_index(json_path, index_dir).get(chapter, ([], []))
+    # copies, the index is shared by every caller in the process
+    return list(verse_ids), list(transcripts)
+
+# iso codes with specialized rules in uroman
+SPECIAL_ISOS_UROMAN = [
+    i.strip()
+    for i in "ara, bel, bul, deu, ell, eng, fas, grc, ell, eng, heb, kaz, kir, lav, lit, mkd, mkd2, oss, pnt, pus, rus, srp, srp2, tur, uig, ukr, yid".split(",")
+]
+
+
+@lru_cache(maxsize=1)
+def get_uroman() -> "ur.Uroman":
+    # loading uroman's tables takes longer than romanizing a whole chapter, build it once
+    return ur.Uroman()
+
+
+def preprocess_verses(texts: List[str], lang: str) -> List[str]:
+    """Romanize and normalize a list of verses with a single uroman call.
+
+    The verses are joined with newlines and romanized at once, the way
+    ``ctc_forced_aligner.get_uroman_tokens`` does, then split back line by line.
+    """
+    if not texts:
+        return []
+
+    # a verse spanning several lines would shift every following verse
+    input_text = "\n".join(" ".join(text.splitlines()) for text in texts) + "\n"
+
+    uroman = get_uroman()
+    if lang in SPECIAL_ISOS_UROMAN:
+        romanized_lines = uroman.romanize_string(input_text, lcode=lang).splitlines()
     else:
-        romanized_text = uroman.romanize_string(text)
-        norm_text = text_normalize(romanized_text,lang)
-    
+        romanized_lines = uroman.romanize_string(input_text).splitlines()
+
+    assert len(romanized_lines) == len(texts), "uroman changed the number of verses"
+
+    if lang in SPECIAL_ISOS_UROMAN:
+        return [normalize_uroman(line) for line in romanized_lines]
+    return [text_normalize(line, lang) for line in romanized_lines]
 
-    return norm_text
+
+def preprocess_verse(text:str,lang:str):
+    return preprocess_verses([text], lang)[0]
 
 
-def pre_processing(json_path:str,chapter:str,lang:str):
+def pre_processing(json_path:str,chapter:str,lang:str,index_dir=None):
 
     # load transcript
-    verse_ids, transcripts = load_transcripts(json_path, chapter)
-    verses= [preprocess_verse(v,lang) for v in transcripts]
+    verse_ids, transcripts = load_transcripts(json_path, chapter, index_dir)
+    verses = preprocess_verses(transcripts, lang)
     
 
     augmented_verses = ["*"] * len(verses) * 2
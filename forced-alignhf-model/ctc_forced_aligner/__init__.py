@@ -1,17 +1,24 @@
 # flake8: noqa F401
 from .alignment_utils import (
+    AlignmentSession,
+    SegmentArray,
     forced_align,
+    forced_align_batch,
     generate_emissions,
+    get_alignment_vocab,
     get_alignments,
+    get_span_bounds,
     get_spans,
     load_alignment_model,
     load_audio,
     merge_repeats,
+    merge_repeats_array,
 )
 from .text_utils import (
     get_uroman_tokens,
     merge_segments,
     postprocess_results,
+    postprocess_span_bounds,
     preprocess_text,
     split_text,
     text_normalize,
@@ -1,16 +1,13 @@
 import json
-from pydub import AudioSegment
+import wave
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch
+import torchaudio
 from pathlib import Path
 
-from alignment_utils import (
-    generate_emissions,
-    get_alignments,
-    get_spans,
-    load_alignment_model,
-    load_audio,
-)
-from text_utils import postprocess_results, preprocess_text
+from alignment_utils import AlignmentSession, get_span_bounds
+from text_utils import postprocess_span_bounds, preprocess_text
 
 TORCH_DTYPES = {
     "bfloat16": torch.bfloat16,
@@ -38,81 +35,253 @@ def cli():
     parser.add_argument("--attn_implementation", type=str, default=None, choices=["eager", "sdpa", "flash_attention_2", None], help="Attention implementation for the model.")
     parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Device for execution ('cuda' or 'cpu').")
     parser.add_argument("--segment_audio", action="store_true", help="Enable segmentation of audio based on timestamps.")
+    parser.add_argument(
+        "--export_workers",
+        type=int,
+        default=0,
+        help="Threads writing the segments, 0 writes them one by one.",
+    )
     parser.add_argument("--generate_json", action="store_true", help="Enable generation of JSON file with results.")
     parser.add_argument("--generate_txt", action="store_true", help="Enable generation of TXT file with results.")
 
     args = parser.parse_args()
 
-    model, tokenizer = load_alignment_model(
+    session = AlignmentSession(
         args.device,
         args.alignment_model,
         args.attn_implementation,
         TORCH_DTYPES[args.compute_dtype],
     )
 
-    audio_waveform = load_audio(args.audio_path, model.dtype, model.device)
-    emissions, stride = generate_emissions(
-        model, audio_waveform, args.window_size, args.context_size, args.batch_size
+    align_file(
+        session,
+        args.audio_path,
+        args.text_path,
+        args.output_dir,
+        language=args.language,
+        romanize=args.romanize,
+        split_size=args.split_size,
+        star_frequency=args.star_frequency,
+        merge_threshold=args.merge_threshold,
+        window_size=args.window_size,
+        context_size=args.context_size,
+        batch_size=args.batch_size,
+        segment_audio=args.segment_audio,
+        generate_json=args.generate_json,
+        generate_txt=args.generate_txt,
+        export_workers=args.export_workers,
     )
 
 
+def to_pcm16(waveform: torch.Tensor) -> np.ndarray:
+    """channels X T float waveform -> T X channels int16 array.
+
+    Any time range of the result is one contiguous slice.
+    """
+    # torchaudio decodes 16-bit wav as sample / 32768, this gives the file's samples back exactly
+    pcm = (waveform * 32768).round().clamp(-32768, 32767).to(torch.int16)
+    return pcm.t().contiguous().numpy()
+
+
+def write_wav(path, pcm: np.ndarray, sample_rate: int):
+    """Write a T X channels int16 array as a 16-bit PCM wav file."""
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm)
+
+
+def export_segments(
+    pcm: np.ndarray,
+    sample_rate: int,
+    results: list,
+    output_dir: Path,
+    stem: str,
+    num_workers: int = 0,
+):
+    """Write every result with a valid time range as ``<stem>_<index>.wav`` and ``.txt``.
+
+    Segments are views into ``pcm``, written by ``num_workers`` threads (file writes
+    release the GIL) or one by one if ``num_workers`` is 0.
+    """
 
-    with open(args.text_path, "r", encoding="utf-8") as f:
+    def export(i, result):
+        start_ms = int(result["start"] * 1000)
+        end_ms = int(result["end"] * 1000)
+
+        # Vérification que les timestamps sont valides
+        if start_ms < end_ms:
+            filename = f"{stem}_{str(i+1).zfill(3)}"
+            start_frame = start_ms * sample_rate // 1000
+            end_frame = end_ms * sample_rate // 1000
+            write_wav(
+                (output_dir / filename).with_suffix(".wav"),
+                pcm[start_frame:end_frame],
+                sample_rate,
+            )
+
+            transcript_path = (output_dir / filename).with_suffix(".txt")
+            with open(transcript_path, "w", encoding="utf-8") as f:
+                f.write(result["text"])
+
+    if num_workers > 0:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # list() re-raises the first failed write
+            list(executor.map(export, range(len(results)), results))
+    else:
+        for i, result in enumerate(results):
+            export(i, result)
+
+
+def prepare_file(
+    session: AlignmentSession,
+    audio_path: str,
+    text_path: str,
+    language: str = None,
+    romanize: bool = False,
+    split_size: str = "word",
+    star_frequency: str = "edges",
+    window_size: int = 30,
+    context_size: int = 2,
+    batch_size: int = 4,
+    segment_audio: bool = False,
+):
+    """Emissions and starred tokens of one audio/text pair, all but the alignment."""
+    # decoded once, for both the model input and the exported segments
+    waveform, sample_rate = torchaudio.load(audio_path)
+    audio_waveform = session.prepare_waveform(waveform, sample_rate)
+    pcm = to_pcm16(waveform) if segment_audio else None
+    del waveform
+    emissions, stride = session.generate_emissions(
+        audio_waveform, window_size, context_size, batch_size
+    )
+
+    with open(text_path, "r", encoding="utf-8") as f:
         text = f.read().replace("\n", " ").strip()
 
     # includ bible verse loading after applying load_json function
-    
 
     tokens_starred, text_starred = preprocess_text(
-        text, args.romanize, args.language, args.split_size, args.star_frequency
+        text, romanize, language, split_size, star_frequency
     )
 
-    segments, scores, blank_token = get_alignments(
-        emissions,
-        tokens_starred,
-        tokenizer,
-    )
+    return {
+        "emissions": emissions,
+        "stride": stride,
+        "text": text,
+        "tokens_starred": tokens_starred,
+        "text_starred": text_starred,
+        "pcm": pcm,
+        "sample_rate": sample_rate,
+    }
 
-    spans = get_spans(tokens_starred, segments, blank_token)
 
-    results = postprocess_results(
-        text_starred, spans, stride, scores, args.merge_threshold
+def write_file_outputs(
+    prepared: dict,
+    alignment,
+    audio_path: str,
+    output_dir: str,
+    merge_threshold: float = 0.0,
+    segment_audio: bool = False,
+    generate_json: bool = False,
+    generate_txt: bool = False,
+    export_workers: int = 0,
+):
+    """Write the outputs of a prepared file from its ``get_alignments`` result."""
+    segments, scores, blank_token = alignment
+
+    span_starts, span_ends = get_span_bounds(
+        prepared["tokens_starred"], segments, blank_token
     )
 
-    output_dir = Path(args.output_dir)
+    results = postprocess_span_bounds(
+        prepared["text_starred"],
+        span_starts,
+        span_ends,
+        prepared["stride"],
+        scores,
+        merge_threshold,
+    )
+
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    txt_output_path = output_dir / f"{Path(args.audio_path).stem}.txt"
-    json_output_path = output_dir / f"{Path(args.audio_path).stem}.json"
+    txt_output_path = output_dir / f"{Path(audio_path).stem}.txt"
+    json_output_path = output_dir / f"{Path(audio_path).stem}.json"
 
     # Générer le fichier TXT si demandé
-    if args.generate_txt:
+    if generate_txt:
         with open(txt_output_path, "w", encoding="utf-8") as f:
             for result in results:
                 f.write(f"{result['start']}-{result['end']}: {result['text']}\n")
 
     # Générer le fichier JSON si demandé
-    if args.generate_json:
+    if generate_json:
         with open(json_output_path, "w", encoding="utf-8") as f:
-            json.dump({"text": text, "segments": results}, f, indent=4)
+            json.dump({"text": prepared["text"], "segments": results}, f, indent=4)
 
     # Segmentation audio si demandé
-    if args.segment_audio:
-        audio = AudioSegment.from_file(args.audio_path, format="wav")
-        for i, result in enumerate(results):
-            start_ms = int(result['start'] * 1000)
-            end_ms = int(result['end'] * 1000)
-
-            # Vérification que les timestamps sont valides
-            if start_ms < end_ms:
-                filename = f"{Path(args.audio_path).stem}_{str(i+1).zfill(3)}"
-                audio_path = (output_dir / filename).with_suffix(".wav")
-                segment = audio[start_ms:end_ms]
-                segment.export(audio_path, format="wav")
-
-                transcript_path = (output_dir / filename).with_suffix(".txt")
-                with open(transcript_path, "w", encoding="utf-8") as f:
-                    f.write(result['text'])
+    if segment_audio:
+        export_segments(
+            prepared["pcm"],
+            prepared["sample_rate"],
+            results,
+            output_dir,
+            Path(audio_path).stem,
+            export_workers,
+        )
+
+    return results
+
+
+def align_file(
+    session: AlignmentSession,
+    audio_path: str,
+    text_path: str,
+    output_dir: str,
+    language: str = None,
+    romanize: bool = False,
+    split_size: str = "word",
+    star_frequency: str = "edges",
+    merge_threshold: float = 0.0,
+    window_size: int = 30,
+    context_size: int = 2,
+    batch_size: int = 4,
+    segment_audio: bool = False,
+    generate_json: bool = False,
+    generate_txt: bool = False,
+    export_workers: int = 0,
+):
+    """Align one audio/text pair with an already loaded ``AlignmentSession``."""
+    prepared = prepare_file(
+        session,
+        audio_path,
+        text_path,
+        language=language,
+        romanize=romanize,
+        split_size=split_size,
+        star_frequency=star_frequency,
+        window_size=window_size,
+        context_size=context_size,
+        batch_size=batch_size,
+        segment_audio=segment_audio,
+    )
+    alignment = session.get_alignments(
+        prepared["emissions"], prepared["tokens_starred"]
+    )
+    return write_file_outputs(
+        prepared,
+        alignment,
+        audio_path,
+        output_dir,
+        merge_threshold=merge_threshold,
+        segment_audio=segment_audio,
+        generate_json=generate_json,
+        generate_txt=generate_txt,
+        export_workers=export_workers,
+    )
+
 
 if __name__ == "__main__":
     cli()
@@ -1,71 +1,278 @@
+import argparse
+import hashlib
+import json
 import os
-import subprocess
+import time
+
+from align import TORCH_DTYPES, prepare_file, write_file_outputs
+from alignment_utils import AlignmentSession
 from tqdm import tqdm
-import argparse
+
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Batch align audio-text pairs using align_p.py")
-
-    parser.add_argument('--audio_dir', required=True, help="Directory containing audio files (.wav)")
-    parser.add_argument('--text_dir', required=True, help="Directory containing text files (.txt)")
-    parser.add_argument('--output_dir', required=True, help="Directory to save aligned output")
-    parser.add_argument('--language', default='fr', help="Language code (e.g., fr, bum)")
-    parser.add_argument('--split_size', default='word', help="Split size: sentence, word, or char")
-    parser.add_argument('--romanize', action='store_true', help="Enable romanization")
-    parser.add_argument('--alignment_model', default='MahmoudAshraf/mms-300m-1130-forced-aligner')
-    parser.add_argument('--compute_dtype', default='float16')
-    parser.add_argument('--batch_size', default='4')
-    parser.add_argument('--window_size', default='30')
-    parser.add_argument('--context_size', default='2')
-    parser.add_argument('--attn_implementation', default=None)
-    parser.add_argument('--device', default='cuda')
-    parser.add_argument('--segment_audio', action='store_true', help="Enable audio segmentation")
-    parser.add_argument('--generate_json', action='store_true', help="Generate .json output")
-    parser.add_argument('--generate_txt', action='store_true', help="Generate .txt output")
+    parser = argparse.ArgumentParser(
+        description="Batch align audio-text pairs with a single in-process model"
+    )
+
+    parser.add_argument(
+        "--audio_dir", required=True, help="Directory containing audio files (.wav)"
+    )
+    parser.add_argument(
+        "--text_dir", required=True, help="Directory containing text files (.txt)"
+    )
+    parser.add_argument(
+        "--output_dir", required=True, help="Directory to save aligned output"
+    )
+    parser.add_argument(
+        "--language", default="fr", help="Language code (e.g., fr, bum)"
+    )
+    parser.add_argument(
+        "--split_size",
+        default="word",
+        choices=["sentence", "word", "char"],
+        help="Split size: sentence, word, or char",
+    )
+    parser.add_argument(
+        "--star_frequency",
+        default="edges",
+        choices=["segment", "edges"],
+        help="Frequency of <star> token.",
+    )
+    parser.add_argument(
+        "--merge_threshold",
+        type=float,
+        default=0.00,
+        help="Merge segments closer than this threshold.",
+    )
+    parser.add_argument("--romanize", action="store_true", help="Enable romanization")
+    parser.add_argument(
+        "--alignment_model", default="MahmoudAshraf/mms-300m-1130-forced-aligner"
+    )
+    parser.add_argument(
+        "--compute_dtype", default="float16", choices=["bfloat16", "float16", "float32"]
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--window_size", type=int, default=30)
+    parser.add_argument("--context_size", type=int, default=2)
+    parser.add_argument("--attn_implementation", default=None)
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument(
+        "--segment_audio", action="store_true", help="Enable audio segmentation"
+    )
+    parser.add_argument(
+        "--export_workers",
+        type=int,
+        default=0,
+        help="Threads writing the segments, 0 writes them one by one",
+    )
+    parser.add_argument(
+        "--align_group_size",
+        type=int,
+        default=8,
+        help="Files whose emissions are force-aligned together, in parallel threads",
+    )
+    parser.add_argument(
+        "--align_threads",
+        type=int,
+        default=0,
+        help="Threads aligning a group of files, 0 for all hardware threads",
+    )
+    parser.add_argument(
+        "--generate_json", action="store_true", help="Generate .json output"
+    )
+    parser.add_argument(
+        "--generate_txt", action="store_true", help="Generate .txt output"
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only list the files that would be aligned (new or changed)",
+    )
 
     return parser.parse_args()
 
+
+# written inside the output directory, one JSON line per aligned file. Same file name
+# and line format as data_prep/job_ledger.py, which the installed package can't import
+LEDGER_FILE_NAME = ".ledger.jsonl"
+
+# sources whose changes invalidate aligned outputs
+ALIGN_MODULES = ("align.py", "alignment_utils.py", "text_utils.py", "norm_config.py")
+
+# arguments that change the outputs of a file
+ALIGN_PARAMS = (
+    "language",
+    "split_size",
+    "star_frequency",
+    "merge_threshold",
+    "romanize",
+    "alignment_model",
+    "compute_dtype",
+    "window_size",
+    "context_size",
+    "segment_audio",
+    "generate_json",
+    "generate_txt",
+)
+
+
+def file_sha1(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_ledger(path):
+    """file name -> fingerprint of every file aligned in a previous run, later lines win."""
+    ledger = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # cut short by a crash
+                    continue
+                ledger[entry["key"]] = entry["fingerprint"]
+    return ledger
+
+
+def file_fingerprint(audio_path, text_path, code, params):
+    """Fingerprint of one file's alignment: audio and text content, code and parameters."""
+    payload = json.dumps(
+        [file_sha1(audio_path), file_sha1(text_path), code, params], sort_keys=True
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
 def main():
     args = parse_args()
 
-    audio_files = [f for f in os.listdir(args.audio_dir) if f.endswith('.wav')]
+    audio_files = [f for f in os.listdir(args.audio_dir) if f.endswith(".wav")]
     audio_files.sort()
 
-    for audio in tqdm(audio_files, desc="Aligning files", unit="file"):
+    # files aligned before from the same audio, text, code and parameters are skipped
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = [file_sha1(os.path.join(here, name)) for name in ALIGN_MODULES]
+    params = {name: getattr(args, name) for name in ALIGN_PARAMS}
+    ledger_path = os.path.join(args.output_dir, LEDGER_FILE_NAME)
+    ledger = load_ledger(ledger_path)
+
+    pending, up_to_date = [], 0
+    for audio in audio_files:
         audio_path = os.path.join(args.audio_dir, audio)
-        text_path = os.path.join(args.text_dir, audio.replace('.wav', '.txt'))
+        text_path = os.path.join(args.text_dir, audio.replace(".wav", ".txt"))
 
         if not os.path.exists(text_path):
             print(f"[⚠️] Text file not found for {audio}")
             continue
 
-        cmd = [
-            "python", "align_p.py",
-            "--audio_path", audio_path,
-            "--text_path", text_path,
-            "--output_dir", args.output_dir,
-            "--language", args.language,
-            "--split_size", args.split_size,
-            "--alignment_model", args.alignment_model,
-            "--compute_dtype", args.compute_dtype,
-            "--batch_size", str(args.batch_size),
-            "--window_size", str(args.window_size),
-            "--context_size", str(args.context_size),
-            "--device", args.device
-        ]
-
-        if args.romanize:
-            cmd.append("--romanize")
-        if args.segment_audio:
-            cmd.append("--segment_audio")
-        if args.generate_json:
-            cmd.append("--generate_json")
-        if args.generate_txt:
-            cmd.append("--generate_txt")
-        if args.attn_implementation:
-            cmd.extend(["--attn_implementation", args.attn_implementation])
-
-        subprocess.run(cmd)
+        fingerprint = file_fingerprint(audio_path, text_path, code, params)
+        if ledger.get(audio) == fingerprint:
+            up_to_date += 1
+            continue
+        if args.dry_run:
+            print(f"  would run {audio} ({'changed' if audio in ledger else 'new'})")
+        pending.append((audio, audio_path, text_path, fingerprint))
+
+    if args.dry_run:
+        print(f"{args.audio_dir}: {len(pending)} to run, {up_to_date} up to date")
+        return
+
+    # load the model, tokenizer and vocabulary once for the whole directory
+    session = AlignmentSession(
+        args.device,
+        args.alignment_model,
+        args.attn_implementation,
+        TORCH_DTYPES[args.compute_dtype],
+    )
+
+    def mark_done(audio, fingerprint):
+        # one line per file, appended once all its outputs are written
+        entry = {
+            "key": audio,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "fingerprint": fingerprint,
+        }
+        with open(ledger_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    progress = tqdm(total=len(pending), desc="Aligning files", unit="file")
+    group_size = max(1, args.align_group_size)
+    for group_start in range(0, len(pending), group_size):
+        # emissions of a whole group are computed first, then aligned in one batch
+        prepared = []
+        group = pending[group_start : group_start + group_size]
+        for audio, audio_path, text_path, fingerprint in group:
+            try:
+                prepared.append(
+                    (
+                        audio,
+                        audio_path,
+                        fingerprint,
+                        prepare_file(
+                            session,
+                            audio_path,
+                            text_path,
+                            language=args.language,
+                            romanize=args.romanize,
+                            split_size=args.split_size,
+                            star_frequency=args.star_frequency,
+                            window_size=args.window_size,
+                            context_size=args.context_size,
+                            batch_size=args.batch_size,
+                            segment_audio=args.segment_audio,
+                        ),
+                    )
+                )
+            except Exception as e:
+                # a failing file used to only kill its own subprocess, keep going
+                print(f"[❌] Alignment failed for {audio}: {e}")
+                progress.update(1)
+        if not prepared:
+            continue
+
+        try:
+            alignments = session.get_alignments_batch(
+                [file["emissions"] for _, _, _, file in prepared],
+                [file["tokens_starred"] for _, _, _, file in prepared],
+                args.align_threads,
+            )
+        except Exception as e:
+            for audio, _, _, _ in prepared:
+                print(f"[❌] Alignment failed for {audio}: {e}")
+            progress.update(len(prepared))
+            continue
+
+        for (audio, audio_path, fingerprint, file), alignment in zip(
+            prepared, alignments
+        ):
+            progress.update(1)
+            if alignment is None:
+                print(
+                    f"[❌] Alignment failed for {audio}: transcript too long for the audio"
+                )
+                continue
+            try:
+                write_file_outputs(
+                    file,
+                    alignment,
+                    audio_path,
+                    args.output_dir,
+                    merge_threshold=args.merge_threshold,
+                    segment_audio=args.segment_audio,
+                    generate_json=args.generate_json,
+                    generate_txt=args.generate_txt,
+                    export_workers=args.export_workers,
+                )
+            except Exception as e:
+                print(f"[❌] Alignment failed for {audio}: {e}")
+                continue
+            mark_done(audio, fingerprint)
+    progress.close()
+
 
 if __name__ == "__main__":
     main()
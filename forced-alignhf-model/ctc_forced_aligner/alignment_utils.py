@@ -13,6 +13,7 @@ from transformers import __version__ as transformers_version
 from transformers.utils import is_flash_attn_2_available
 
 from ctc_forced_aligner import forced_align as forced_align_cpp
+from ctc_forced_aligner import forced_align_batch as forced_align_batch_cpp
 
 SAMPLING_FREQ = 16000
 
@@ -31,15 +32,54 @@ class Segment:
         return self.end - self.start
 
 
+@dataclass
+class SegmentArray:
+    """Struct-of-arrays form of the ``Segment`` list returned by ``merge_repeats``."""
+
+    labels: np.ndarray  # (N,) token of each run, object array of str
+    starts: np.ndarray  # (N,) first frame of each run
+    ends: np.ndarray  # (N,) last frame of each run, inclusive
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_segments(cls, segments):
+        return cls(
+            np.array([seg.label for seg in segments], dtype=object),
+            np.array([seg.start for seg in segments], dtype=np.int64),
+            np.array([seg.end for seg in segments], dtype=np.int64),
+        )
+
+    def to_segments(self):
+        return [
+            Segment(label, start, end)
+            for label, start, end in zip(
+                self.labels.tolist(), self.starts.tolist(), self.ends.tolist()
+            )
+        ]
+
+
+def merge_repeats_array(path, idx_to_token_map) -> SegmentArray:
+    """Run-length encode an alignment path into a :class:`SegmentArray`."""
+    path = np.asarray(path, dtype=np.int64).reshape(-1)
+    if path.size == 0:
+        return SegmentArray(
+            np.empty(0, dtype=object),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+        )
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(path)) + 1))
+    ends = np.append(starts[1:] - 1, path.size - 1)
+
+    vocab = np.empty(max(idx_to_token_map) + 1, dtype=object)
+    vocab[list(idx_to_token_map.keys())] = list(idx_to_token_map.values())
+    return SegmentArray(vocab[path[starts]], starts, ends)
+
+
 def merge_repeats(path, idx_to_token_map):
-    i1, i2 = 0, 0
-    segments = []
-    while i1 < len(path):
-        while i2 < len(path) and path[i1] == path[i2]:
-            i2 += 1
-        segments.append(Segment(idx_to_token_map[path[i1]], i1, i2 - 1))
-        i1 = i2
-    return segments
+    return merge_repeats_array(path, idx_to_token_map).to_segments()
 
 
 def time_to_frame(time):
@@ -48,32 +88,41 @@ def time_to_frame(time):
     return int(time * frames_per_sec)
 
 
+def _span_intervals(tokens, labels, blank):
+    """First and last segment index of every token, found in the non-blank segments.
+
+    The non-blank segments spell the letters of ``tokens`` in order, so the cumulative
+    letter count of each token indexes its last segment directly. An empty token gets
+    the last segment of the token before it.
+    """
+    letters = [token.split(" ") if len(token) else [] for token in tokens]
+    counts = np.array([len(token_letters) for token_letters in letters], dtype=np.int64)
+    assert counts[0] > 0, "the first token is empty"
+
+    nonblank = np.flatnonzero(labels != blank)
+    expected = np.array(
+        [ltr for token_letters in letters for ltr in token_letters], dtype=object
+    )
+    assert len(nonblank) == len(expected) and np.all(
+        labels[nonblank] == expected
+    ), "the aligned segments don't spell the tokens"
+
+    last_letter = np.cumsum(counts) - 1
+    seg_ends = nonblank[last_letter]
+    seg_starts = seg_ends.copy()
+    not_empty = counts > 0
+    seg_starts[not_empty] = nonblank[(last_letter - counts + 1)[not_empty]]
+    return seg_starts, seg_ends
+
+
 def get_spans(tokens, segments, blank):
-    ltr_idx = 0
-    tokens_idx = 0
-    intervals = []
-    start, end = (0, 0)
-    for seg_idx, seg in enumerate(segments):
-        if tokens_idx == len(tokens):
-            assert seg_idx == len(segments) - 1
-            assert seg.label == blank
-            continue
-        cur_token = tokens[tokens_idx].split(" ")
-        ltr = cur_token[ltr_idx]
-        if seg.label == blank:
-            continue
-        assert seg.label == ltr, f"{seg.label} != {ltr}"
-        if (ltr_idx) == 0:
-            start = seg_idx
-        if ltr_idx == len(cur_token) - 1:
-            ltr_idx = 0
-            tokens_idx += 1
-            intervals.append((start, seg_idx))
-            while tokens_idx < len(tokens) and len(tokens[tokens_idx]) == 0:
-                intervals.append((seg_idx, seg_idx))
-                tokens_idx += 1
-        else:
-            ltr_idx += 1
+    if isinstance(segments, SegmentArray):
+        segment_array, segments = segments, segments.to_segments()
+    else:
+        segment_array = SegmentArray.from_segments(segments)
+    seg_starts, seg_ends = _span_intervals(tokens, segment_array.labels, blank)
+    intervals = list(zip(seg_starts.tolist(), seg_ends.tolist()))
+
     spans = []
     for idx, (start, end) in enumerate(intervals):
         span = segments[start : end + 1]
@@ -99,8 +148,45 @@ def get_spans(tokens, segments, blank):
     return spans
 
 
+def get_span_bounds(tokens, segments, blank) -> Tuple[np.ndarray, np.ndarray]:
+    """First and last frame of every span of :func:`get_spans`, without building the spans.
+
+    Returns:
+        Tuple(NDArray, NDArray): ``spans[i][0].start`` and ``spans[i][-1].end`` for
+        every token, i.e. the bounds including the surrounding blank padding.
+    """
+    if not isinstance(segments, SegmentArray):
+        segments = SegmentArray.from_segments(segments)
+    seg_starts, seg_ends = _span_intervals(tokens, segments.labels, blank)
+    is_first = np.arange(len(seg_starts)) == 0
+    is_last = np.arange(len(seg_ends)) == len(seg_ends) - 1
+
+    # a blank segment before the span gives it its start, or half of it after the first span
+    prev_idx = np.maximum(seg_starts - 1, 0)
+    prev_blank = (seg_starts > 0) & (segments.labels[prev_idx] == blank)
+    prev_mid = (segments.starts[prev_idx] + segments.ends[prev_idx]) // 2
+    pad_starts = np.where(is_first, segments.starts[prev_idx], prev_mid)
+    start_frames = np.where(prev_blank, pad_starts, segments.starts[seg_starts])
+
+    # a blank segment after the span gives it its end, or half of it before the last span
+    next_idx = np.minimum(seg_ends + 1, len(segments) - 1)
+    next_blank = (seg_ends + 1 < len(segments)) & (segments.labels[next_idx] == blank)
+    next_mid = (segments.starts[next_idx] + segments.ends[next_idx]) // 2
+    pad_ends = np.where(is_last, segments.ends[next_idx], next_mid)
+    end_frames = np.where(next_blank, pad_ends, segments.ends[seg_ends])
+
+    return start_frames, end_frames
+
+
 def load_audio(audio_file: str, dtype: torch.dtype, device: str):
     waveform, audio_sf = torchaudio.load(audio_file)  # waveform: channels X T
+    return prepare_waveform(waveform, audio_sf, dtype, device)
+
+
+def prepare_waveform(
+    waveform: torch.Tensor, audio_sf: int, dtype: torch.dtype, device: str
+):
+    """Turn an already decoded channels X T waveform into the model input."""
     waveform = torch.mean(waveform, dim=0)
 
     if audio_sf != SAMPLING_FREQ:
@@ -201,7 +287,8 @@ def forced_align(
         For example, in str `"aabbc"`, the number of repeats are `2`.
 
     Note:
-        The current version only supports ``batch_size==1``.
+        This function only supports ``batch_size==1``, see :func:`forced_align_batch`
+        for padded batches.
     """
     if blank in targets:
         raise ValueError(
@@ -221,24 +308,106 @@ def forced_align(
     return paths, scores
 
 
-def get_alignments(
-    emissions: torch.Tensor,
-    tokens: list,
-    tokenizer,
-):
-    assert len(tokens) > 0, "Empty transcript"
+def forced_align_batch(
+    log_probs: np.ndarray,
+    targets: np.ndarray,
+    input_lengths: Optional[np.ndarray] = None,
+    target_lengths: Optional[np.ndarray] = None,
+    blank: int = 0,
+    num_threads: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    r"""Align a padded batch of CTC label sequences to their emissions.
 
+    Items are aligned in parallel by the C++ extension, on ``num_threads`` threads
+    and with the GIL released.
+
+    Args:
+        log_probs (NDArray): log probability of CTC emission output.
+            NDArray of shape `(B, T, C)`, padded along `T`.
+        targets (NDArray): Target sequences. NDArray of shape `(B, L)`, padded along `L`.
+            Padding values are ignored.
+        input_lengths (NDArray or None, optional):
+            Number of valid frames of each item, 1-D NDArray of shape `(B,)`.
+            (Default: all `T` frames)
+        target_lengths (NDArray or None, optional):
+            Number of valid labels of each item, 1-D NDArray of shape `(B,)`.
+            (Default: all `L` labels)
+        blank (int, optional): The index of blank symbol in CTC emission. (Default: 0)
+        num_threads (int, optional): Number of threads, 0 for all hardware threads.
+            (Default: 0)
+
+    Returns:
+        Tuple(NDArray, NDArray):
+            NDArray: `(B, T)` label of each time step, blank past the input length.
+
+            NDArray: `(B, T)` log probability score of each time step, 0 past the
+            input length. Items whose targets don't fit in their input length get
+            ``-inf`` on every valid frame instead of raising.
+    """
+    log_probs = np.asarray(log_probs)
+    targets = np.asarray(targets, dtype=np.int64)
+    batch_size, num_frames, num_labels = log_probs.shape
+    if input_lengths is None:
+        input_lengths = np.full(batch_size, num_frames)
+    if target_lengths is None:
+        target_lengths = np.full(batch_size, targets.shape[1])
+    input_lengths = np.asarray(input_lengths, dtype=np.int64)
+    target_lengths = np.asarray(target_lengths, dtype=np.int64)
+
+    target_mask = np.arange(targets.shape[1])[None, :] < target_lengths[:, None]
+    valid_targets = targets[target_mask]
+    if blank in valid_targets:
+        raise ValueError(
+            f"targets Tensor shouldn't contain blank index. Found {targets}."
+        )
+    if blank >= num_labels or blank < 0:
+        raise ValueError("blank must be within [0, log_probs.shape[-1])")
+    if valid_targets.size and (
+        np.max(valid_targets) >= num_labels or np.min(valid_targets) < 0
+    ):
+        raise ValueError("targets values must be within [0, log_probs.shape[-1])")
+    assert log_probs.dtype == np.float32, "log_probs must be float32"
+
+    return forced_align_batch_cpp(
+        log_probs,
+        targets,
+        input_lengths,
+        target_lengths,
+        blank,
+        num_threads,
+    )
+
+
+def get_alignment_vocab(tokenizer):
+    """Build the lowercased alignment vocabulary of a CTC tokenizer.
+
+    Returns:
+        Tuple(dict, int, dict): the token -> index dictionary (including ``<star>``),
+        the blank index and the index -> token map.
+    """
     dictionary = tokenizer.get_vocab()
     dictionary = {k.lower(): v for k, v in dictionary.items()}
     dictionary["<star>"] = len(dictionary)
 
+    blank_id = dictionary.get("<blank>", tokenizer.pad_token_id)
+    idx_to_token_map = {v: k for k, v in dictionary.items()}
+    return dictionary, blank_id, idx_to_token_map
+
+
+def _align_tokens(
+    emissions: torch.Tensor,
+    tokens: list,
+    dictionary: dict,
+    blank_id: int,
+    idx_to_token_map: dict,
+):
+    assert len(tokens) > 0, "Empty transcript"
+
     # Force Alignment
     token_indices = [
         dictionary[c] for c in " ".join(tokens).split(" ") if c in dictionary
     ]
 
-    blank_id = dictionary.get("<blank>", tokenizer.pad_token_id)
-
     if not emissions.is_cpu:
         emissions = emissions.cpu()
     targets = np.asarray([token_indices], dtype=np.int64)
@@ -248,13 +417,75 @@ def get_alignments(
         targets,
         blank=blank_id,
     )
-    path = path.squeeze().tolist()
-
-    idx_to_token_map = {v: k for k, v in dictionary.items()}
-    segments = merge_repeats(path, idx_to_token_map)
+    segments = merge_repeats_array(path, idx_to_token_map)
     return segments, scores, idx_to_token_map[blank_id]
 
 
+def _align_tokens_batch(
+    emissions_list: list,
+    tokens_list: list,
+    dictionary: dict,
+    blank_id: int,
+    idx_to_token_map: dict,
+    num_threads: int = 0,
+):
+    """:func:`_align_tokens` of several files at once, with :func:`forced_align_batch`.
+
+    Returns:
+        list: ``(segments, scores, blank_token)`` of every file, or None for a file
+        whose transcript is too long for its emissions.
+    """
+    token_indices = []
+    for tokens in tokens_list:
+        assert len(tokens) > 0, "Empty transcript"
+        token_indices.append(
+            [dictionary[c] for c in " ".join(tokens).split(" ") if c in dictionary]
+        )
+
+    input_lengths = np.array([len(emissions) for emissions in emissions_list])
+    target_lengths = np.array([len(indices) for indices in token_indices])
+    num_labels = emissions_list[0].shape[-1]
+    log_probs = np.zeros(
+        (len(emissions_list), input_lengths.max(), num_labels), dtype=np.float32
+    )
+    # padding values are ignored
+    targets = np.zeros((len(token_indices), max(target_lengths.max(), 1)), np.int64)
+    for i, (emissions, indices) in enumerate(zip(emissions_list, token_indices)):
+        log_probs[i, : len(emissions)] = emissions.float().cpu().numpy()
+        targets[i, : len(indices)] = indices
+
+    paths, scores = forced_align_batch(
+        log_probs,
+        targets,
+        input_lengths,
+        target_lengths,
+        blank=blank_id,
+        num_threads=num_threads,
+    )
+
+    results = []
+    for path, item_scores, length in zip(paths, scores, input_lengths):
+        path, item_scores = path[:length], item_scores[:length]
+        if not length or np.isneginf(item_scores).all():
+            results.append(None)
+            continue
+        segments = merge_repeats_array(path, idx_to_token_map)
+        results.append((segments, item_scores, idx_to_token_map[blank_id]))
+    return results
+
+
+def get_alignments(
+    emissions: torch.Tensor,
+    tokens: list,
+    tokenizer,
+):
+    dictionary, blank_id, idx_to_token_map = get_alignment_vocab(tokenizer)
+    segments, scores, blank_token = _align_tokens(
+        emissions, tokens, dictionary, blank_id, idx_to_token_map
+    )
+    return segments.to_segments(), scores, blank_token
+
+
 def load_alignment_model(
     device: str,
     model_path: str = "MahmoudAshraf/mms-300m-1130-forced-aligner",
@@ -285,3 +516,77 @@ def load_alignment_model(
     tokenizer = AutoTokenizer.from_pretrained(model_path)
 
     return model, tokenizer
+
+
+class AlignmentSession:
+    """Alignment model, tokenizer and vocabulary loaded once and reused across files.
+
+    ``load_alignment_model`` and the vocabulary lookups in ``get_alignments`` are
+    the expensive part of aligning a short file, so batch drivers should create a
+    single session and call :meth:`generate_emissions` / :meth:`get_alignments`
+    for every file instead of starting a new process per file.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        model_path: str = "MahmoudAshraf/mms-300m-1130-forced-aligner",
+        attn_implementation: str = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.model, self.tokenizer = load_alignment_model(
+            device, model_path, attn_implementation, dtype
+        )
+        (
+            self.dictionary,
+            self.blank_id,
+            self.idx_to_token_map,
+        ) = get_alignment_vocab(self.tokenizer)
+        self.star_id = self.dictionary["<star>"]
+
+    @property
+    def blank_token(self) -> str:
+        return self.idx_to_token_map[self.blank_id]
+
+    def load_audio(self, audio_file: str) -> torch.Tensor:
+        return load_audio(audio_file, self.model.dtype, self.model.device)
+
+    def prepare_waveform(
+        self, waveform: torch.Tensor, sample_rate: int
+    ) -> torch.Tensor:
+        return prepare_waveform(
+            waveform, sample_rate, self.model.dtype, self.model.device
+        )
+
+    def generate_emissions(
+        self,
+        audio_waveform: torch.Tensor,
+        window_length=30,
+        context_length=2,
+        batch_size=4,
+    ):
+        return generate_emissions(
+            self.model, audio_waveform, window_length, context_length, batch_size
+        )
+
+    def get_alignments(self, emissions: torch.Tensor, tokens: list):
+        """Like :func:`get_alignments`, but the segments are a :class:`SegmentArray`."""
+        return _align_tokens(
+            emissions, tokens, self.dictionary, self.blank_id, self.idx_to_token_map
+        )
+
+    def get_alignments_batch(
+        self, emissions_list: list, tokens_list: list, num_threads: int = 0
+    ):
+        """:meth:`get_alignments` of several files, aligned in parallel C++ threads.
+
+        Files whose transcript doesn't fit in their emissions get None.
+        """
+        return _align_tokens_batch(
+            emissions_list,
+            tokens_list,
+            self.dictionary,
+            self.blank_id,
+            self.idx_to_token_map,
+            num_threads,
+        )
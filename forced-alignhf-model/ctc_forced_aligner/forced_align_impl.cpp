@@ -1,69 +1,100 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/numpy.h>
 
+#include <algorithm>
+#include <atomic>
+#include <limits>
+#include <stdexcept>
+#include <thread>
+#include <vector>
+
 namespace py = pybind11;
 
 // Inspired from
 // https://github.com/flashlight/sequence/blob/main/flashlight/lib/sequence/criterion/cpu/ConnectionistTemporalClassificationCriterion.cpp
+//
+// Aligns a single item. `logProbs` points to a row-major (T, C) block, `targets`
+// to L labels and `paths` to T outputs, so several items of a batch can be
+// aligned concurrently without touching any Python object.
 template <typename scalar_t, typename target_t>
 void forced_align_impl(
-    const py::array_t<scalar_t>& logProbs,
-    const py::array_t<target_t>& targets,
+    const scalar_t* logProbs,
+    const int64_t T,
+    const int64_t C,
+    const target_t* targets,
+    const int64_t L,
     const int64_t blank,
-    py::array_t<target_t>& paths) {
+    target_t* paths) {
   const scalar_t kNegInfinity = -std::numeric_limits<scalar_t>::infinity();
-  const auto batchIndex =
-      0; // TODO: support batch version and use the real batch index
-  const auto T = logProbs.shape(1);
-  const auto L = targets.shape(1);
   const auto S = 2 * L + 1;
   std::vector<scalar_t> alphas(2 * S, kNegInfinity);
 
-  // Replace backPtr tensor with two std::vector<bool>
-  // allocate memory based on the expected needed size which is approximately
-  // S * (T-L), we will use a safety margin of (T-L) to avoid reallocation
-  std::vector<unsigned long long> backPtr_offset(T - 1);
-  std::vector<unsigned long long> backPtr_seek(T - 1);
-
-  auto logProbs_data = logProbs.template unchecked<3>();
-  auto targets_data = targets.template unchecked<2>();
-  auto paths_data = paths.template mutable_unchecked<2>();
+  auto logProb = [&](int64_t t, int64_t c) { return logProbs[t * C + c]; };
 
   auto R = 0;
   for (auto i = 1; i < L; i++) {
-    if (targets_data(batchIndex, i) == targets_data(batchIndex, i - 1)) {
+    if (targets[i] == targets[i - 1]) {
       ++R;
     }
   }
 
-  if (T < L + R) {
+  if (T < L + R || T < 1) {
       throw std::runtime_error("targets length is too long for CTC.");
   }
-  std::vector<bool> backPtrBit0((S + 1) * (T - L), false);
-  std::vector<bool> backPtrBit1((S + 1) * (T - L), false);
 
-  auto start = T - (L + R) > 0 ? 0 : 1;
-  auto end = (S == 1) ? 1 : 2;
-  for (auto i = start; i < end; i++) {
-    auto labelIdx = (i % 2 == 0) ? blank : targets_data(batchIndex, i / 2);
-    alphas[i] = logProbs_data(batchIndex, 0, labelIdx);
+  // An empty target sequence can only be aligned to blanks
+  if (L == 0) {
+    std::fill(paths, paths + T, static_cast<target_t>(blank));
+    return;
   }
-  unsigned long long seek = 0;
-  for (auto t = 1; t < T; t++) {
+
+  // States [start, end) of frame t that can still lead to the end of the
+  // targets in the remaining frames, from those of frame t - 1.
+  auto advance = [&](int64_t t, int64_t& start, int64_t& end) {
     if (T - t <= L + R) {
-      if ((start % 2 == 1) &&
-        targets_data(batchIndex, start / 2) != targets_data(batchIndex, start / 2 + 1)) {
+      if ((start % 2 == 1) && start / 2 + 1 < L &&
+        targets[start / 2] != targets[start / 2 + 1]) {
         start = start + 1;
       }
       start = start + 1;
     }
     if (t <= L + R) {
       if (end % 2 == 0 && end < 2 * L &&
-        targets_data(batchIndex, end / 2 - 1) != targets_data(batchIndex, end / 2)) {
+        targets[end / 2 - 1] != targets[end / 2]) {
         end = end + 1;
       }
       end = end + 1;
     }
+  };
+
+  int64_t start = T - (L + R) > 0 ? 0 : 1;
+  int64_t end = (S == 1) ? 1 : 2;
+
+  // Replace backPtr tensor with two std::vector<bool>, one bit pair per state
+  // of every frame after the first. The states are counted ahead instead of
+  // estimated from S * (T-L), which is too small when T is close to L + R.
+  int64_t numBackPtrs = 0;
+  {
+    auto countStart = start;
+    auto countEnd = end;
+    for (int64_t t = 1; t < T; t++) {
+      advance(t, countStart, countEnd);
+      numBackPtrs += countEnd - countStart;
+    }
+  }
+  std::vector<unsigned long long> backPtr_offset(std::max<int64_t>(T - 1, 1));
+  std::vector<unsigned long long> backPtr_seek(std::max<int64_t>(T - 1, 1));
+
+  std::vector<bool> backPtrBit0(std::max<int64_t>(numBackPtrs, 1), false);
+  std::vector<bool> backPtrBit1(std::max<int64_t>(numBackPtrs, 1), false);
+
+  for (auto i = start; i < end; i++) {
+    auto labelIdx = (i % 2 == 0) ? blank : targets[i / 2];
+    alphas[i] = logProb(0, labelIdx);
+  }
+  unsigned long long seek = 0;
+  for (auto t = 1; t < T; t++) {
+    advance(t, start, end);
     auto startloop = start;
     auto curIdxOffset = t % 2;
     auto prevIdxOffset = (t - 1) % 2;
@@ -71,7 +102,7 @@ void forced_align_impl(
     backPtr_seek[t - 1] = seek;
     backPtr_offset[t - 1] = start;
     if (start == 0) {
-      alphas[curIdxOffset * S] = alphas[prevIdxOffset * S] + logProbs_data(batchIndex, t, blank);
+      alphas[curIdxOffset * S] = alphas[prevIdxOffset * S] + logProb(t, blank);
       startloop += 1;
       seek += 1;
     }
@@ -81,14 +112,14 @@ void forced_align_impl(
       auto x1 = alphas[prevIdxOffset * S + i - 1];
       auto x2 = kNegInfinity;
 
-      auto labelIdx = (i % 2 == 0) ? blank : targets_data(batchIndex, i / 2);
+      auto labelIdx = (i % 2 == 0) ? blank : targets[i / 2];
 
       // In CTC, the optimal path may optionally chose to skip a blank label.
       // x2 represents skipping a letter, and can only happen if we're not
       // currently on a blank_label, and we're not on a repeat letter
       // (i != 1) just ensures we don't access targets[i - 2] if its i < 2
       if (i % 2 != 0 && i != 1 &&
-        targets_data(batchIndex, i / 2) != targets_data(batchIndex, i / 2 - 1)) {
+        targets[i / 2] != targets[i / 2 - 1]) {
         x2 = alphas[prevIdxOffset * S + i - 2];
       }
       scalar_t result = 0.0;
@@ -101,7 +132,7 @@ void forced_align_impl(
       } else {
         result = x0;
       }
-      alphas[curIdxOffset * S + i] = result + logProbs_data(batchIndex, t, labelIdx);
+      alphas[curIdxOffset * S + i] = result + logProb(t, labelIdx);
     }
     seek += (end - startloop);
   }
@@ -109,19 +140,24 @@ void forced_align_impl(
   auto ltrIdx = alphas[idx1 * S + S - 1] > alphas[idx1 * S + S - 2] ? S - 1 : S - 2;
   // path stores the token index for each time step after force alignment.
   for (auto t = T - 1; t > -1; t--) {
-    auto lbl_idx = ltrIdx % 2 == 0 ? blank : targets_data(batchIndex, ltrIdx / 2);
-    paths_data(batchIndex, t) = lbl_idx;
+    auto lbl_idx = ltrIdx % 2 == 0 ? blank : targets[ltrIdx / 2];
+    paths[t] = lbl_idx;
+    if (t == 0) {
+      // the first frame has no back pointers
+      break;
+    }
     // Calculate backPtr value from bits
-    auto t_minus_one = t - 1 >= 0 ? t - 1 : 0;
-    auto backPtr_idx = backPtr_seek[t_minus_one] +
-                       ltrIdx - backPtr_offset[t_minus_one];
+    auto backPtr_idx = backPtr_seek[t - 1] + ltrIdx - backPtr_offset[t - 1];
     ltrIdx -= (backPtrBit1[backPtr_idx] << 1) | backPtrBit0[backPtr_idx];
   }
 }
 
+using LogProbsArray = py::array_t<float, py::array::c_style | py::array::forcecast>;
+using TargetsArray = py::array_t<int64_t, py::array::c_style | py::array::forcecast>;
+
 std::tuple<py::array_t<int64_t>, py::array_t<float>> compute(
-    const py::array_t<float>& logProbs,
-    const py::array_t<int64_t>& targets,
+    const LogProbsArray& logProbs,
+    const TargetsArray& targets,
     const int64_t blank) {
 
   if (logProbs.ndim() != 3) throw std::runtime_error("log_probs must be a 3-D array.");
@@ -130,9 +166,11 @@ std::tuple<py::array_t<int64_t>, py::array_t<float>> compute(
 
   const auto B = logProbs.shape(0);
   const auto T = logProbs.shape(1);
+  const auto C = logProbs.shape(2);
   auto paths = py::array_t<int64_t>({B, T});
 
-  forced_align_impl<float, int64_t>(logProbs, targets, blank, paths);
+  forced_align_impl<float, int64_t>(
+      logProbs.data(), T, C, targets.data(), targets.shape(1), blank, paths.mutable_data());
 
   auto aligned_paths = paths.unchecked<2>();
   auto scores = py::array_t<float>({T});
@@ -146,6 +184,100 @@ std::tuple<py::array_t<int64_t>, py::array_t<float>> compute(
   return std::make_tuple(paths, scores);
 }
 
+// Batched version: items are aligned in parallel on `num_threads` threads
+// (0 = all hardware threads) with the GIL released. Frames past an item's input
+// length get the blank label and a score of 0; items whose targets can't be
+// aligned get the blank label and a score of -inf on every valid frame.
+std::tuple<py::array_t<int64_t>, py::array_t<float>> compute_batch(
+    const LogProbsArray& logProbs,
+    const TargetsArray& targets,
+    const TargetsArray& inputLengths,
+    const TargetsArray& targetLengths,
+    const int64_t blank,
+    int64_t numThreads) {
+
+  if (logProbs.ndim() != 3) throw std::runtime_error("log_probs must be a 3-D array.");
+  if (targets.ndim() != 2) throw std::runtime_error("targets must be a 2-D array.");
+  if (inputLengths.ndim() != 1 || targetLengths.ndim() != 1)
+    throw std::runtime_error("input_lengths and target_lengths must be 1-D arrays.");
+
+  const auto B = logProbs.shape(0);
+  const auto T = logProbs.shape(1);
+  const auto C = logProbs.shape(2);
+  const auto L = targets.shape(1);
+  if (targets.shape(0) != B || inputLengths.shape(0) != B || targetLengths.shape(0) != B)
+    throw std::runtime_error("log_probs, targets and lengths must have the same batch size.");
+
+  const float* logProbsPtr = logProbs.data();
+  const int64_t* targetsPtr = targets.data();
+  const int64_t* inputLengthsPtr = inputLengths.data();
+  const int64_t* targetLengthsPtr = targetLengths.data();
+  for (auto b = 0; b < B; ++b) {
+    if (inputLengthsPtr[b] < 0 || inputLengthsPtr[b] > T)
+      throw std::runtime_error("input_lengths must be within [0, T].");
+    if (targetLengthsPtr[b] < 0 || targetLengthsPtr[b] > L)
+      throw std::runtime_error("target_lengths must be within [0, L].");
+  }
+
+  auto paths = py::array_t<int64_t>({B, T});
+  auto scores = py::array_t<float>({B, T});
+  int64_t* pathsPtr = paths.mutable_data();
+  float* scoresPtr = scores.mutable_data();
+
+  if (numThreads <= 0) {
+    numThreads = std::max<int64_t>(1, std::thread::hardware_concurrency());
+  }
+  numThreads = std::min<int64_t>(numThreads, std::max<int64_t>(B, 1));
+
+  {
+    py::gil_scoped_release release;
+
+    std::atomic<int64_t> next(0);
+    auto worker = [&]() {
+      for (auto b = next.fetch_add(1); b < B; b = next.fetch_add(1)) {
+        const auto itemT = inputLengthsPtr[b];
+        const float* itemLogProbs = logProbsPtr + b * T * C;
+        int64_t* itemPaths = pathsPtr + b * T;
+        float* itemScores = scoresPtr + b * T;
+        std::fill(itemPaths, itemPaths + T, blank);
+        std::fill(itemScores, itemScores + T, 0.0f);
+
+        try {
+          forced_align_impl<float, int64_t>(
+              itemLogProbs, itemT, C, targetsPtr + b * L, targetLengthsPtr[b], blank, itemPaths);
+          for (auto t = 0; t < itemT; ++t) {
+            itemScores[t] = itemLogProbs[t * C + itemPaths[t]];
+          }
+        } catch (const std::exception&) {
+          std::fill(itemPaths, itemPaths + T, blank);
+          std::fill(itemScores, itemScores + itemT, -std::numeric_limits<float>::infinity());
+        }
+      }
+    };
+
+    std::vector<std::thread> threads;
+    for (auto i = 1; i < numThreads; ++i) {
+      threads.emplace_back(worker);
+    }
+    worker();
+    for (auto& thread : threads) {
+      thread.join();
+    }
+  }
+
+  return std::make_tuple(paths, scores);
+}
+
 PYBIND11_MODULE(ctc_forced_aligner, m) {
     m.def("forced_align", &compute, "Compute forced alignment.");
-}
\ No newline at end of file
+    m.def(
+        "forced_align_batch",
+        &compute_batch,
+        "Compute forced alignment for a padded batch on several threads.",
+        py::arg("log_probs"),
+        py::arg("targets"),
+        py::arg("input_lengths"),
+        py::arg("target_lengths"),
+        py::arg("blank"),
+        py::arg("num_threads") = 0);
+}
@@ -1,108 +1,140 @@
 import re
+import sys
 import unicodedata
+
+from functools import lru_cache
+
 import uroman as ur
 import numpy as np
 from norm_config import norm_config
 
 
 
-def text_normalize(
-    text, iso_code, lower_case=True, remove_numbers=True, remove_brackets=False
-):
-    """Given a text, normalize it by changing to lower case, removing punctuations,
-    removing words that only contain digits and removing extra spaces
+# brackets with numbers in them, usually corresponds to "(Sam 23:17)"
+BRACKETS_WITH_DIGITS_PATTERN = re.compile(r"\([^\)]*\d[^\)]*\)")
+BRACKETS_PATTERN = re.compile(r"\([^\)]*\)")
+SPACES_PATTERN = re.compile(r"\s+")
 
-    Args:
-        text : The string to be normalized
-        iso_code : ISO 639-3 code of the language
-        remove_numbers : Boolean flag to specify if words containing only digits should be removed
 
-    Returns:
-        normalized_text : the string after all normalization
+@lru_cache(maxsize=1)
+def _all_characters():
+    return "".join(map(chr, range(sys.maxunicode + 1)))
 
-    """
 
-    config = norm_config.get(iso_code, norm_config["*"])
+def _char_class_members(char_class):
+    """Every character matched by the regex character class ``[char_class]``."""
+    return re.findall(r"[" + char_class + r"]", _all_characters())
 
-    for field in [
-        "lower_case",
-        "punc_set",
-        "del_set",
-        "mapping",
-        "digit_set",
-        "unicode_norm",
-    ]:
-        if field not in config:
-            config[field] = norm_config["*"][field]
 
-    text = unicodedata.normalize(config["unicode_norm"], text)
+class TextNormalizer:
+    """``text_normalize`` compiled once for one ISO code.
 
-    # Convert to lower case
+    The mapping and digit patterns are compiled and the punctuation and delete sets
+    are turned into a single ``str.translate`` table, so normalizing a long text
+    doesn't rebuild and recompile them for every line. The shared ``norm_config``
+    is left untouched.
+    """
 
-    if config["lower_case"] and lower_case:
-        text = text.lower()
+    def __init__(self, iso_code):
+        config = dict(norm_config["*"])
+        config.update(norm_config.get(iso_code, {}))
 
-    # brackets
+        self.unicode_norm = config["unicode_norm"]
+        self.lower_case = config["lower_case"]
+        self.mapping = [
+            (re.compile(old), new) for old, new in config["mapping"].items()
+        ]
 
-    # always text inside brackets with numbers in them. Usually corresponds to "(Sam 23:17)"
-    text = re.sub(r"\([^\)]*\d[^\)]*\)", " ", text)
-    if remove_brackets:
-        text = re.sub(r"\([^\)]*\)", " ", text)
+        # characters in the delete list are removed, punctuations are replaced
+        # with a space (punctuations win, as they were replaced before the deletion)
+        self.translation = {
+            ord(c): None for c in _char_class_members(config["del_set"])
+        }
+        self.translation.update(
+            {ord(c): " " for c in _char_class_members(config["punc_set"])}
+        )
 
-    # Apply mappings
+        # Remove words containing only digits
+        # We check for 3 cases:
+        #   a)text starts with a number
+        #   b) a number is present somewhere in the middle of the text
+        #   c) the text ends with a number
+        # For each case we use lookaround regex pattern to see if the digit pattern
+        # in preceded and followed by whitespaces, only then we replace the numbers
+        # with space
+        # The lookaround enables overlapping pattern matches to be replaced
+        digits_pattern = r"[" + config["digit_set"] + r"]+"
+        self.digits_pattern = re.compile(
+            r"^"
+            + digits_pattern
+            + r"(?=\s)|(?<=\s)"
+            + digits_pattern
+            + r"(?=\s)|(?<=\s)"
+            + digits_pattern
+            + r"$"
+        )
 
-    for old, new in config["mapping"].items():
-        text = re.sub(old, new, text)
+        self.unidecode = None
+        if config["rm_diacritics"]:
+            from unidecode import unidecode
 
-    # Replace punctutations with space
+            self.unidecode = unidecode
 
-    punct_pattern = r"[" + config["punc_set"]
+    def normalize(
+        self, text, lower_case=True, remove_numbers=True, remove_brackets=False
+    ):
+        text = unicodedata.normalize(self.unicode_norm, text)
 
-    punct_pattern += r"]"
+        # Convert to lower case
+        if self.lower_case and lower_case:
+            text = text.lower()
 
-    normalized_text = re.sub(punct_pattern, " ", text)
+        # brackets
+        text = BRACKETS_WITH_DIGITS_PATTERN.sub(" ", text)
+        if remove_brackets:
+            text = BRACKETS_PATTERN.sub(" ", text)
 
-    # remove characters in delete list
+        # Apply mappings
+        for old, new in self.mapping:
+            text = old.sub(new, text)
 
-    delete_patten = r"[" + config["del_set"] + r"]"
+        # Replace punctutations with space and remove characters in delete list
+        normalized_text = text.translate(self.translation)
 
-    normalized_text = re.sub(delete_patten, "", normalized_text)
+        if remove_numbers:
+            normalized_text = self.digits_pattern.sub(" ", normalized_text)
 
-    # Remove words containing only digits
-    # We check for 3 cases:
-    #   a)text starts with a number
-    #   b) a number is present somewhere in the middle of the text
-    #   c) the text ends with a number
-    # For each case we use lookaround regex pattern to see if the digit pattern in preceded
-    # and followed by whitespaces, only then we replace the numbers with space
-    # The lookaround enables overlapping pattern matches to be replaced
+        if self.unidecode is not None:
+            normalized_text = self.unidecode(normalized_text)
 
-    if remove_numbers:
-        digits_pattern = r"[" + config["digit_set"]
+        # Remove extra spaces
+        return SPACES_PATTERN.sub(" ", normalized_text).strip()
 
-        digits_pattern += r"]+"
 
-        complete_digit_pattern = (
-            r"^"
-            + digits_pattern
-            + r"(?=\s)|(?<=\s)"
-            + digits_pattern
-            + r"(?=\s)|(?<=\s)"
-            + digits_pattern
-            + r"$"
-        )
+@lru_cache(maxsize=None)
+def get_normalizer(iso_code):
+    return TextNormalizer(iso_code)
 
-        normalized_text = re.sub(complete_digit_pattern, " ", normalized_text)
 
-    if config["rm_diacritics"]:
-        from unidecode import unidecode
+def text_normalize(
+    text, iso_code, lower_case=True, remove_numbers=True, remove_brackets=False
+):
+    """Given a text, normalize it by changing to lower case, removing punctuations,
+    removing words that only contain digits and removing extra spaces
 
-        normalized_text = unidecode(normalized_text)
+    Args:
+        text : The string to be normalized
+        iso_code : ISO 639-3 code of the language
+        remove_numbers : Boolean flag to specify if words containing only digits should be removed
 
-    # Remove extra spaces
-    normalized_text = re.sub(r"\s+", " ", normalized_text).strip()
+    Returns:
+        normalized_text : the string after all normalization
+
+    """
 
-    return normalized_text
+    return get_normalizer(iso_code).normalize(
+        text, lower_case, remove_numbers, remove_brackets
+    )
 
 
 # iso codes with specialized rules in uroman
@@ -224,32 +256,54 @@ def merge_segments(segments, threshold=0.00):
             segments[i + 1]["start"] = segments[i]["end"]
 
 
-def postprocess_results(
+def postprocess_span_bounds(
     text_starred: list,
-    spans: list,
+    span_starts: np.ndarray,
+    span_ends: np.ndarray,
     stride: float,
     scores: np.ndarray,
     merge_threshold: float = 0.0,
 ):
-    results = []
-
-    for i, t in enumerate(text_starred):
-        if t == "<star>":
-            continue
-        span = spans[i]
-        seg_start_idx = span[0].start
-        seg_end_idx = span[-1].end
-
-        audio_start_sec = seg_start_idx * (stride) / 1000
-        audio_end_sec = seg_end_idx * (stride) / 1000
-        score = scores[seg_start_idx:seg_end_idx].sum()
-        sample = {
-            "start": audio_start_sec,
-            "end": audio_end_sec,
-            "text": t,
-            "score": score.item(),
-        }
-        results.append(sample)
+    """:func:`postprocess_results` from the span bounds of ``get_span_bounds``.
+
+    Word scores are read from a prefix sum of ``scores`` instead of summing a slice
+    per word.
+    """
+    keep = np.flatnonzero(np.asarray(text_starred, dtype=object) != "<star>")
+    starts = np.asarray(span_starts, dtype=np.int64)[keep]
+    ends = np.asarray(span_ends, dtype=np.int64)[keep]
+
+    cumulative_scores = np.concatenate(
+        ([0.0], np.cumsum(np.asarray(scores).reshape(-1), dtype=np.float64))
+    )
+    word_scores = cumulative_scores[np.maximum(ends, starts)] - cumulative_scores[starts]
+
+    results = [
+        {"start": start, "end": end, "text": text_starred[i], "score": score}
+        for i, start, end, score in zip(
+            keep.tolist(),
+            (starts * stride / 1000).tolist(),
+            (ends * stride / 1000).tolist(),
+            word_scores.tolist(),
+        )
+    ]
 
     merge_segments(results, merge_threshold)
     return results
+
+
+def postprocess_results(
+    text_starred: list,
+    spans: list,
+    stride: float,
+    scores: np.ndarray,
+    merge_threshold: float = 0.0,
+):
+    return postprocess_span_bounds(
+        text_starred,
+        [span[0].start for span in spans],
+        [span[-1].end for span in spans],
+        stride,
+        scores,
+        merge_threshold,
+    )
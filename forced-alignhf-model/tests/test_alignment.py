@@ -1,9 +1,26 @@
+import math
+
 import numpy as np
 import pytest
 import torch
 import torchaudio.functional as F
 
-from ctc_forced_aligner.alignment_utils import forced_align
+from ctc_forced_aligner.alignment_utils import (
+    Segment,
+    _align_tokens,
+    _align_tokens_batch,
+    forced_align,
+    forced_align_batch,
+    get_span_bounds,
+    get_spans,
+    merge_repeats,
+    merge_repeats_array,
+)
+from ctc_forced_aligner.text_utils import (
+    merge_segments,
+    postprocess_results,
+    postprocess_span_bounds,
+)
 
 
 @pytest.mark.parametrize(
@@ -26,3 +43,275 @@ def test_alignment(logprobs_size, vocab_size, targets_size):
 
     num_mismatches = np.sum(ctc_alignment[0] != torch_alignment[0].numpy())
     assert num_mismatches <=1
+
+
+@pytest.mark.parametrize("batch_size, vocab_size", [(1, 30), (4, 30), (7, 40)])
+def test_batched_alignment(batch_size, vocab_size):
+    rng = np.random.default_rng(batch_size)
+    max_frames, max_targets = 2000, 800
+    input_lengths = rng.integers(max_frames // 2, max_frames + 1, batch_size)
+    target_lengths = (input_lengths * rng.uniform(0.2, 0.4, batch_size)).astype(np.int64)
+    logprobs = 6.5 * rng.standard_normal((batch_size, max_frames, vocab_size + 1)) - 13
+    logprobs = logprobs.astype(np.float32)
+    targets = rng.integers(1, vocab_size, (batch_size, max_targets))
+
+    paths, scores = forced_align_batch(logprobs, targets, input_lengths, target_lengths)
+
+    for i in range(batch_size):
+        path, score = forced_align(
+            logprobs[i : i + 1, : input_lengths[i]].copy(),
+            targets[i : i + 1, : target_lengths[i]].copy(),
+        )
+        np.testing.assert_array_equal(paths[i, : input_lengths[i]], path[0])
+        np.testing.assert_allclose(scores[i, : input_lengths[i]], score)
+        assert np.all(paths[i, input_lengths[i] :] == 0)
+
+
+def test_batched_alignment_too_long_targets():
+    logprobs = np.zeros((2, 10, 5), dtype=np.float32)
+    targets = np.ones((2, 20), dtype=np.int64)
+    paths, scores = forced_align_batch(
+        logprobs, targets, np.array([10, 10]), np.array([3, 20])
+    )
+
+    assert np.isfinite(scores[0]).all()
+    assert np.isneginf(scores[1]).all()
+
+
+@pytest.mark.parametrize(
+    "targets",
+    [[1], [1, 2, 3, 4, 5], [1, 1], [1, 2, 2, 3], [3, 3, 3]],
+)
+def test_alignment_exact_fit(targets):
+    # as many frames as the targets need (T == L + R), and a few more
+    torch.manual_seed(0)
+    repeats = sum(a == b for a, b in zip(targets, targets[1:]))
+    for num_frames in range(len(targets) + repeats, len(targets) + repeats + 3):
+        logprobs = torch.log_softmax(torch.randn(1, num_frames, 6), dim=-1)
+
+        ctc_alignment, _ = forced_align(logprobs.numpy(), np.array([targets]))
+        torch_alignment, _ = F.forced_align(logprobs, torch.tensor([targets]))
+
+        np.testing.assert_array_equal(ctc_alignment[0], torch_alignment[0].numpy())
+
+
+def test_batched_alignment_exact_fit_and_empty_targets():
+    rng = np.random.default_rng(0)
+    logprobs = np.log(rng.dirichlet(np.ones(6), size=(4, 5))).astype(np.float32)
+    targets = np.array([[1, 0, 0, 0, 0], [1, 2, 3, 4, 5], [0] * 5, [1, 2, 0, 0, 0]])
+
+    paths, scores = forced_align_batch(logprobs, targets, [1, 5, 4, 2], [1, 5, 0, 2])
+
+    np.testing.assert_array_equal(
+        paths,
+        [[1, 0, 0, 0, 0], [1, 2, 3, 4, 5], [0, 0, 0, 0, 0], [1, 2, 0, 0, 0]],
+    )
+    assert np.all(np.isfinite(scores))
+    # an empty target sequence is aligned to blanks on its valid frames
+    np.testing.assert_allclose(scores[2, :4], logprobs[2, :4, 0])
+
+
+def test_batched_alignment_accepts_lists():
+    rng = np.random.default_rng(0)
+    logprobs = (6.5 * rng.standard_normal((2, 50, 6)) - 13).astype(np.float32)
+    targets = [[1, 2, 3, 4], [5, 4, 0, 0]]
+
+    paths, scores = forced_align_batch(logprobs, targets, [50, 40], [4, 2])
+    expected, _ = forced_align_batch(
+        logprobs, np.array(targets), np.array([50, 40]), np.array([4, 2])
+    )
+
+    np.testing.assert_array_equal(paths, expected)
+
+
+def test_align_tokens_batch_matches_single():
+    idx_to_token_map = {0: "<blank>", 1: "a", 2: "b", 3: "c", 4: "<star>"}
+    dictionary = {token: idx for idx, token in idx_to_token_map.items()}
+    tokens_list = [["<star>", "a b", "c"], ["b b", "<star>", "a c a"], ["a"] * 20]
+    generator = torch.Generator().manual_seed(0)
+    emissions_list = [
+        torch.log_softmax(torch.randn(frames, 5, generator=generator), dim=-1)
+        for frames in (30, 45, 10)
+    ]
+
+    alignments = _align_tokens_batch(
+        emissions_list, tokens_list, dictionary, 0, idx_to_token_map
+    )
+
+    for emissions, tokens, alignment in zip(
+        emissions_list[:2], tokens_list[:2], alignments[:2]
+    ):
+        segments, scores, blank_token = _align_tokens(
+            emissions, tokens, dictionary, 0, idx_to_token_map
+        )
+        assert alignment[0].to_segments() == segments.to_segments()
+        np.testing.assert_allclose(alignment[1], scores)
+        assert alignment[2] == blank_token
+    # 20 tokens don't fit in 10 frames
+    assert alignments[2] is None
+
+
+# reference copies of the per-segment loops that SegmentArray and the span bounds replaced
+def _reference_merge_repeats(path, idx_to_token_map):
+    i1, i2 = 0, 0
+    segments = []
+    while i1 < len(path):
+        while i2 < len(path) and path[i1] == path[i2]:
+            i2 += 1
+        segments.append(Segment(idx_to_token_map[path[i1]], i1, i2 - 1))
+        i1 = i2
+    return segments
+
+
+def _reference_get_spans(tokens, segments, blank):
+    ltr_idx = 0
+    tokens_idx = 0
+    intervals = []
+    start, end = (0, 0)
+    for seg_idx, seg in enumerate(segments):
+        if tokens_idx == len(tokens):
+            assert seg_idx == len(segments) - 1
+            assert seg.label == blank
+            continue
+        cur_token = tokens[tokens_idx].split(" ")
+        ltr = cur_token[ltr_idx]
+        if seg.label == blank:
+            continue
+        assert seg.label == ltr, f"{seg.label} != {ltr}"
+        if (ltr_idx) == 0:
+            start = seg_idx
+        if ltr_idx == len(cur_token) - 1:
+            ltr_idx = 0
+            tokens_idx += 1
+            intervals.append((start, seg_idx))
+            while tokens_idx < len(tokens) and len(tokens[tokens_idx]) == 0:
+                intervals.append((seg_idx, seg_idx))
+                tokens_idx += 1
+        else:
+            ltr_idx += 1
+    spans = []
+    for idx, (start, end) in enumerate(intervals):
+        span = segments[start : end + 1]
+        if start > 0:
+            prev_seg = segments[start - 1]
+            if prev_seg.label == blank:
+                pad_start = (
+                    prev_seg.start
+                    if (idx == 0)
+                    else int((prev_seg.start + prev_seg.end) / 2)
+                )
+                span = [Segment(blank, pad_start, span[0].start)] + span
+        if end + 1 < len(segments):
+            next_seg = segments[end + 1]
+            if next_seg.label == blank:
+                pad_end = (
+                    next_seg.end
+                    if (idx == len(intervals) - 1)
+                    else math.floor((next_seg.start + next_seg.end) / 2)
+                )
+                span = span + [Segment(blank, span[-1].end, pad_end)]
+        spans.append(span)
+    return spans
+
+
+def _reference_postprocess_results(text_starred, spans, stride, scores):
+    results = []
+    for i, t in enumerate(text_starred):
+        if t == "<star>":
+            continue
+        span = spans[i]
+        seg_start_idx = span[0].start
+        seg_end_idx = span[-1].end
+        score = scores[seg_start_idx:seg_end_idx].sum()
+        results.append(
+            {
+                "start": seg_start_idx * stride / 1000,
+                "end": seg_end_idx * stride / 1000,
+                "text": t,
+                "score": score.item(),
+            }
+        )
+    merge_segments(results)
+    return results
+
+
+def _random_path(rng, tokens, token_to_idx):
+    """A CTC path spelling ``tokens``, with blank runs of random length around the letters."""
+    path = [0] * rng.integers(0, 3)
+    for token in tokens:
+        for ltr in token.split(" ") if token else []:
+            label = token_to_idx[ltr]
+            # a repeated letter needs a blank in between, or it merges with the previous one
+            num_blanks = rng.integers(1 if path and path[-1] == label else 0, 3)
+            path += [0] * num_blanks + [label] * rng.integers(1, 4)
+    return path + [0] * rng.integers(0, 3)
+
+
+def _check_spans(tokens, text, path, idx_to_token_map):
+    scores = np.linspace(-1.0, 0.0, len(path), dtype=np.float32)
+
+    reference_segments = _reference_merge_repeats(path, idx_to_token_map)
+    assert merge_repeats(path, idx_to_token_map) == reference_segments
+    segment_array = merge_repeats_array(np.asarray([path]), idx_to_token_map)
+    assert segment_array.to_segments() == reference_segments
+
+    reference_spans = _reference_get_spans(tokens, reference_segments, "<blank>")
+    assert get_spans(tokens, reference_segments, "<blank>") == reference_spans
+    assert get_spans(tokens, segment_array, "<blank>") == reference_spans
+
+    span_starts, span_ends = get_span_bounds(tokens, segment_array, "<blank>")
+    assert span_starts.tolist() == [span[0].start for span in reference_spans]
+    assert span_ends.tolist() == [span[-1].end for span in reference_spans]
+
+    expected = _reference_postprocess_results(text, reference_spans, 20, scores)
+    for results in (
+        postprocess_results(text, reference_spans, 20, scores),
+        postprocess_span_bounds(text, span_starts, span_ends, 20, scores),
+    ):
+        assert [r["text"] for r in results] == [r["text"] for r in expected]
+        for result, reference in zip(results, expected):
+            assert (result["start"], result["end"]) == (
+                reference["start"],
+                reference["end"],
+            )
+            assert result["score"] == pytest.approx(reference["score"], abs=1e-5)
+    return reference_segments, expected
+
+
+def test_span_bounds_match_spans():
+    idx_to_token_map = {0: "<blank>", 1: "a", 2: "b", 3: "c", 4: "<star>"}
+    tokens = ["<star>", "a b", "b b c", "", "<star>", "c"]
+    text = ["<star>", "ab", "bbc", "x", "<star>", "c"]
+    path = [0, 4, 0, 1, 1, 2, 0, 2, 0, 2, 3, 0, 0, 4, 4, 0, 3, 0, 0]
+
+    segments, results = _check_spans(tokens, text, path, idx_to_token_map)
+    assert [(seg.start, seg.end) for seg in segments][:4] == [
+        (0, 0),
+        (1, 1),
+        (2, 2),
+        (3, 4),
+    ]
+    assert [(r["text"], r["start"], r["end"]) for r in results] == [
+        ("ab", 0.04, 0.12),
+        ("bbc", 0.12, 0.22),
+        ("x", 0.22, 0.22),
+        ("c", 0.3, 0.36),
+    ]
+
+
+def test_span_bounds_match_spans_random_paths():
+    idx_to_token_map = {0: "<blank>", 1: "a", 2: "b", 3: "c", 4: "<star>"}
+    token_to_idx = {token: idx for idx, token in idx_to_token_map.items()}
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        words = [
+            " ".join(rng.choice(["a", "b", "c"], size=rng.integers(0, 4)))
+            for _ in range(rng.integers(1, 6))
+        ]
+        # the first token is never empty, stars are optional around the words
+        tokens = ["<star>"] + [token for word in words for token in (word, "<star>")]
+        if rng.random() < 0.5:
+            tokens = tokens[1:] if words[0] else tokens
+        text = [token.replace(" ", "") if token else "x" for token in tokens]
+        path = _random_path(rng, tokens, token_to_idx)
+        _check_spans(tokens, text, path, idx_to_token_map)